@@ -1,24 +1,38 @@
-import easyocr
-import cv2
-import ollama
 import json
+import copy
+import hashlib
 import logging
 import os
-from typing import Dict, Any, Optional, List
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional, List
+from backend.ocr_cache import OCRCache, hash_file
+from backend.image_preprocessing import (
+    ImagePreprocessor, PreprocessProfile, VisionPayloadBuilder, box_to_rect, merge_regions, reading_order
+)
+from backend.partial_json import IncrementalJSONParser
+from backend.chunked_analysis import chunk_text, estimate_tokens, merge_analyses
+from backend.clinical_extractor import extract_clinical_values, prefill_hint, merge_extracted
+from backend.json_repair import repair_json
+from backend.ollama_pool import OllamaPool, is_connection_error
+from backend.lazy_import import lazy_import
+from backend.pipeline_metrics import StageTimer, timed
+from backend.cancellation import propagate
+from config import config
+
+# Pulls in torch; only needed once an AIEngine is built
+easyocr = lazy_import("easyocr")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class AIEngine:
-    def __init__(self):
-        self.reader = easyocr.Reader(['es', 'en'])
-        self.client = ollama.Client(host='http://192.168.1.81:11434')
-        self.vision_model = 'qwen3-vl:8b'
-        self.logic_model = 'qwen3:8b'
-        self.host = 'http://192.168.1.81:11434'
 
-        self.medical_prompt = """
+# Prompt templates
+MEDICAL_PROMPT = """
         Eres un asistente médico de IA especializado en análisis de documentos clínicos.
         Tu tarea es analizar el siguiente texto médico y generar un JSON estructurado con formato SOAP.
 
@@ -95,7 +109,7 @@ class AIEngine:
         {text_content}
         """
 
-        self.classification_prompt = """
+CLASSIFICATION_PROMPT = """
         Clasifica el siguiente texto médico en una de estas categorías y responde ÚNICAMENTE con un JSON:
         {{"document_type": "consultation|prescription|lab_result|referral", "confidence": 0-100, "reason": "breve explicación"}}
 
@@ -103,7 +117,423 @@ class AIEngine:
         {text_content}
         """
 
-    def extract_text_from_image(self, image_path: str, examples: List[Dict[str, Any]] = []) -> str:
+
+REGION_PROMPT = (
+    "Esta imagen es un fragmento recortado de un documento médico. Transcribe exactamente el texto "
+    "que contiene, sin comentarios ni explicaciones. Si no hay texto legible, responde con una cadena vacía."
+)
+
+
+def _nullable(kind: str) -> Dict[str, Any]:
+    return {"type": [kind, "null"]}
+
+
+def _string_list() -> Dict[str, Any]:
+    return {"type": "array", "items": {"type": "string"}}
+
+
+def _object(properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+# Structured-output constraint for the SOAP analysis (Ollama `format=`); mirrors MEDICAL_PROMPT
+SOAP_SCHEMA = _object({
+    "patient_info": _object({
+        "name": {"type": "string"},
+        "age": {"type": ["string", "integer", "null"]},
+        "gender": _nullable("string"),
+    }),
+    "document_type": {"type": "string", "enum": ["consultation", "prescription", "lab_result", "referral"]},
+    "subjective": _object({
+        "chief_complaint": {"type": "string"},
+        "symptoms": _string_list(),
+        "history": {"type": "string"},
+    }),
+    "objective": _object({
+        "vitals": _object({k: _nullable("string") for k in (
+            "blood_pressure", "heart_rate", "temperature", "weight", "height", "spo2")}),
+        "findings": _string_list(),
+    }),
+    "assessment": _object({
+        "diagnoses": {"type": "array", "items": _object({
+            "description": {"type": "string"},
+            "cie10_code": _nullable("string"),
+        })},
+        "differential_diagnoses": _string_list(),
+    }),
+    "plan": _object({
+        "medications": {"type": "array", "items": _object({
+            k: {"type": "string"} for k in ("drug_name", "dose", "frequency", "duration", "instructions")
+        })},
+        "studies": _string_list(),
+        "referrals": _string_list(),
+        "follow_up": {"type": "string"},
+        "recommendations": _string_list(),
+    }),
+    "lab_values": {"type": "array", "items": _object({
+        "test_name": {"type": "string"},
+        "value": {"type": "string"},
+        "unit": {"type": "string"},
+        "reference_range": {"type": "string"},
+        "is_abnormal": {"type": "boolean"},
+    })},
+    "summary": {"type": "string"},
+    "confidence_score": {"type": "integer", "minimum": 0, "maximum": 100},
+})
+
+# Short descriptions used when only some fields have to be asked for again
+SOAP_FIELD_DESCRIPTIONS = {
+    "patient_info": "datos del paciente (name, age, gender)",
+    "document_type": 'uno de "consultation", "prescription", "lab_result", "referral"',
+    "subjective": "chief_complaint, symptoms, history",
+    "objective": "vitals y findings",
+    "assessment": "diagnoses (description, cie10_code) y differential_diagnoses",
+    "plan": "medications, studies, referrals, follow_up, recommendations",
+    "lab_values": "lista de estudios de laboratorio con test_name, value, unit, reference_range, is_abnormal",
+    "summary": "resumen clínico conciso (2-3 oraciones en Español)",
+    "confidence_score": "entero de 0 a 100 con la confianza del análisis",
+}
+
+MISSING_FIELDS_PROMPT = """
+        Eres un asistente médico de IA. Del siguiente texto médico, genera ÚNICAMENTE un JSON
+        con estos campos (no incluyas ningún otro):
+        {fields}
+
+        Responde ÚNICAMENTE con el JSON válido. Sin bloques de código markdown.
+
+        Texto Médico a Analizar:
+        {text_content}
+        """
+
+
+def soap_schema_for(fields: List[str]) -> Dict[str, Any]:
+    """SOAP_SCHEMA restricted to `fields`."""
+    return _object({f: SOAP_SCHEMA["properties"][f] for f in fields if f in SOAP_SCHEMA["properties"]})
+
+
+CHUNK_PREAMBLE = (
+    "[Fragmento {index} de {total} de un documento más largo. Extrae únicamente la información "
+    "que aparece en este fragmento.]\n"
+)
+
+
+def build_vision_prompt(examples: List[Dict[str, Any]] = None) -> str:
+    prompt = (
+        "Transcribe el texto en este documento médico exactamente como aparece. "
+        "Incluye todos los datos clínicos, nombres de medicamentos, dosis, valores de laboratorio "
+        "y cualquier información del paciente visible. No agregues comentarios."
+    )
+
+    if examples:
+        prompt = "Aquí hay ejemplos de documentos previos y su transcripción correcta:\n\n"
+        for i, ex in enumerate(examples[:10]):
+            prompt += f"Ejemplo {i+1}: '{ex['corrected_text']}'\n"
+        prompt += "\nAhora, transcribe este nuevo documento médico con el mismo nivel de detalle.\n"
+    return prompt
+
+
+# (ocr_text, image_path) -> few-shot examples for the vision prompt
+ExampleSelector = Callable[[str, str], List[Dict[str, Any]]]
+
+
+def create_image_preprocessor() -> ImagePreprocessor:
+    """Preprocessor with the OCR and vision profiles from config."""
+    return ImagePreprocessor({
+        "ocr": PreprocessProfile("ocr", config.OCR_MAX_IMAGE_EDGE,
+                                 grayscale=config.OCR_GRAYSCALE,
+                                 normalize_contrast=config.OCR_NORMALIZE_CONTRAST),
+        "vision": PreprocessProfile("vision", config.VISION_MAX_IMAGE_EDGE,
+                                    grayscale=config.VISION_GRAYSCALE,
+                                    normalize_contrast=config.VISION_NORMALIZE_CONTRAST),
+    })
+
+
+def create_vision_payload_builder(preprocessor: ImagePreprocessor) -> VisionPayloadBuilder:
+    return VisionPayloadBuilder(preprocessor, fmt=config.VISION_IMAGE_FORMAT,
+                                quality=config.VISION_IMAGE_QUALITY,
+                                patch_size=config.VISION_PATCH_SIZE,
+                                max_cache_bytes=config.VISION_PAYLOAD_CACHE_MB * 1024 * 1024)
+
+
+def parse_json_content(json_str: str) -> Dict[str, Any]:
+    """Parse a model's JSON reply, tolerating markdown code fences around it."""
+    if "```json" in json_str:
+        json_str = json_str.split("```json")[1].split("```")[0]
+    elif "```" in json_str:
+        json_str = json_str.split("```")[1].split("```")[0]
+    return json.loads(json_str)
+
+
+def validate_analysis(data: Dict[str, Any]) -> bool:
+    required_fields = [
+        "document_type",
+        "summary",
+        "confidence_score"
+    ]
+
+    if not isinstance(data, dict):
+        return False
+
+    for field in required_fields:
+        if field not in data:
+            logger.warning(f"Missing field in AI response: {field}")
+            return False
+
+    return True
+
+
+def fallback_analysis(chief_complaint: str, summary: str) -> Dict[str, Any]:
+    """Empty SOAP structure stored when the model's answer can't be used."""
+    return {
+        "document_type": "consultation",
+        "subjective": {"chief_complaint": chief_complaint, "symptoms": [], "history": ""},
+        "objective": {"vitals": {}, "findings": []},
+        "assessment": {"diagnoses": [], "differential_diagnoses": []},
+        "plan": {"medications": [], "studies": [], "referrals": [], "follow_up": "", "recommendations": []},
+        "lab_values": [],
+        "summary": summary,
+        "confidence_score": 0
+    }
+
+
+class LLMResponseCache:
+    """
+    In-memory memoization of parsed LLM responses.
+
+    Keys combine model, prompt template version, whitespace-normalized input
+    text and request options. Entries expire after `ttl_seconds` and the least
+    recently used ones are dropped beyond `max_entries`. Concurrent requests for
+    the same key share a single in-flight computation, so identical work never
+    occupies the GPU twice.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        return re.sub(r"\s+", " ", text or "").strip()
+
+    @classmethod
+    def make_key(cls, model: str, prompt_version: str, text: str, options: Dict[str, Any] = None) -> str:
+        raw = json.dumps([model, prompt_version, cls.normalize_text(text), options or {}],
+                         sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(value)
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.time(), copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any],
+                       cacheable: Callable[[Any], bool] = None, bypass: bool = False) -> Any:
+        """
+        Return the cached value for `key`, or run `compute()` once and cache its
+        result if `cacheable(result)` holds. With bypass=True the cache is not
+        read, but a fresh cacheable result still replaces the stored one.
+        """
+        if bypass:
+            with self._lock:
+                self.bypasses += 1
+            value = compute()
+            if cacheable is None or cacheable(value):
+                self.put(key, value)
+            return value
+
+        while True:
+            value = self.get(key)
+            if value is not None:
+                with self._lock:
+                    self.hits += 1
+                return value
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._inflight[key] = event
+                    self.misses += 1
+                    break
+            # Someone else is computing this key; wait, then re-check the cache
+            # (if their result wasn't cacheable we become the next computer)
+            event.wait()
+
+        try:
+            value = compute()
+            if cacheable is None or cacheable(value):
+                self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is event:
+                    del self._inflight[key]
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+            }
+
+
+class AIEngine:
+    # Bump when a prompt template changes meaningfully so cached results
+    # produced by the old prompt stop matching.
+    VISION_PROMPT_VERSION = "1"
+    REGION_PROMPT_VERSION = "1"
+    MEDICAL_PROMPT_VERSION = "1"
+    CLASSIFICATION_PROMPT_VERSION = "1"
+    OCR_LANGUAGES = ['es', 'en']
+    DOCUMENT_TYPES = ("consultation", "prescription", "lab_result", "referral")
+    # Sections pushed to clients as soon as they finish streaming
+    STREAM_SECTIONS = (
+        "document_type", "patient_info", "summary", "subjective", "objective",
+        "assessment", "plan.medications", "plan", "lab_values", "confidence_score",
+    )
+
+    def __init__(self):
+        self.reader = easyocr.Reader(self.OCR_LANGUAGES)
+        # One EasyOCR inference at a time; pages and regions share the reader
+        self._reader_lock = threading.Lock()
+        self.preprocessor = create_image_preprocessor()
+        self.vision_payloads = create_vision_payload_builder(self.preprocessor)
+        self.ocr_cache = OCRCache(max_bytes=config.OCR_CACHE_MAX_MB * 1024 * 1024)
+        self.llm_cache = LLMResponseCache(max_entries=config.LLM_CACHE_MAX_ENTRIES,
+                                          ttl_seconds=config.LLM_CACHE_TTL_SECONDS)
+        # How model replies were turned into JSON (parsed / repaired / reasked / failed)
+        self._json_outcomes: Dict[str, int] = {}
+        self._json_lock = threading.Lock()
+        self.vision_model = config.OLLAMA_VISION_MODEL
+        self.logic_model = config.OLLAMA_LOGIC_MODEL
+        # Vision and logic hosts are added to the pool even if not listed in OLLAMA_HOSTS
+        hosts = config.OLLAMA_HOSTS + config.OLLAMA_VISION_HOSTS + config.OLLAMA_LOGIC_HOSTS
+        self.pool = OllamaPool(
+            hosts,
+            model_routes={
+                self.vision_model: config.OLLAMA_VISION_HOSTS,
+                self.logic_model: config.OLLAMA_LOGIC_HOSTS,
+            },
+            health_interval=config.OLLAMA_HEALTH_INTERVAL,
+            keep_alive=config.OLLAMA_KEEP_ALIVE,
+            breaker_failures=config.OLLAMA_BREAKER_FAILURES,
+            breaker_reset=config.OLLAMA_BREAKER_RESET_SECONDS,
+            hedge_percentile=config.OLLAMA_HEDGE_PERCENTILE,
+            hedge_min_samples=config.OLLAMA_HEDGE_MIN_SAMPLES,
+            # One context size per model for every call (Ollama silently truncates prompts beyond
+            # num_ctx, and reloads the model when it changes). If both roles use the same model
+            # the analysis context wins, since it's the larger budget.
+            model_options={
+                self.vision_model: {"num_ctx": config.VISION_NUM_CTX},
+                self.logic_model: {"num_ctx": config.ANALYSIS_NUM_CTX},
+            }
+        )
+        self.host = hosts[0]
+
+        self.medical_prompt = MEDICAL_PROMPT
+        self.classification_prompt = CLASSIFICATION_PROMPT
+
+    @property
+    def ocr_model(self) -> str:
+        # Preprocessing changes what EasyOCR sees, so it's part of the cache key
+        return "easyocr:" + ",".join(self.OCR_LANGUAGES) + ":" + self.preprocessor.profiles["ocr"].signature()
+
+    def _readtext(self, image) -> List[Any]:
+        start = time.perf_counter()
+        with self._reader_lock:
+            results = self.reader.readtext(image)
+        logger.info(f"EasyOCR took {(time.perf_counter() - start) * 1000:.0f} ms "
+                    f"on {image.shape[1]}x{image.shape[0]}")
+        return results
+
+    def extract_text_from_pages(self, image_paths: List[str], examples: List[Dict[str, Any]] = [],
+                                select_examples: ExampleSelector = None, timer: StageTimer = None) -> List[str]:
+        """
+        Text for each page of a multi-page document, in page order. Uncached
+        pages that come out of preprocessing at the same size go through
+        EasyOCR's batched inference together; the per-page confidence checks
+        and vision fallbacks then run in parallel on OCR_PAGE_WORKERS threads.
+        Failed pages yield an "Error..." string like extract_text_from_image.
+        """
+        ocr_results = self._batch_readtext(image_paths)
+        workers = max(1, min(len(image_paths), config.OCR_PAGE_WORKERS))
+        def extract(path):
+            return self.extract_text_from_image(path, examples, ocr_result=ocr_results.get(path),
+                                                select_examples=select_examples, timer=timer)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-page") as executor:
+            return list(executor.map(propagate(extract), image_paths))
+
+    def _batch_readtext(self, image_paths: List[str]) -> Dict[str, Any]:
+        """EasyOCR results for the pages not already cached: path -> (prepared image, results)."""
+        prepared = {}
+        for path in image_paths:
+            if path in prepared or not os.path.exists(path):
+                continue
+            if self.ocr_cache.contains(hash_file(path), "easyocr", self.ocr_model):
+                continue
+            image = self.preprocessor.process(path, "ocr")
+            if image is not None:
+                prepared[path] = image
+
+        # readtext_batched needs every image in a batch to have the same shape
+        groups: Dict[Any, List[str]] = {}
+        for path, image in prepared.items():
+            groups.setdefault(image.image.shape, []).append(path)
+
+        results = {}
+        for shape, paths in groups.items():
+            if len(paths) == 1:
+                results[paths[0]] = (prepared[paths[0]], self._readtext(prepared[paths[0]].image))
+                continue
+            start = time.perf_counter()
+            with self._reader_lock:
+                batch = self.reader.readtext_batched([prepared[p].image for p in paths],
+                                                     batch_size=config.OCR_BATCH_SIZE)
+            logger.info(f"EasyOCR batch of {len(paths)} pages took "
+                        f"{(time.perf_counter() - start) * 1000:.0f} ms on {shape[1]}x{shape[0]}")
+            for path, page_results in zip(paths, batch):
+                results[path] = (prepared[path], page_results)
+        return results
+
+    def extract_text_from_image(self, image_path: str, examples: List[Dict[str, Any]] = [],
+                                ocr_result=None, select_examples: ExampleSelector = None,
+                                timer: StageTimer = None) -> str:
+        """
+        `ocr_result` is a precomputed (prepared image, EasyOCR results) pair, see _batch_readtext.
+        `select_examples(ocr_text, image_path)` picks the vision prompt's few-shot
+        examples for this page (e.g. CorrectionIndex.select); it replaces `examples`
+        and is only called if the page actually goes to the vision model.
+        Time spent in the vision fallback is added to `timer` as "vision_fallback".
+        """
         try:
             logger.info(f"Starting text extraction for: {image_path}")
 
@@ -111,147 +541,382 @@ class AIEngine:
                 logger.error(f"Image file not found: {image_path}")
                 return "Error: Image file not found."
 
-            img = cv2.imread(image_path)
-            if img is None:
-                logger.error(f"Failed to load image with OpenCV: {image_path}")
-                return "Error: Could not load image."
+            image_hash = hash_file(image_path)
+            ocr_model = self.ocr_model
 
-            results = self.reader.readtext(img)
-
-            if not results:
+            prepared = None
+            results = None
+            cached = None if ocr_result else self.ocr_cache.get(image_hash, "easyocr", ocr_model)
+            if cached is not None:
+                logger.info(f"EasyOCR cache hit for {image_hash[:12]}")
+                text, avg_conf = cached['text'], cached['confidence'] or 0
+            else:
+                if ocr_result:
+                    prepared, results = ocr_result
+                else:
+                    prepared = self.preprocessor.process(image_path, "ocr")
+                    if prepared is None:
+                        return "Error: Could not load image."
+                    results = self._readtext(prepared.image)
+
+                text = ""
+                confidences = []
+                for (_, t, conf) in results:
+                    text += t + " "
+                    confidences.append(conf)
+                text = text.strip()
+
+                avg_conf = sum(confidences) / len(confidences) if confidences else 0
+                self.ocr_cache.put(image_hash, "easyocr", text, avg_conf, model=ocr_model)
+
+            if not text:
                 logger.info("EasyOCR found no text. Falling back to Vision Model.")
-                return self._transcribe_with_vision(image_path, examples)
+                with timed(timer, "vision_fallback"):
+                    if select_examples is not None:
+                        examples = select_examples("", image_path)
+                    return self._transcribe_with_vision(image_path, examples, image_hash=image_hash)
 
-            text = ""
-            confidences = []
-            for (_, t, conf) in results:
-                text += t + " "
-                confidences.append(conf)
-
-            avg_conf = sum(confidences) / len(confidences) if confidences else 0
             logger.info(f"EasyOCR Average Confidence: {avg_conf:.2f}")
 
-            if avg_conf >= 0.80:
-                return text.strip()
+            if avg_conf >= config.OCR_CONFIDENCE_THRESHOLD:
+                return text
+
+            with timed(timer, "vision_fallback"):
+                if config.OCR_REGION_FALLBACK:
+                    hybrid = self._transcribe_low_confidence_regions(image_path, image_hash, prepared, results)
+                    if hybrid:
+                        return hybrid
 
-            logger.info("Confidence too low (< 0.80). Falling back to Vision Model.")
-            return self._transcribe_with_vision(image_path, examples)
+                logger.info(f"Confidence too low (< {config.OCR_CONFIDENCE_THRESHOLD:.2f}). "
+                            f"Falling back to Vision Model.")
+                if select_examples is not None:
+                    examples = select_examples(text, image_path)
+                return self._transcribe_with_vision(image_path, examples, image_hash=image_hash)
 
         except Exception as e:
             logger.error(f"OCR Error: {e}")
-            if "Connection refused" in str(e):
+            if is_connection_error(e):
                 return "Error: Ollama service is not running."
             return f"Error using Vision AI: {str(e)}"
 
-    def _transcribe_with_vision(self, image_path: str, examples: List[Dict[str, Any]] = []) -> str:
+    def _transcribe_low_confidence_regions(self, image_path: str, image_hash: str,
+                                           prepared=None, results=None) -> Optional[str]:
+        """
+        Hybrid fallback: keep the EasyOCR boxes that read well, send padded crops of
+        the low-confidence ones to the vision model in parallel and merge everything
+        back in reading order. Returns None when a full-page transcription is the
+        better deal (too many crops, or most of the page is illegible).
+        """
+        ocr_profile = self.preprocessor.profiles["ocr"]
+        prompt_version = (f"{self.REGION_PROMPT_VERSION}:{ocr_profile.signature()}:"
+                          f"{config.OCR_REGION_CONFIDENCE}")
+        cached = self.ocr_cache.get(image_hash, "hybrid", self.vision_model, prompt_version)
+        if cached is not None:
+            logger.info(f"Hybrid transcription cache hit for {image_hash[:12]}")
+            return cached['text']
+
+        if results is None:
+            # EasyOCR text came from the cache, but the boxes are needed to crop
+            prepared = self.preprocessor.process(image_path, "ocr")
+            if prepared is None:
+                return None
+            results = self._readtext(prepared.image)
+
+        boxes = [(box_to_rect(points), t, conf) for (points, t, conf) in results]
+        low = [(rect, t) for rect, t, conf in boxes if conf < config.OCR_REGION_CONFIDENCE]
+        if not low:
+            return None
+
+        regions = merge_regions([rect for rect, _ in low], prepared.size)
+        page_area = prepared.size[0] * prepared.size[1]
+        crop_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+        if len(regions) > config.OCR_REGION_MAX_CROPS or crop_area > page_area * config.OCR_REGION_MAX_AREA:
+            logger.info(f"{len(regions)} low-confidence regions covering {crop_area / page_area:.0%} "
+                        f"of the page; using full-page vision instead")
+            return None
+
+        def inside(rect, region):
+            return rect[0] >= region[0] and rect[1] >= region[1] and rect[2] <= region[2] and rect[3] <= region[3]
+
+        def transcribe(region):
+            try:
+                response = self.pool.chat(
+                    model=self.vision_model,
+                    timeout=config.OLLAMA_VISION_TIMEOUT,
+                    messages=[{'role': 'user', 'content': REGION_PROMPT,
+                               'images': [prepared.encode(self.vision_payloads.ext, region=region,
+                                                          quality=self.vision_payloads.quality)]}]
+                )
+                return response['message']['content'].strip()
+            except Exception as e:
+                # Keep EasyOCR's reading for this region rather than losing it
+                logger.error(f"Region transcription failed for {region}: {e}")
+                return " ".join(t for rect, t in low if inside(rect, region))
+
+        logger.info(f"Sending {len(regions)} low-confidence regions ({crop_area / page_area:.0%} of the page) "
+                    f"to Ollama ({self.vision_model})...")
+        start = time.perf_counter()
+        workers = max(1, min(len(regions), config.OCR_REGION_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-region") as executor:
+            region_texts = list(executor.map(propagate(transcribe), regions))
+        logger.info(f"Region transcription took {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        segments = [(rect, t) for rect, t, conf in boxes if conf >= config.OCR_REGION_CONFIDENCE]
+        segments += list(zip(regions, region_texts))
+        text = reading_order(segments)
+        if text:
+            self.ocr_cache.put(image_hash, "hybrid", text, model=self.vision_model,
+                               prompt_version=prompt_version)
+        return text
+
+    def _transcribe_with_vision(self, image_path: str, examples: List[Dict[str, Any]] = [],
+                                image_hash: str = None) -> str:
         try:
-            logger.info(f"Sending image to Ollama ({self.vision_model})...")
-
-            prompt = (
-                "Transcribe el texto en este documento médico exactamente como aparece. "
-                "Incluye todos los datos clínicos, nombres de medicamentos, dosis, valores de laboratorio "
-                "y cualquier información del paciente visible. No agregues comentarios."
-            )
-
-            if examples:
-                prompt = "Aquí hay ejemplos de documentos previos y su transcripción correcta:\n\n"
-                for i, ex in enumerate(examples[:10]):
-                    prompt += f"Ejemplo {i+1}: '{ex['corrected_text']}'\n"
-                prompt += "\nAhora, transcribe este nuevo documento médico con el mismo nivel de detalle.\n"
+            prompt = build_vision_prompt(examples)
+
+            # Few-shot examples are part of the prompt, so they're part of the cache key too
+            prompt_version = (f"{self.VISION_PROMPT_VERSION}:{hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]}:"
+                              f"{self.vision_payloads.signature()}")
+            if image_hash:
+                cached = self.ocr_cache.get(image_hash, "vision", self.vision_model, prompt_version)
+                if cached is not None:
+                    logger.info(f"Vision transcription cache hit for {image_hash[:12]}")
+                    return cached['text']
+
+            payload = self.vision_payloads.build(image_path, image_hash=image_hash)
+            if payload is None:
+                return "Error: Could not load image."
 
-            response = self.client.chat(
+            logger.info(f"Sending image to Ollama ({self.vision_model})...")
+            response = self.pool.chat(
                 model=self.vision_model,
+                timeout=config.OLLAMA_VISION_TIMEOUT,
                 messages=[
                     {
                         'role': 'user',
                         'content': prompt,
-                        'images': [image_path]
+                        'images': [payload]
                     }
                 ]
             )
-            return response['message']['content'].strip()
+            text = response['message']['content'].strip()
+            if image_hash and text:
+                self.ocr_cache.put(image_hash, "vision", text, model=self.vision_model,
+                                   prompt_version=prompt_version)
+            return text
         except Exception as e:
             logger.error(f"Vision Model Transcription Error: {e}")
             return "Error during Vision Model transcription."
 
-    def classify_document(self, text_content: str) -> Dict[str, Any]:
+    def classify_document(self, text_content: str, fresh: bool = False) -> Dict[str, Any]:
         if not text_content or text_content.strip() == "":
             return {"document_type": "consultation", "confidence": 0}
 
         try:
-            formatted = self.classification_prompt.format(text_content=text_content)
-            response = self.client.chat(
-                model=self.logic_model,
-                messages=[{'role': 'user', 'content': formatted}],
-                format='json'
+            key = self.llm_cache.make_key(self.logic_model, self.CLASSIFICATION_PROMPT_VERSION,
+                                          text_content, {"format": "json"})
+            return self.llm_cache.get_or_compute(
+                key, lambda: self._request_classification(text_content), bypass=fresh
             )
-            json_str = response['message']['content']
-            if "```json" in json_str:
-                json_str = json_str.split("```json")[1].split("```")[0]
-            elif "```" in json_str:
-                json_str = json_str.split("```")[1].split("```")[0]
-            return json.loads(json_str)
         except Exception as e:
             logger.error(f"Classification error: {e}")
             return {"document_type": "consultation", "confidence": 0}
 
-    def analyze_medical_text(self, text_content: str) -> Dict[str, Any]:
+    def _request_classification(self, text_content: str) -> Dict[str, Any]:
+        formatted = self.classification_prompt.format(text_content=text_content)
+        response = self.pool.chat(
+            model=self.logic_model,
+            messages=[{'role': 'user', 'content': formatted}],
+            format='json',
+            timeout=config.OLLAMA_CLASSIFY_TIMEOUT
+        )
+        return parse_json_content(response['message']['content'])
+
+    @property
+    def analysis_chunk_tokens(self) -> int:
+        """Room for document text in one analysis call: context minus prompt and response."""
+        prompt_tokens = estimate_tokens(self.medical_prompt) + estimate_tokens(CHUNK_PREAMBLE)
+        return max(256, config.ANALYSIS_NUM_CTX - config.ANALYSIS_RESPONSE_TOKENS - prompt_tokens)
+
+    @property
+    def analysis_format(self):
+        """Full JSON schema (structured outputs) or plain JSON mode for older Ollama servers."""
+        return SOAP_SCHEMA if config.ANALYSIS_JSON_SCHEMA else 'json'
+
+    def analyze_medical_text(self, text_content: str, fresh: bool = False,
+                             on_section: Callable[[str, Any], None] = None) -> Dict[str, Any]:
+        """
+        SOAP analysis of `text_content`. If `on_section(path, value)` is given the
+        response is streamed and each section in STREAM_SECTIONS is reported as
+        soon as it is complete (on a cache hit it is never called).
+
+        Text that doesn't fit the model's context window alongside the prompt is
+        analyzed map-reduce style: token-budgeted chunks in parallel, then a
+        deterministic merge (see backend.chunked_analysis). Streaming only
+        applies to the single-call path.
+        """
         if not text_content or text_content.strip() == "":
             return {"error": "No text content to analyze"}
 
         try:
-            logger.info(f"Sending text to Ollama ({self.logic_model}) for medical analysis...")
-            formatted_prompt = self.medical_prompt.format(text_content=text_content)
-
-            response = self.client.chat(
-                model=self.logic_model,
-                messages=[
-                    {'role': 'user', 'content': formatted_prompt}
-                ],
-                format='json'
-            )
+            # Vitals, labs and doses that appear verbatim are read by rules, not generated
+            extracted = extract_clinical_values(text_content) if config.PRE_EXTRACT_VALUES else None
 
-            json_str = response['message']['content']
+            chunks = chunk_text(text_content, self.analysis_chunk_tokens, config.ANALYSIS_CHUNK_OVERLAP_TOKENS)
+            if len(chunks) > 1:
+                return merge_extracted(self._analyze_in_chunks(chunks, fresh), extracted)
 
-            if "```json" in json_str:
-                json_str = json_str.split("```json")[1].split("```")[0]
-            elif "```" in json_str:
-                json_str = json_str.split("```")[1].split("```")[0]
-
-            json_data = json.loads(json_str)
+            json_data = self._cached_medical_analysis(text_content, fresh, on_section,
+                                                      hint=prefill_hint(extracted))
 
             if self.validate_response(json_data):
-                return json_data
+                return merge_extracted(json_data, extracted)
             else:
-                return {
-                    "document_type": "consultation",
-                    "subjective": {"chief_complaint": "No se pudo analizar", "symptoms": [], "history": ""},
-                    "objective": {"vitals": {}, "findings": []},
-                    "assessment": {"diagnoses": [], "differential_diagnoses": []},
-                    "plan": {"medications": [], "studies": [], "referrals": [], "follow_up": "", "recommendations": []},
-                    "lab_values": [],
-                    "summary": "La respuesta de la IA no contenía todos los campos requeridos.",
-                    "confidence_score": 0
-                }
+                return fallback_analysis("No se pudo analizar",
+                                         "La respuesta de la IA no contenía todos los campos requeridos.")
 
         except json.JSONDecodeError:
             logger.error("Failed to parse JSON from Ollama response.")
-            return {
-                "document_type": "consultation",
-                "subjective": {"chief_complaint": "Error de análisis", "symptoms": [], "history": ""},
-                "objective": {"vitals": {}, "findings": []},
-                "assessment": {"diagnoses": [], "differential_diagnoses": []},
-                "plan": {"medications": [], "studies": [], "referrals": [], "follow_up": "", "recommendations": []},
-                "lab_values": [],
-                "summary": "Error al parsear la respuesta de la IA.",
-                "confidence_score": 0
-            }
+            return fallback_analysis("Error de análisis", "Error al parsear la respuesta de la IA.")
         except Exception as e:
             logger.error(f"Ollama Logic error: {e}")
-            if "Connection refused" in str(e):
+            if is_connection_error(e):
                 return {"error": "Ollama service is not running. Please start 'ollama serve'."}
             return {"error": f"Analysis failed: {str(e)}"}
 
+    def _cached_medical_analysis(self, text_content: str, fresh: bool = False,
+                                 on_section: Callable[[str, Any], None] = None,
+                                 hint: str = "") -> Dict[str, Any]:
+        key = self.llm_cache.make_key(self.logic_model, self.MEDICAL_PROMPT_VERSION, text_content,
+                                      {"format": "schema" if config.ANALYSIS_JSON_SCHEMA else "json",
+                                       "num_ctx": config.ANALYSIS_NUM_CTX, "hint": hint})
+        # The cache hands out copies, so merging extracted values into the result is safe
+        return self.llm_cache.get_or_compute(
+            key, lambda: self._request_medical_analysis(text_content, on_section, hint),
+            cacheable=self.validate_response, bypass=fresh
+        )
+
+    def _analyze_in_chunks(self, chunks: List[str], fresh: bool = False) -> Dict[str, Any]:
+        logger.info(f"Document too long for one call; analyzing {len(chunks)} chunks "
+                    f"(~{self.analysis_chunk_tokens} tokens each)")
+
+        def analyze_chunk(indexed):
+            index, chunk = indexed
+            text = CHUNK_PREAMBLE.format(index=index + 1, total=len(chunks)) + chunk
+            try:
+                result = self._cached_medical_analysis(text, fresh)
+            except json.JSONDecodeError:
+                logger.error(f"Failed to parse JSON for chunk {index + 1}/{len(chunks)}")
+                return None
+            return result if self.validate_response(result) else None
+
+        workers = max(1, min(len(chunks), config.ANALYSIS_CHUNK_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-chunk") as executor:
+            results = list(executor.map(propagate(analyze_chunk), enumerate(chunks)))
+
+        usable = [(r, estimate_tokens(c)) for r, c in zip(results, chunks) if r is not None]
+        if not usable:
+            return fallback_analysis("No se pudo analizar",
+                                     "La respuesta de la IA no contenía todos los campos requeridos.")
+        if len(usable) < len(chunks):
+            logger.warning(f"{len(chunks) - len(usable)} of {len(chunks)} chunks could not be analyzed")
+        return merge_analyses([r for r, _ in usable], weights=[w for _, w in usable])
+
+    def _request_medical_analysis(self, text_content: str,
+                                  on_section: Callable[[str, Any], None] = None,
+                                  hint: str = "") -> Dict[str, Any]:
+        logger.info(f"Sending text to Ollama ({self.logic_model}) for medical analysis...")
+        formatted_prompt = self.medical_prompt.format(text_content=text_content) + hint
+        messages = [{'role': 'user', 'content': formatted_prompt}]
+
+        # num_ctx comes from the pool's per-model options, shared with classification
+        if on_section is None:
+            response = self.pool.chat(
+                model=self.logic_model,
+                messages=messages,
+                format=self.analysis_format,
+                timeout=config.OLLAMA_ANALYSIS_TIMEOUT
+            )
+            return self._complete_analysis(response['message']['content'], text_content)
+
+        parser = IncrementalJSONParser(on_section, watch=self.STREAM_SECTIONS)
+        for chunk in self.pool.chat(model=self.logic_model, messages=messages,
+                                      format=self.analysis_format, stream=True,
+                                      timeout=config.OLLAMA_ANALYSIS_TIMEOUT):
+            parser.feed(chunk['message']['content'])
+        return self._complete_analysis(parser.text, text_content)
+
+    def _complete_analysis(self, content: str, text_content: str) -> Dict[str, Any]:
+        """
+        Parse the model's reply without throwing the generation away: repair
+        near-JSON (truncation, trailing commas, unquoted keys), then ask again
+        only for the top-level fields that are still missing.
+        """
+        try:
+            data = parse_json_content(content)
+            self._count_json("parsed")
+        except json.JSONDecodeError:
+            try:
+                data = repair_json(content)
+            except json.JSONDecodeError:
+                self._count_json("failed")
+                raise
+            self._count_json("repaired")
+            logger.info("Repaired malformed JSON from the analysis model")
+
+        missing = [f for f in SOAP_SCHEMA["properties"] if f not in data]
+        if missing:
+            self._count_json("reasked")
+            logger.info(f"Analysis is missing {missing}; asking the model for those fields only")
+            try:
+                data.update({f: v for f, v in self._request_missing_fields(text_content, missing).items()
+                             if f in missing})
+            except Exception as e:
+                logger.error(f"Re-asking for missing fields failed: {e}")
+        return data
+
+    def _request_missing_fields(self, text_content: str, fields: List[str]) -> Dict[str, Any]:
+        prompt = MISSING_FIELDS_PROMPT.format(
+            fields="\n        ".join(f'- "{f}": {SOAP_FIELD_DESCRIPTIONS.get(f, "")}' for f in fields),
+            text_content=text_content
+        )
+        response = self.pool.chat(
+            model=self.logic_model,
+            messages=[{'role': 'user', 'content': prompt}],
+            format=soap_schema_for(fields) if config.ANALYSIS_JSON_SCHEMA else 'json',
+            timeout=config.OLLAMA_ANALYSIS_TIMEOUT
+        )
+        content = response['message']['content']
+        try:
+            return parse_json_content(content)
+        except json.JSONDecodeError:
+            return repair_json(content)
+
+    def _count_json(self, outcome: str):
+        with self._json_lock:
+            self._json_outcomes[outcome] = self._json_outcomes.get(outcome, 0) + 1
+
+    def json_repair_stats(self) -> Dict[str, int]:
+        """How analysis replies were recovered: parsed / repaired / reasked / failed."""
+        with self._json_lock:
+            return dict({"parsed": 0, "repaired": 0, "reasked": 0, "failed": 0}, **self._json_outcomes)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "ocr": self.ocr_cache.stats(),
+            "llm": self.llm_cache.stats(),
+        }
+
+    def preprocessing_stats(self) -> Dict[str, Any]:
+        stats = self.preprocessor.stats()
+        stats["vision_payloads"] = self.vision_payloads.stats()
+        return stats
+
+    def normalize_document_type(self, doc_type: Any) -> str:
+        if isinstance(doc_type, str) and doc_type.strip().lower() in self.DOCUMENT_TYPES:
+            return doc_type.strip().lower()
+        return "consultation"
+
     def extract_prescriptions(self, analysis: Dict[str, Any]) -> List[Dict[str, Any]]:
         medications = []
         plan = analysis.get("plan", {})
@@ -280,20 +945,10 @@ class AIEngine:
                         "value": lab.get("value", ""),
                         "unit": lab.get("unit", ""),
                         "reference_range": lab.get("reference_range", ""),
-                        "is_abnormal": 1 if lab.get("is_abnormal", False) else 0
+                        # None (no range, and the model didn't judge it) is stored as unknown
+                        "is_abnormal": None if lab.get("is_abnormal") is None else int(bool(lab["is_abnormal"]))
                     })
         return results
 
     def validate_response(self, data: Dict[str, Any]) -> bool:
-        required_fields = [
-            "document_type",
-            "summary",
-            "confidence_score"
-        ]
-
-        for field in required_fields:
-            if field not in data:
-                logger.warning(f"Missing field in AI response: {field}")
-                return False
-
-        return True
+        return validate_analysis(data)
@@ -0,0 +1,84 @@
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(BaseException):
+    """
+    The job this thread works for was cancelled (consultation deleted, or a
+    newer regeneration superseded it). A BaseException, like
+    asyncio.CancelledError, so the `except Exception` fallbacks in the AI
+    engine don't turn it into an error analysis.
+    """
+
+
+class CancelToken:
+    """
+    Cooperative cancellation flag for one pipeline job. Long-running code
+    checks it between steps (raise_if_cancelled) and the Ollama pool checks it
+    between streamed chunks, dropping the connection so the server stops
+    generating. A child token is cancelled with its parent, or on its own.
+    """
+
+    def __init__(self, parent: "CancelToken" = None):
+        self.parent = parent
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(self.reason or (self.parent.reason if self.parent else None) or "cancelled")
+
+    def child(self) -> "CancelToken":
+        return CancelToken(parent=self)
+
+
+_local = threading.local()
+
+
+def current_token() -> Optional[CancelToken]:
+    """The token of the job running on this thread, if any."""
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancelToken]):
+    """Make `token` the current one for this thread (the scheduler wraps each stage in this)."""
+    previous = current_token()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def check_cancelled():
+    """Raise JobCancelled if the current job was cancelled; a no-op outside a job."""
+    token = current_token()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def propagate(fn: Callable) -> Callable:
+    """Wrap `fn` for a worker thread (ThreadPoolExecutor) so it runs under the caller's token."""
+    token = current_token()
+    if token is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with cancel_scope(token):
+            token.raise_if_cancelled()
+            return fn(*args, **kwargs)
+    return run
@@ -0,0 +1,213 @@
+import re
+import unicodedata
+import logging
+from collections import Counter
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.;:!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for Spanish/English prompts
+    return max(1, len(text or "") // 4)
+
+
+def _split_to_fit(piece: str, max_tokens: int) -> List[str]:
+    """Break a piece that is too long on its own: lines, then sentences, then hard cuts."""
+    if estimate_tokens(piece) <= max_tokens:
+        return [piece]
+    for pattern in ("\n", _SENTENCE_RE):
+        parts = piece.split(pattern) if isinstance(pattern, str) else pattern.split(piece)
+        if len(parts) > 1:
+            result = []
+            for part in parts:
+                result.extend(_split_to_fit(part, max_tokens))
+            return result
+    size = max_tokens * 4
+    return [piece[i:i + size] for i in range(0, len(piece), size)]
+
+
+def chunk_text(text: str, max_tokens: int, overlap_tokens: int = 0) -> List[str]:
+    """
+    Split `text` into chunks of at most ~`max_tokens`, cutting at paragraph
+    (and page-marker) boundaries where possible. Each chunk after the first
+    starts with up to `overlap_tokens` of the previous chunk's tail so
+    findings that straddle a boundary are seen whole by one of them.
+    """
+    text = (text or "").strip()
+    if estimate_tokens(text) <= max_tokens:
+        return [text] if text else []
+
+    pieces = []
+    for paragraph in _PARAGRAPH_RE.split(text):
+        if paragraph.strip():
+            pieces.extend(p for p in _split_to_fit(paragraph.strip(), max(1, max_tokens - overlap_tokens)) if p.strip())
+
+    chunks, current = [], []
+    for piece in pieces:
+        candidate = "\n\n".join(current + [piece])
+        if current and estimate_tokens(candidate) > max_tokens:
+            chunks.append("\n\n".join(current))
+            tail = chunks[-1][-overlap_tokens * 4:] if overlap_tokens else ""
+            current = [tail, piece] if tail else [piece]
+        else:
+            current.append(piece)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+# ─── Deterministic SOAP merge ────────────────────────────────
+
+def normalize_key(value: Any) -> str:
+    """Case-, accent- and punctuation-insensitive key used to spot duplicates."""
+    text = unicodedata.normalize("NFKD", str(value or "")).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == "" or value == [] or value == {} or \
+        (isinstance(value, str) and value.strip().lower() in ("null", "none", "no especificado"))
+
+
+def _first(values: List[Any]) -> Any:
+    return next((v for v in values if not _is_empty(v)), None)
+
+
+def _union(lists: List[Any]) -> List[Any]:
+    seen, result = set(), []
+    for items in lists:
+        for item in items if isinstance(items, list) else []:
+            key = normalize_key(item) if not isinstance(item, dict) else normalize_key(sorted(item.items()))
+            if key and key not in seen:
+                seen.add(key)
+                result.append(item)
+    return result
+
+
+def _join_text(values: List[Any]) -> str:
+    seen, parts = set(), []
+    for value in values:
+        if _is_empty(value) or not isinstance(value, str):
+            continue
+        key = normalize_key(value)
+        if key not in seen:
+            seen.add(key)
+            parts.append(value.strip())
+    return " ".join(parts)
+
+
+def _merge_records(records: List[Dict[str, Any]], key_fields: List[str]) -> List[Dict[str, Any]]:
+    """
+    Deduplicate dict records on the first non-empty key field, in order. Later
+    duplicates only fill fields the first occurrence left empty.
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        key = next((f"{f}:{normalize_key(record.get(f))}" for f in key_fields if not _is_empty(record.get(f))), None)
+        if key is None:
+            continue
+        if key not in merged:
+            merged[key] = dict(record)
+        else:
+            for field, value in record.items():
+                if _is_empty(merged[key].get(field)) and not _is_empty(value):
+                    merged[key][field] = value
+    return list(merged.values())
+
+
+def _merge_labs(lab_lists: List[Any]) -> List[Dict[str, Any]]:
+    """Lab values are duplicates only if both test name and value match (repeat draws are kept)."""
+    keyed = [dict(lab, _key=f"{normalize_key(lab.get('test_name'))}|{normalize_key(lab.get('value'))}")
+             for labs in lab_lists if isinstance(labs, list)
+             for lab in labs if isinstance(lab, dict) and not _is_empty(lab.get('test_name'))]
+    merged = _merge_records(keyed, ["_key"])
+    for lab in merged:
+        lab.pop("_key", None)
+    return merged
+
+
+def _section(analysis: Dict[str, Any], name: str) -> Dict[str, Any]:
+    value = analysis.get(name)
+    return value if isinstance(value, dict) else {}
+
+
+def merge_analyses(analyses: List[Dict[str, Any]], weights: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Merge per-chunk SOAP analyses (in document order) into one. The result only
+    depends on the inputs and their order:
+    scalars take the first non-empty value, lists are unioned without
+    duplicates, medications dedupe on drug name, diagnoses on CIE-10 code (or
+    description), lab values on test name + value; document_type is a
+    length-weighted vote and confidence_score a length-weighted mean.
+    """
+    weights = weights or [1] * len(analyses)
+
+    votes: Counter = Counter()
+    for analysis, weight in zip(analyses, weights):
+        if analysis.get("document_type"):
+            votes[analysis["document_type"]] += weight
+    # Counter.most_common keeps insertion order on ties, i.e. the earliest chunk wins
+    document_type = votes.most_common(1)[0][0] if votes else "consultation"
+
+    patient_fields = ("name", "age", "gender")
+    patient_info = {f: _first([_section(a, "patient_info").get(f) for a in analyses]) for f in patient_fields}
+    if patient_info["name"] is None:
+        patient_info["name"] = "No especificado"
+
+    subjective = [_section(a, "subjective") for a in analyses]
+    objective = [_section(a, "objective") for a in analyses]
+    assessment = [_section(a, "assessment") for a in analyses]
+    plan = [_section(a, "plan") for a in analyses]
+
+    vital_keys = []
+    for o in objective:
+        for k in (o.get("vitals") or {}) if isinstance(o.get("vitals"), dict) else {}:
+            if k not in vital_keys:
+                vital_keys.append(k)
+
+    diagnoses = _merge_records([d for a in assessment for d in (a.get("diagnoses") or [])],
+                               ["cie10_code", "description"])
+    diagnosis_keys = {normalize_key(d.get("description")) for d in diagnoses}
+    differentials = [d for d in _union([a.get("differential_diagnoses") for a in assessment])
+                     if normalize_key(d) not in diagnosis_keys]
+
+    total_weight = sum(w for a, w in zip(analyses, weights) if isinstance(a.get("confidence_score"), (int, float)))
+    confidence = sum(a["confidence_score"] * w for a, w in zip(analyses, weights)
+                     if isinstance(a.get("confidence_score"), (int, float)))
+
+    return {
+        "patient_info": patient_info,
+        "document_type": document_type,
+        "subjective": {
+            "chief_complaint": _first([s.get("chief_complaint") for s in subjective]) or "",
+            "symptoms": _union([s.get("symptoms") for s in subjective]),
+            "history": _join_text([s.get("history") for s in subjective]),
+        },
+        "objective": {
+            "vitals": {k: _first([(o.get("vitals") or {}).get(k) for o in objective
+                                  if isinstance(o.get("vitals"), dict)]) for k in vital_keys},
+            "findings": _union([o.get("findings") for o in objective]),
+        },
+        "assessment": {
+            "diagnoses": diagnoses,
+            "differential_diagnoses": differentials,
+        },
+        "plan": {
+            "medications": _merge_records([m for p in plan for m in (p.get("medications") or [])],
+                                          ["drug_name"]),
+            "studies": _union([p.get("studies") for p in plan]),
+            "referrals": _union([p.get("referrals") for p in plan]),
+            "follow_up": _join_text([p.get("follow_up") for p in plan]),
+            "recommendations": _union([p.get("recommendations") for p in plan]),
+        },
+        "lab_values": _merge_labs([a.get("lab_values") for a in analyses]),
+        "summary": _join_text([a.get("summary") for a in analyses]),
+        "confidence_score": int(round(confidence / total_weight)) if total_weight else 0,
+        "chunks": len(analyses),
+    }
@@ -0,0 +1,232 @@
+import re
+import json
+import logging
+from typing import Dict, Any, List, Optional
+
+from backend.chunked_analysis import normalize_key
+
+logger = logging.getLogger(__name__)
+
+_NUM = r"\d+(?:[.,]\d+)?"
+
+# ─── Vitals ──────────────────────────────────────────────────
+# Spanish clinical shorthand first (TA, FC, SatO2, ...), English second.
+
+_VITAL_PATTERNS = {
+    "blood_pressure": (
+        re.compile(r"\b(?:T\.?\s?A\.?|P\.?\s?A\.?|presi[oó]n\s+arterial|BP)\s*[:=]?\s*"
+                   r"(\d{2,3})\s*/\s*(\d{2,3})(?:\s*mm\s?Hg)?", re.IGNORECASE),
+        lambda m: f"{m.group(1)}/{m.group(2)} mmHg",
+    ),
+    "heart_rate": (
+        re.compile(r"\b(?:F\.?\s?C\.?|frecuencia\s+card[ií]aca|pulso|HR)\s*[:=]?\s*(\d{2,3})"
+                   r"(?:\s*(?:lpm|x'|x\s?min|/min|bpm))?", re.IGNORECASE),
+        lambda m: f"{m.group(1)} lpm",
+    ),
+    "temperature": (
+        re.compile(r"(?:\bTemp(?:eratura)?\.?|\bT°|\bT\s*:)\s*[:=]?\s*(3[4-9](?:[.,]\d)?|4[0-3](?:[.,]\d)?)"
+                   r"\s*(?:°\s?C|ºC|C\b)?", re.IGNORECASE),
+        lambda m: f"{m.group(1).replace(',', '.')} °C",
+    ),
+    "spo2": (
+        re.compile(r"\b(?:SpO2|SatO2|Sat\.?\s*O2|Saturaci[oó]n(?:\s+de\s+ox[ií]geno|\s+de\s+O2)?)\s*[:=]?\s*"
+                   r"(\d{2,3})\s*%", re.IGNORECASE),
+        lambda m: f"{m.group(1)}%",
+    ),
+    "weight": (
+        re.compile(r"\bPeso\s*[:=]?\s*(" + _NUM + r")\s*(kg|kgs|g)\b", re.IGNORECASE),
+        lambda m: f"{m.group(1).replace(',', '.')} {m.group(2).lower().rstrip('s')}",
+    ),
+    "height": (
+        re.compile(r"\b(?:Talla|Estatura|Altura)\s*[:=]?\s*(" + _NUM + r")\s*(cm|m)\b", re.IGNORECASE),
+        lambda m: f"{m.group(1).replace(',', '.')} {m.group(2).lower()}",
+    ),
+}
+
+# ─── Lab values ──────────────────────────────────────────────
+# One result per line: "<test> [:] <value> [unit] [(ref low - high)]"
+
+_LAB_LINE = re.compile(
+    r"^\s*(?P<name>[A-Za-zÁÉÍÓÚÜÑáéíóúüñ][A-Za-zÁÉÍÓÚÜÑáéíóúüñ0-9 .()/-]{0,40}?)\s*[:=]?\s+"
+    r"(?P<value>[<>]?\s?" + _NUM + r")\s*"
+    r"(?P<unit>(?:[a-zA-Zµμ%][a-zA-Zµμ%/^0-9³.]*(?:/[a-zA-Zµμ0-9³]+)?)?)\s*"
+    r"(?:[(\[]?\s*(?:VR|V\.R\.|Ref\.?|Rango|Referencia)?\s*:?\s*"
+    r"(?P<ref>" + _NUM + r"\s*[-–]\s*" + _NUM + r"|[<>]\s?" + _NUM + r")\s*[)\]]?)?\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Test names recognised even without a reference range; anything else needs one
+_KNOWN_LABS = {normalize_key(name) for name in (
+    "hemoglobina", "hb", "hematocrito", "hto", "leucocitos", "eritrocitos", "plaquetas",
+    "neutrofilos", "linfocitos", "monocitos", "eosinofilos", "basofilos", "vcm", "hcm", "chcm",
+    "glucosa", "glucemia", "hba1c", "hemoglobina glucosilada", "urea", "bun", "creatinina",
+    "acido urico", "colesterol", "colesterol total", "hdl", "ldl", "trigliceridos",
+    "sodio", "na", "potasio", "k", "cloro", "cl", "calcio", "magnesio", "fosforo",
+    "tsh", "t4", "t4 libre", "t3", "alt", "ast", "tgo", "tgp", "fosfatasa alcalina", "ggt",
+    "bilirrubina total", "bilirrubina directa", "bilirrubina indirecta", "albumina",
+    "proteinas totales", "pcr", "vsg", "inr", "tp", "ttp", "ferritina", "vitamina d", "psa",
+)}
+
+# ─── Dosages ─────────────────────────────────────────────────
+
+_DOSE = re.compile(r"(?P<dose>" + _NUM + r"\s*(?:mg|g|mcg|µg|ml|mL|UI|U|gotas|tabletas?|tabs?|c[aá]psulas?)\b)",
+                   re.IGNORECASE)
+_FREQUENCY = re.compile(
+    r"(?P<frequency>cada\s+\d+\s*(?:h|hr|hrs|horas?)\b|c/\s?\d+\s*(?:h|hr|hrs|horas?)\b|"
+    r"\d+\s+veces?\s+al\s+d[ií]a|una\s+vez\s+al\s+d[ií]a|(?:cada|c/)\s*(?:24|12|8|6|4)\s*h)",
+    re.IGNORECASE
+)
+_DURATION = re.compile(r"(?P<duration>(?:por|durante|x)\s+\d+\s*(?:d[ií]as?|semanas?|meses?))", re.IGNORECASE)
+_DRUG = re.compile(r"(?P<drug>[A-Za-zÁÉÍÓÚÑáéíóúñ][A-Za-zÁÉÍÓÚÑáéíóúñ\-]{3,}(?:\s+[A-Za-zÁÉÍÓÚÑáéíóúñ\-]{3,})?)\s*"
+                   + r"(?=" + _NUM + r"\s*(?:mg|g|mcg|µg|ml|mL|UI)\b)", re.IGNORECASE)
+
+
+def _to_float(value: str) -> Optional[float]:
+    try:
+        return float(value.replace(",", ".").lstrip("<> "))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _is_abnormal(value: str, reference: str) -> Optional[bool]:
+    if not reference:
+        return None
+    number = _to_float(value)
+    if number is None:
+        return None
+    reference = reference.strip()
+    if reference[0] in "<>":
+        limit = _to_float(reference[1:])
+        if limit is None:
+            return None
+        return number >= limit if reference[0] == "<" else number <= limit
+    low, high = (_to_float(p) for p in re.split(r"[-–]", reference, maxsplit=1))
+    if low is None or high is None:
+        return None
+    return not (low <= number <= high)
+
+
+def extract_vitals(text: str) -> Dict[str, str]:
+    vitals = {}
+    for name, (pattern, render) in _VITAL_PATTERNS.items():
+        match = pattern.search(text)
+        if match:
+            vitals[name] = render(match)
+    return vitals
+
+
+def extract_lab_values(text: str) -> List[Dict[str, Any]]:
+    labs, seen = [], set()
+    for match in _LAB_LINE.finditer(text):
+        name = match.group("name").strip(" .:-")
+        reference = (match.group("ref") or "").strip()
+        key = normalize_key(name)
+        if not key or (key not in _KNOWN_LABS and not reference):
+            continue
+        value = match.group("value").replace(" ", "")
+        if (key, value) in seen:
+            continue
+        seen.add((key, value))
+        labs.append({
+            "test_name": name,
+            "value": value,
+            "unit": match.group("unit") or "",
+            "reference_range": reference,
+            # None without a usable range: unknown, not normal
+            "is_abnormal": _is_abnormal(value, reference),
+        })
+    return labs
+
+
+def extract_medications(text: str) -> List[Dict[str, str]]:
+    """Drug + dose (+ frequency / duration) per line; only lines with an explicit dose are used."""
+    medications = []
+    for line in text.splitlines():
+        drug = _DRUG.search(line)
+        dose = _DOSE.search(line)
+        if not drug or not dose or normalize_key(drug.group("drug")) in _KNOWN_LABS:
+            continue
+        frequency = _FREQUENCY.search(line)
+        duration = _DURATION.search(line)
+        medications.append({
+            "drug_name": drug.group("drug").strip(),
+            "dose": dose.group("dose").strip(),
+            "frequency": frequency.group("frequency").strip() if frequency else "",
+            "duration": duration.group("duration").strip() if duration else "",
+        })
+    return medications
+
+
+def extract_clinical_values(text: str) -> Dict[str, Any]:
+    """Everything the rule-based pass can read verbatim from `text`."""
+    return {
+        "vitals": extract_vitals(text or ""),
+        "lab_values": extract_lab_values(text or ""),
+        "medications": extract_medications(text or ""),
+    }
+
+
+def prefill_hint(extracted: Dict[str, Any]) -> str:
+    """
+    Prompt addendum listing what was already extracted, so the model only
+    generates values that are missing instead of re-emitting them.
+    """
+    if not extracted:
+        return ""
+    # Labs read without a reference range are left out: the model still reports
+    # them so it can judge is_abnormal, which merge_extracted keeps
+    judged = [lab for lab in extracted.get("lab_values") or [] if lab.get("is_abnormal") is not None]
+    if not (extracted.get("vitals") or judged):
+        return ""
+    parts = ["\n        Valores ya extraídos automáticamente del texto (se agregarán al resultado):"]
+    if extracted.get("vitals"):
+        parts.append(f"        - objective.vitals: {json.dumps(extracted['vitals'], ensure_ascii=False)}")
+    if judged:
+        names = ", ".join(lab["test_name"] for lab in judged)
+        parts.append(f"        - lab_values: {names}")
+    parts.append("        No repitas estos valores; en objective.vitals y lab_values incluye únicamente "
+                 "los que falten. Todo lo demás genéralo normalmente.")
+    return "\n".join(parts)
+
+
+def merge_extracted(analysis: Dict[str, Any], extracted: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fold the rule-based values back into the model's analysis. Extracted vitals
+    and labs are verbatim from the text, so they win over the model's (except
+    the abnormal flag of a lab printed without a reference range, which only
+    the model can judge); the model's extra labs are kept, and its medications
+    only get empty dose, frequency or duration fields filled in.
+    """
+    if not extracted:
+        return analysis
+
+    if extracted.get("vitals"):
+        objective = analysis.get("objective") if isinstance(analysis.get("objective"), dict) else {}
+        vitals = objective.get("vitals") if isinstance(objective.get("vitals"), dict) else {}
+        vitals.update(extracted["vitals"])
+        objective["vitals"] = vitals
+        analysis["objective"] = objective
+
+    if extracted.get("lab_values"):
+        known = {normalize_key(lab["test_name"]) for lab in extracted["lab_values"]}
+        model_labs = [lab for lab in (analysis.get("lab_values") or []) if isinstance(lab, dict)]
+        model_flags = {normalize_key(lab.get("test_name")): lab["is_abnormal"] for lab in model_labs
+                       if isinstance(lab.get("is_abnormal"), bool)}
+        labs = [dict(lab, is_abnormal=model_flags.get(normalize_key(lab["test_name"])))
+                if lab.get("is_abnormal") is None else lab
+                for lab in extracted["lab_values"]]
+        analysis["lab_values"] = labs + [lab for lab in model_labs
+                                         if normalize_key(lab.get("test_name")) not in known]
+
+    plan = analysis.get("plan") if isinstance(analysis.get("plan"), dict) else {}
+    by_drug = {normalize_key(m["drug_name"]): m for m in extracted.get("medications") or []}
+    for medication in plan.get("medications") or []:
+        if not isinstance(medication, dict):
+            continue
+        found = by_drug.get(normalize_key(medication.get("drug_name")))
+        if found is None:
+            continue
+        for field in ("dose", "frequency", "duration"):
+            if not medication.get(field) and found.get(field):
+                medication[field] = found[field]
+    return analysis
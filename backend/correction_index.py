@@ -0,0 +1,152 @@
+import math
+import re
+import threading
+import logging
+from collections import Counter
+from typing import Dict, Any, List
+
+from backend.chunked_analysis import estimate_tokens
+from backend.image_preprocessing import dhash, hamming_distance
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def text_features(text: str) -> Counter:
+    """Bag of lowercase words plus character trigrams (robust to OCR misspellings)."""
+    words = _WORD_RE.findall((text or "").lower())
+    features = Counter(f"w:{w}" for w in words if len(w) > 1)
+    for w in words:
+        padded = f" {w} "
+        features.update(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    return features
+
+
+class CorrectionIndex:
+    """
+    In-memory retrieval index over the `corrections` table, used to pick the
+    few-shot examples for the vision prompt.
+
+    Each correction is indexed by TF-IDF-weighted word and character-trigram
+    features of its corrected text, plus a perceptual hash (dHash) of its image
+    when the file still exists. select() scores corrections against the
+    EasyOCR text of the page being transcribed (and its image) and returns the
+    best matches that fit `token_budget`, instead of the latest N regardless of
+    relevance. The index loads lazily from `store` and is updated
+    incrementally through DBManager's correction listener.
+    """
+
+    def __init__(self, store, max_examples: int = 3, token_budget: int = 800,
+                 min_score: float = 0.1, image_weight: float = 0.3):
+        self.store = store
+        self.max_examples = max_examples
+        self.token_budget = token_budget
+        self.min_score = min_score
+        self.image_weight = image_weight
+
+        self._docs: Dict[int, Dict[str, Any]] = {}
+        self._postings: Dict[str, Dict[int, float]] = {}
+        self._df: Counter = Counter()
+        self._lock = threading.Lock()
+        self._loaded = False
+        store.add_correction_listener(self.add)
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        corrections = self.store.get_all_corrections()
+        for correction in corrections:
+            self.add(correction)
+        logger.info(f"Correction index loaded with {len(corrections)} examples")
+
+    def add(self, correction: Dict[str, Any]):
+        """Index one correction row (id, image_path, corrected_text)."""
+        text = correction.get('corrected_text') or ""
+        features = text_features(text)
+        image_hash = dhash(correction['image_path']) if correction.get('image_path') else None
+        with self._lock:
+            doc_id = correction['id']
+            if doc_id in self._docs:
+                self._remove(doc_id)
+            for term in features:
+                self._df[term] += 1
+            self._docs[doc_id] = {
+                "correction": {"image_path": correction.get('image_path'), "corrected_text": text},
+                "features": features,
+                "image_hash": image_hash,
+                "tokens": estimate_tokens(text),
+            }
+            for term, count in features.items():
+                self._postings.setdefault(term, {})[doc_id] = 1 + math.log(count)
+
+    def _remove(self, doc_id: int):
+        for term in self._docs.pop(doc_id)["features"]:
+            self._df[term] -= 1
+            postings = self._postings.get(term)
+            if postings:
+                postings.pop(doc_id, None)
+
+    def _idf(self, term: str) -> float:
+        return math.log((1 + len(self._docs)) / (1 + self._df.get(term, 0))) + 1
+
+    def select(self, query_text: str = "", image_path: str = None) -> List[Dict[str, Any]]:
+        """Most relevant corrections for this page, best first, within the token budget."""
+        self._ensure_loaded()
+        query = text_features(query_text)
+        query_hash = dhash(image_path) if image_path and self.image_weight > 0 else None
+
+        with self._lock:
+            if not self._docs:
+                return []
+
+            text_scores: Counter = Counter()
+            if query:
+                query_weights = {t: (1 + math.log(c)) * self._idf(t) for t, c in query.items()}
+                query_norm = math.sqrt(sum(w * w for w in query_weights.values()))
+                for term, q_weight in query_weights.items():
+                    idf = self._idf(term)
+                    for doc_id, tf in self._postings.get(term, {}).items():
+                        text_scores[doc_id] += q_weight * tf * idf
+                for doc_id in text_scores:
+                    doc_norm = math.sqrt(sum(((1 + math.log(c)) * self._idf(t)) ** 2
+                                             for t, c in self._docs[doc_id]["features"].items()))
+                    text_scores[doc_id] /= (query_norm * doc_norm) or 1
+
+            scored = []
+            for doc_id, doc in self._docs.items():
+                score = text_scores.get(doc_id, 0.0)
+                if query_hash is not None and doc["image_hash"] is not None:
+                    # Unrelated images differ in ~32 of 64 bits; score that as 0
+                    image_score = max(0.0, 1 - hamming_distance(query_hash, doc["image_hash"]) / 32)
+                    score = (1 - self.image_weight) * score + self.image_weight * image_score if query \
+                        else image_score
+                if score >= self.min_score:
+                    scored.append((score, doc_id))
+            scored.sort(reverse=True)
+
+            selected, used = [], 0
+            for score, doc_id in scored:
+                doc = self._docs[doc_id]
+                if used + doc["tokens"] > self.token_budget:
+                    continue
+                selected.append(dict(doc["correction"], score=round(score, 3)))
+                used += doc["tokens"]
+                if len(selected) >= self.max_examples:
+                    break
+
+        if selected:
+            logger.info(f"Selected {len(selected)} few-shot examples (~{used} tokens, "
+                        f"scores {[e['score'] for e in selected]})")
+        return selected
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "examples": len(self._docs),
+                "terms": len(self._postings),
+                "token_budget": self.token_budget,
+                "max_examples": self.max_examples,
+            }
@@ -0,0 +1,120 @@
+import threading
+import time
+import logging
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class EngineRegistry:
+    """
+    Process-wide holder for the warm AIEngine.
+
+    Building an AIEngine loads the EasyOCR detector/recognizer weights and opens
+    the Ollama clients, so it must happen once per process and never on the
+    request path. The server pipeline and the desktop GUI both ask the registry
+    for the shared instance instead of constructing their own.
+    """
+
+    COLD = "cold"
+    LOADING = "loading"
+    READY = "ready"
+    ERROR = "error"
+
+    def __init__(self):
+        self._engine = None
+        self._state = self.COLD
+        self._error: Optional[str] = None
+        self._load_seconds: Optional[float] = None
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def warm_up(self) -> threading.Thread:
+        """Start loading the engine in a background thread (no-op if already loading/loaded)."""
+        thread = threading.Thread(target=self._load, name="ai-engine-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def get_engine(self, timeout: Optional[float] = None):
+        """
+        Return the shared AIEngine, loading it on the calling thread if nobody
+        has started the warm-up yet. If another thread is already loading it,
+        wait up to `timeout` seconds (None = wait forever).
+        """
+        if self._state == self.READY:
+            return self._engine
+
+        if not self._load():
+            if not self._ready.wait(timeout):
+                raise TimeoutError("AI Engine is still loading")
+
+        if self._engine is None:
+            raise RuntimeError(f"AI Engine failed to load: {self._error}")
+        return self._engine
+
+    def is_ready(self) -> bool:
+        return self._state == self.READY
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self._state,
+            "error": self._error,
+            "load_seconds": round(self._load_seconds, 2) if self._load_seconds is not None else None,
+            "loaded_at": self._loaded_at,
+        }
+
+    def reset(self):
+        """Drop the cached engine so the next get_engine() rebuilds it (e.g. after a config change)."""
+        with self._lock:
+            self._engine = None
+            self._state = self.COLD
+            self._error = None
+            self._load_seconds = None
+            self._loaded_at = None
+            self._ready.clear()
+
+    def _load(self) -> bool:
+        """
+        Load the engine if it's cold or previously failed.
+        Returns False if another thread is currently doing the load.
+        """
+        with self._lock:
+            if self._state == self.READY:
+                return True
+            if self._state == self.LOADING:
+                return False
+            self._state = self.LOADING
+            self._error = None
+            self._ready.clear()
+
+        start = time.perf_counter()
+        try:
+            logger.info("Loading shared AI Engine...")
+            from backend.ai_manager import AIEngine
+            engine = AIEngine()
+        except Exception as e:
+            logger.error(f"Error loading shared AI Engine: {e}")
+            with self._lock:
+                self._state = self.ERROR
+                self._error = str(e)
+            self._ready.set()
+            return True
+
+        with self._lock:
+            self._engine = engine
+            self._load_seconds = time.perf_counter() - start
+            self._loaded_at = time.time()
+            self._state = self.READY
+        self._ready.set()
+        logger.info(f"Shared AI Engine ready in {self._load_seconds:.2f}s")
+        return True
+
+
+# Global instance
+engine_registry = EngineRegistry()
+
+
+def get_ai_engine(timeout: Optional[float] = None):
+    """Shortcut for engine_registry.get_engine()."""
+    return engine_registry.get_engine(timeout=timeout)
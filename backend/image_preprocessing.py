@@ -0,0 +1,386 @@
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+from backend.lazy_import import lazy_import
+
+# Imported on first use; annotations below are strings so defining them doesn't load numpy
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+logger = logging.getLogger(__name__)
+
+
+class PreprocessProfile:
+    """How an image should be prepared for one consumer (EasyOCR or the vision model)."""
+
+    def __init__(self, name: str, max_long_edge: int, grayscale: bool = False,
+                 normalize_contrast: bool = False):
+        self.name = name
+        # 0 disables resizing
+        self.max_long_edge = max_long_edge
+        self.grayscale = grayscale
+        self.normalize_contrast = normalize_contrast
+
+    def signature(self) -> str:
+        """Stable description of the settings, used in cache keys."""
+        return (f"{self.name}:{self.max_long_edge}:"
+                f"{'g' if self.grayscale else 'c'}{'n' if self.normalize_contrast else ''}")
+
+    def __repr__(self):
+        return f"PreprocessProfile({self.signature()})"
+
+
+class PreprocessedImage:
+    """Result of preprocessing: the pixels plus what was done to them and how long it took."""
+
+    def __init__(self, image: "np.ndarray", profile: PreprocessProfile,
+                 original_size: Tuple[int, int], timings: Dict[str, float]):
+        self.image = image
+        self.profile = profile
+        self.original_size = original_size  # (width, height) after EXIF rotation
+        self.timings = timings              # step -> milliseconds
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.image.shape[1], self.image.shape[0]
+
+    @property
+    def scale(self) -> float:
+        """Factor from original to processed coordinates."""
+        return self.size[0] / self.original_size[0] if self.original_size[0] else 1.0
+
+    def encode(self, ext: str = ".png", region: Tuple[int, int, int, int] = None,
+               quality: int = None) -> bytes:
+        """
+        Encode the image, or only `region` (x0, y0, x1, y1 in processed coordinates).
+        `quality` (1-100) applies to .jpg and .webp.
+        """
+        image = self.image
+        if region is not None:
+            x0, y0, x1, y1 = region
+            image = image[y0:y1, x0:x1]
+        params = []
+        if quality is not None:
+            if ext in (".jpg", ".jpeg"):
+                params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+            elif ext == ".webp":
+                params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+        ok, buffer = cv2.imencode(ext, image, params)
+        if not ok:
+            raise ValueError(f"Could not encode preprocessed image as {ext}")
+        return buffer.tobytes()
+
+
+def dhash(image_path: str, hash_size: int = 8) -> Optional[int]:
+    """
+    Difference hash: a 64-bit perceptual fingerprint that survives re-encoding,
+    resizing and small lighting changes. None if the file can't be read.
+    """
+    try:
+        with Image.open(image_path) as img:
+            img.draft("L", (hash_size * 8, hash_size * 8))
+            img = ImageOps.exif_transpose(img).convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+            pixels = list(img.getdata())
+    except Exception as e:
+        logger.warning(f"Could not hash image {image_path}: {e}")
+        return None
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def box_to_rect(points) -> Tuple[int, int, int, int]:
+    """EasyOCR quadrilateral -> axis-aligned (x0, y0, x1, y1)."""
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return int(min(xs)), int(min(ys)), int(round(max(xs))), int(round(max(ys)))
+
+
+def merge_regions(rects: List[Tuple[int, int, int, int]], size: Tuple[int, int],
+                  padding_ratio: float = 0.25) -> List[Tuple[int, int, int, int]]:
+    """
+    Pad each rectangle by a fraction of its height (at least 4 px), clamp it to
+    the image `size` (width, height) and merge rectangles that overlap, so
+    neighbouring illegible words become one crop.
+    """
+    width, height = size
+    padded = []
+    for x0, y0, x1, y1 in rects:
+        pad = max(4, int((y1 - y0) * padding_ratio))
+        padded.append([max(0, x0 - pad), max(0, y0 - pad), min(width, x1 + pad), min(height, y1 + pad)])
+
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for rect in padded:
+            for other in result:
+                if rect[0] < other[2] and other[0] < rect[2] and rect[1] < other[3] and other[1] < rect[3]:
+                    other[0], other[1] = min(other[0], rect[0]), min(other[1], rect[1])
+                    other[2], other[3] = max(other[2], rect[2]), max(other[3], rect[3])
+                    merged = True
+                    break
+            else:
+                result.append(rect)
+        padded = result
+    return [tuple(r) for r in padded]
+
+
+def reading_order(segments: List[Tuple[Tuple[int, int, int, int], str]]) -> str:
+    """
+    Join (rect, text) segments top-to-bottom, left-to-right. A segment belongs
+    to the current line when its vertical centre falls within the line's span.
+    """
+    lines: List[List[Tuple[Tuple[int, int, int, int], str]]] = []
+    for rect, text in sorted(segments, key=lambda s: (s[0][1] + s[0][3]) / 2):
+        center = (rect[1] + rect[3]) / 2
+        if lines:
+            top = min(r[1] for r, _ in lines[-1])
+            bottom = max(r[3] for r, _ in lines[-1])
+            if top <= center <= bottom:
+                lines[-1].append((rect, text))
+                continue
+        lines.append([(rect, text)])
+    return "\n".join(
+        " ".join(t for _, t in sorted(line, key=lambda s: s[0][0]) if t)
+        for line in lines
+    ).strip()
+
+
+class ImagePreprocessor:
+    """
+    Loads photos once and prepares them per profile before OCR or vision.
+
+    OCR and vision time grow with pixel count, and phone photos arrive at
+    12-48 MP, so every image is bounded on its long edge before it reaches a
+    model. Loading goes through Pillow so EXIF orientation is applied (the
+    vision model otherwise sees sideways photos) and JPEGs are decoded at a
+    reduced size when the target allows it. The OCR profile additionally
+    converts to grayscale and equalizes contrast (CLAHE), which helps EasyOCR
+    on unevenly lit paper; the vision profile keeps colour.
+
+    Per-step timings are kept for every call and aggregated in stats().
+    """
+
+    def __init__(self, profiles: Dict[str, PreprocessProfile]):
+        self.profiles = profiles
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict[str, float]] = {}
+
+    def process(self, image_path: str, profile_name: str) -> Optional[PreprocessedImage]:
+        """Returns the prepared image, or None if the file can't be decoded."""
+        profile = self.profiles[profile_name]
+        timings: Dict[str, float] = {}
+
+        start = time.perf_counter()
+        try:
+            pil_image = Image.open(image_path)
+            if profile.max_long_edge and pil_image.format == "JPEG":
+                # Let libjpeg decode at 1/2, 1/4 or 1/8 scale; never below the target size
+                target = max(1, int(profile.max_long_edge))
+                w, h = pil_image.size
+                ratio = target / max(w, h)
+                if ratio < 1:
+                    pil_image.draft("RGB", (max(1, int(w * ratio)), max(1, int(h * ratio))))
+            pil_image.load()
+        except Exception as e:
+            logger.error(f"Failed to load image {image_path}: {e}")
+            return None
+        timings["load"] = self._elapsed(start)
+
+        start = time.perf_counter()
+        pil_image = ImageOps.exif_transpose(pil_image)
+        image = cv2.cvtColor(np.asarray(pil_image.convert("RGB")), cv2.COLOR_RGB2BGR)
+        timings["exif"] = self._elapsed(start)
+
+        # Reported in full-resolution coordinates even if the JPEG was draft-decoded
+        exif_size = self._oriented_size(image_path) or (image.shape[1], image.shape[0])
+
+        start = time.perf_counter()
+        image = self._resize(image, profile.max_long_edge)
+        timings["resize"] = self._elapsed(start)
+
+        if profile.grayscale:
+            start = time.perf_counter()
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            timings["grayscale"] = self._elapsed(start)
+
+        if profile.normalize_contrast:
+            start = time.perf_counter()
+            image = self._normalize_contrast(image)
+            timings["contrast"] = self._elapsed(start)
+
+        self._record(profile.name, timings)
+        result = PreprocessedImage(image, profile, exif_size, timings)
+        logger.info(f"Preprocessed {image_path} for {profile.name}: {exif_size[0]}x{exif_size[1]} -> "
+                    f"{result.size[0]}x{result.size[1]} in {sum(timings.values()):.0f} ms {timings}")
+        return result
+
+    @staticmethod
+    def _elapsed(start: float) -> float:
+        return round((time.perf_counter() - start) * 1000, 2)
+
+    @staticmethod
+    def _oriented_size(image_path: str) -> Optional[Tuple[int, int]]:
+        try:
+            with Image.open(image_path) as img:
+                w, h = img.size
+                # EXIF orientations 5-8 swap width and height
+                if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                    return h, w
+                return w, h
+        except Exception:
+            return None
+
+    @staticmethod
+    def _resize(image: "np.ndarray", max_long_edge: int) -> "np.ndarray":
+        h, w = image.shape[:2]
+        long_edge = max(h, w)
+        if not max_long_edge or long_edge <= max_long_edge:
+            return image
+        ratio = max_long_edge / long_edge
+        return cv2.resize(image, (max(1, round(w * ratio)), max(1, round(h * ratio))),
+                          interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _normalize_contrast(image: "np.ndarray") -> "np.ndarray":
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        if image.ndim == 2:
+            return clahe.apply(image)
+        # Equalize lightness only so colours aren't shifted
+        lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+        lab[:, :, 0] = clahe.apply(lab[:, :, 0])
+        return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+
+    def _record(self, profile_name: str, timings: Dict[str, float]):
+        with self._lock:
+            totals = self._totals.setdefault(profile_name, {"count": 0})
+            totals["count"] += 1
+            for step, ms in timings.items():
+                totals[f"{step}_ms"] = totals.get(f"{step}_ms", 0.0) + ms
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for name, totals in self._totals.items():
+                count = totals["count"]
+                result[name] = {
+                    "images": count,
+                    "avg_ms": {key[:-3]: round(value / count, 2)
+                               for key, value in totals.items() if key.endswith("_ms")},
+                    "profile": self.profiles[name].signature(),
+                }
+            return result
+
+
+class VisionPayloadBuilder:
+    """
+    Builds the compact image bytes sent to the vision model.
+
+    Ollama would otherwise read and base64-encode the original multi-megabyte
+    capture on every call (regenerations included). Here the image goes
+    through the vision profile, is snapped to a multiple of the model's patch
+    size (so the model doesn't resample it again) and re-encoded as JPEG or
+    WebP. Encoded payloads are kept in a byte-bounded LRU keyed by image hash
+    and settings, and stats() reports how many bytes were saved against the
+    original files.
+    """
+
+    def __init__(self, preprocessor: ImagePreprocessor, profile_name: str = "vision",
+                 fmt: str = "jpeg", quality: int = 85, patch_size: int = 28,
+                 max_cache_bytes: int = 32 * 1024 * 1024):
+        self.preprocessor = preprocessor
+        self.profile_name = profile_name
+        self.ext = ".webp" if fmt.lower() == "webp" else ".jpg"
+        self.quality = quality
+        self.patch_size = patch_size
+        self.max_cache_bytes = max_cache_bytes
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.hits = 0
+        self.original_bytes = 0
+        self.payload_bytes = 0
+
+    def signature(self) -> str:
+        profile = self.preprocessor.profiles[self.profile_name]
+        return f"{profile.signature()}:{self.ext[1:]}{self.quality}:p{self.patch_size}"
+
+    def build(self, image_path: str, image_hash: str = None) -> Optional[bytes]:
+        """Encoded payload for `image_path`, or None if the image can't be loaded."""
+        key = f"{image_hash or os.path.abspath(image_path)}:{self.signature()}"
+        with self._lock:
+            payload = self._cache.get(key)
+            if payload is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return payload
+
+        prepared = self.preprocessor.process(image_path, self.profile_name)
+        if prepared is None:
+            return None
+        prepared.image = self._snap_to_patches(prepared.image)
+
+        start = time.perf_counter()
+        payload = prepared.encode(self.ext, quality=self.quality)
+        encode_ms = (time.perf_counter() - start) * 1000
+        try:
+            original = os.path.getsize(image_path)
+        except OSError:
+            original = 0
+
+        with self._lock:
+            self.builds += 1
+            self.original_bytes += original
+            self.payload_bytes += len(payload)
+            if len(payload) <= self.max_cache_bytes:
+                self._cache[key] = payload
+                self._cache_bytes += len(payload)
+                while self._cache_bytes > self.max_cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+
+        logger.info(f"Vision payload for {image_path}: {original / 1024:.0f} KB -> {len(payload) / 1024:.0f} KB "
+                    f"({prepared.size[0]}x{prepared.size[1]} {self.ext[1:]}, encoded in {encode_ms:.0f} ms)")
+        return payload
+
+    def _snap_to_patches(self, image: "np.ndarray") -> "np.ndarray":
+        if not self.patch_size or self.patch_size <= 1:
+            return image
+        h, w = image.shape[:2]
+        snapped_w = max(self.patch_size, round(w / self.patch_size) * self.patch_size)
+        snapped_h = max(self.patch_size, round(h / self.patch_size) * self.patch_size)
+        if (snapped_w, snapped_h) == (w, h):
+            return image
+        return cv2.resize(image, (snapped_w, snapped_h), interpolation=cv2.INTER_AREA)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            saved = self.original_bytes - self.payload_bytes
+            return {
+                "format": self.ext[1:],
+                "quality": self.quality,
+                "builds": self.builds,
+                "cache_hits": self.hits,
+                "cached_payloads": len(self._cache),
+                "cache_bytes": self._cache_bytes,
+                "original_bytes": self.original_bytes,
+                "payload_bytes": self.payload_bytes,
+                "bytes_saved": saved,
+                "savings_ratio": round(saved / self.original_bytes, 3) if self.original_bytes else 0.0,
+            }
@@ -0,0 +1,629 @@
+import heapq
+import itertools
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+from typing import Callable, Dict, Any, List, Optional
+
+from backend.cancellation import CancelToken, JobCancelled, cancel_scope
+from backend.pipeline_metrics import percentile
+from backend.prometheus_metrics import PIPELINE_QUEUE_WAIT, PIPELINE_JOB_DURATION
+
+logger = logging.getLogger(__name__)
+
+# Most urgent first; the index is the class's aging offset multiplier
+PRIORITIES = ("urgent", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+
+def normalize_priority(value: Optional[str]) -> str:
+    """Validate a priority name ("URGENT " -> "urgent"); None means the default."""
+    priority = (value or DEFAULT_PRIORITY).strip().lower()
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{value}' (expected one of {', '.join(PRIORITIES)})")
+    return priority
+
+
+class QueueFullError(Exception):
+    """Raised when the pipeline is at capacity and can't accept more jobs."""
+
+    def __init__(self, pending: int, capacity: int):
+        super().__init__(f"Processing queue is full ({pending}/{capacity})")
+        self.pending = pending
+        self.capacity = capacity
+
+
+class PipelineJob:
+    """A consultation moving through the AI pipeline (ocr -> classify -> analyze)."""
+
+    def __init__(self, consultation_id: int, user_id: str, patient_id: int = None,
+                 text: str = None, image_path: str = None, stage: str = None,
+                 fresh: bool = False, pipeline_mode: str = "two_pass",
+                 image_paths: List[str] = None, priority: str = DEFAULT_PRIORITY):
+        self.consultation_id = consultation_id
+        self.user_id = user_id
+        self.patient_id = patient_id
+        self.text = text
+        # Multi-page documents list every page; image_path is always page 1
+        self.image_paths = list(image_paths) if image_paths else ([image_path] if image_path else [])
+        self.image_path = image_path or (self.image_paths[0] if self.image_paths else None)
+        # Skip the LLM response cache (user asked for a new sample)
+        self.fresh = fresh
+        # "single" skips the classify stage; the analysis call returns the document type
+        self.pipeline_mode = pipeline_mode
+        self.priority = priority if priority in PRIORITIES else DEFAULT_PRIORITY
+        self.stage = stage or ("ocr" if self.image_path and not text else self.text_stage)
+        # Results handed from one stage to the next (classification, analysis, ...)
+        self.context: Dict[str, Any] = {}
+        self.submitted_at = time.time()
+        # When the job last entered a stage queue (not persisted; queue wait is per process)
+        self.enqueued_at = self.submitted_at
+        # Set by JobScheduler.cancel(); checked between stages and by the Ollama pool
+        self.cancel_token = CancelToken()
+
+        # Durable queue bookkeeping
+        self.job_id: Optional[int] = None
+        self.attempts = 0
+        self.lease_owner: Optional[str] = None
+
+    @property
+    def text_stage(self) -> str:
+        """First stage once the job has text to work on."""
+        return "analyze" if self.pipeline_mode == "single" else "classify"
+
+    def to_payload(self) -> Dict[str, Any]:
+        return {
+            "text": self.text,
+            "image_path": self.image_path,
+            "image_paths": self.image_paths,
+            "fresh": self.fresh,
+            "pipeline_mode": self.pipeline_mode,
+            "priority": self.priority,
+            "context": self.context,
+            "submitted_at": self.submitted_at,
+        }
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "PipelineJob":
+        payload = record.get('payload') or {}
+        job = cls(
+            record['consultation_id'],
+            record['user_id'],
+            patient_id=record.get('patient_id'),
+            text=payload.get('text'),
+            image_path=payload.get('image_path'),
+            stage=record['stage'],
+            fresh=payload.get('fresh', False),
+            pipeline_mode=payload.get('pipeline_mode', 'two_pass'),
+            image_paths=payload.get('image_paths'),
+            # The consultation's column wins: it's updated when a queued job is re-prioritized
+            priority=record.get('priority') or payload.get('priority', DEFAULT_PRIORITY)
+        )
+        job.context = payload.get('context') or {}
+        job.submitted_at = payload.get('submitted_at', job.submitted_at)
+        job.job_id = record['id']
+        job.attempts = record.get('attempts', 0)
+        return job
+
+    def __repr__(self):
+        return f"PipelineJob(consultation_id={self.consultation_id}, stage={self.stage}, priority={self.priority})"
+
+
+class PriorityJobQueue:
+    """
+    Stage queue ordered by priority class, with aging so low-priority work
+    can't starve. A job's sort key is its submission time plus `aging_seconds`
+    per class below urgent: an urgent job goes ahead of normal jobs submitted
+    up to `aging_seconds` before it (low ones: twice that), and once a job has
+    waited that long it's served before anything newer. The key doesn't change
+    while the job waits, so a heap keeps the order; re-prioritizing a queued
+    job marks its heap entry stale and pushes a new one.
+    """
+
+    def __init__(self, aging_seconds: float = 300):
+        self.aging_seconds = max(0.0, aging_seconds)
+        self._heap: List[list] = []
+        self._entries: Dict[int, list] = {}  # id(job) -> live heap entry
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _push(self, job: PipelineJob) -> list:
+        key = job.submitted_at + PRIORITIES.index(job.priority) * self.aging_seconds
+        entry = [key, next(self._seq), job]
+        self._entries[id(job)] = entry
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def put(self, job: PipelineJob) -> int:
+        """Enqueue `job`; returns its 1-based position in serving order."""
+        with self._cond:
+            entry = self._push(job)
+            self._cond.notify()
+            return 1 + sum(1 for e in self._entries.values() if e[:2] < entry[:2])
+
+    def get(self) -> PipelineJob:
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                if self._heap:
+                    break
+                self._cond.wait()
+            job = heapq.heappop(self._heap)[2]
+            del self._entries[id(job)]
+            return job
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._entries)
+
+    def counts(self) -> Dict[str, int]:
+        with self._cond:
+            counts = {p: 0 for p in PRIORITIES}
+            for entry in self._entries.values():
+                counts[entry[2].priority] += 1
+            return counts
+
+    def remove(self, consultation_id: int) -> List[PipelineJob]:
+        """Take the consultation's jobs out of the queue and return them."""
+        with self._cond:
+            removed = []
+            for key, entry in list(self._entries.items()):
+                if entry[2].consultation_id == consultation_id:
+                    removed.append(entry[2])
+                    entry[2] = None
+                    del self._entries[key]
+            return removed
+
+    def reprioritize(self, consultation_id: int, priority: str) -> int:
+        """Move the consultation's queued jobs to `priority`. Returns how many were queued here."""
+        with self._cond:
+            matches = [e for e in self._entries.values() if e[2].consultation_id == consultation_id]
+            for entry in matches:
+                job = entry[2]
+                entry[2] = None
+                job.priority = priority
+                self._push(job)
+            return len(matches)
+
+
+class JobScheduler:
+    """
+    Bounded, staged worker pool for consultation processing.
+
+    Each stage has its own priority queue (see PriorityJobQueue) and a fixed
+    number of worker threads, so OCR, classification and analysis can be sized
+    independently against the shared EasyOCR model and Ollama host. A stage handler receives the job and
+    returns the name of the next stage, or None when the job is finished.
+
+    Admission is bounded: at most `max_pending` jobs may be queued or running
+    across all stages; beyond that submit() raises QueueFullError so the API
+    can answer 429 instead of piling more work on a saturated box.
+
+    With a `store` (DBManager) every job is also persisted in the `jobs` table.
+    Workers lease a job before running a stage, and the reaper thread renews
+    the leases of stages still running here, so a slow stage is never run
+    twice. A lease that isn't renewed or completed within `lease_seconds`
+    (the process hung or died) becomes visible again and is picked up by the
+    reaper. A failing stage is retried up to `max_attempts` times, after
+    `retry_backoff` seconds, doubled on each further attempt.
+    recover() re-enqueues whatever a previous process left unfinished.
+
+    cancel() stops a consultation's jobs: queued ones are dropped, running ones
+    stop cooperatively through their CancelToken (between stages, before the
+    results are saved, or at the next chunk of an Ollama reply).
+    submit(supersede=True) cancels the consultation's earlier jobs first, so
+    repeated regenerations coalesce into the latest one.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable[[PipelineJob], Optional[str]]],
+                 workers: Dict[str, int], max_pending: int = 20,
+                 on_error: Callable[[PipelineJob, Exception], None] = None,
+                 store=None, lease_seconds: float = 600, max_attempts: int = 3,
+                 pipeline_mode: str = "two_pass", aging_seconds: float = 300,
+                 retry_backoff: float = 5):
+        self.handlers = handlers
+        self.workers = {stage: max(1, int(workers.get(stage, 1))) for stage in handlers}
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = max(0.0, retry_backoff)
+        self.pipeline_mode = pipeline_mode
+
+        self._queues: Dict[str, PriorityJobQueue] = {
+            stage: PriorityJobQueue(aging_seconds) for stage in handlers
+        }
+        self._running: Dict[str, int] = {stage: 0 for stage in handlers}
+        # Jobs queued or running, by id(job), for re-prioritizing and cancelling
+        self._live: Dict[int, PipelineJob] = {}
+        # Recent queue waits (seconds) per priority, for queue_depth()
+        self._waits: Dict[str, deque] = {p: deque(maxlen=500) for p in PRIORITIES}
+        self._queued_ids = set()
+        # Durable jobs whose stage is running in this process: job_id -> lease owner
+        self._leased: Dict[int, str] = {}
+        self._pending = 0
+        self._completed = 0
+        self._failed = 0
+        self._retried = 0
+        self._rejected = 0
+        self._recovered = 0
+        self._cancelled = 0
+        self._lock = threading.Lock()
+        self._threads = []
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for stage, count in self.workers.items():
+                for i in range(count):
+                    t = threading.Thread(target=self._worker_loop, args=(stage,),
+                                         name=f"pipeline-{stage}-{i}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+            if self.store is not None:
+                t = threading.Thread(target=self._reaper_loop, name="pipeline-reaper", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info(f"Job scheduler started with workers {self.workers}, capacity {self.max_pending}")
+
+    def submit(self, job: PipelineJob, supersede: bool = False) -> int:
+        """
+        Enqueue a job at its entry stage. With supersede=True any other job of
+        the same consultation is cancelled first (a newer regeneration wins).
+        Returns the job's 1-based position in that stage's queue.
+        """
+        if job.stage not in self._queues:
+            raise ValueError(f"Unknown pipeline stage: {job.stage}")
+
+        self.start()
+        with self._lock:
+            # The jobs this one supersedes give their slots up, but a running one only
+            # does once its worker notices the cancel; count them as free already
+            replaced = sum(1 for live in self._live.values()
+                           if live.consultation_id == job.consultation_id) if supersede else 0
+            if self._pending - replaced >= self.max_pending:
+                self._rejected += 1
+                raise QueueFullError(self._pending, self.max_pending)
+            self._pending += 1
+        # Only once the new job is admitted: a rejected regeneration leaves the old one running
+        if supersede:
+            self.cancel(job.consultation_id, reason="superseded")
+
+        if self.store is not None:
+            job.job_id = self.store.enqueue_job(job.consultation_id, job.user_id, job.stage,
+                                                job.to_payload(), patient_id=job.patient_id,
+                                                max_attempts=self.max_attempts)
+            if job.job_id < 0:
+                logger.warning(f"Could not persist {job}; it will not survive a restart")
+                job.job_id = None
+
+        position = self._put(job)
+        logger.info(f"Queued {job} at position {position}")
+        return position
+
+    def recover(self) -> int:
+        """
+        Re-enqueue work left behind by a previous process: unfinished jobs from
+        the `jobs` table, plus consultations stuck in 'processing' with no job.
+        Call once at startup, before any worker runs. Returns the number of jobs resumed.
+        """
+        if self.store is None:
+            return 0
+
+        self.store.reset_leases()
+        self.store.purge_jobs()
+
+        resumed = 0
+        for record in self.store.get_unfinished_jobs():
+            if record['stage'] not in self._queues:
+                logger.warning(f"Skipping job {record['id']} with unknown stage '{record['stage']}'")
+                continue
+            job = PipelineJob.from_record(record)
+            with self._lock:
+                self._pending += 1
+            self._put(job)
+            resumed += 1
+
+        for c in self.store.get_orphaned_consultations():
+            text = c.get('raw_text') or None
+            if not text and not c.get('image_path'):
+                logger.warning(f"Orphaned consultation {c['id']} has no text or image; leaving as is")
+                continue
+            image_paths = None
+            if (c.get('page_count') or 1) > 1:
+                image_paths = [p['image_path'] for p in self.store.get_pages(c['id'])]
+            job = PipelineJob(c['id'], c['user_id'], patient_id=c.get('patient_id'),
+                              text=text, image_path=c.get('image_path') or None,
+                              pipeline_mode=self.pipeline_mode, image_paths=image_paths,
+                              priority=c.get('priority') or DEFAULT_PRIORITY)
+            job.job_id = self.store.enqueue_job(job.consultation_id, job.user_id, job.stage,
+                                                job.to_payload(), patient_id=job.patient_id,
+                                                max_attempts=self.max_attempts)
+            if job.job_id < 0:
+                job.job_id = None
+            with self._lock:
+                self._pending += 1
+            self._put(job)
+            resumed += 1
+
+        with self._lock:
+            self._recovered += resumed
+        if resumed:
+            logger.info(f"Recovered {resumed} unfinished pipeline job(s)")
+        self.start()
+        return resumed
+
+    def reprioritize(self, consultation_id: int, priority: str) -> bool:
+        """
+        Change the priority of a consultation's job, whether it's waiting in a
+        stage queue or running (it then keeps the new priority for the
+        remaining stages). Returns False if the scheduler has no job for it.
+        """
+        priority = normalize_priority(priority)
+        for q in self._queues.values():
+            q.reprioritize(consultation_id, priority)
+        found = 0
+        with self._lock:
+            for job in self._live.values():
+                if job.consultation_id == consultation_id:
+                    job.priority = priority
+                    found += 1
+        if found:
+            logger.info(f"Consultation {consultation_id} re-prioritized to {priority}")
+        return found > 0
+
+    def cancel(self, consultation_id: int, reason: str = "cancelled") -> int:
+        """Cancel every queued or running job of a consultation. Returns how many there were."""
+        removed = [job for q in self._queues.values() for job in q.remove(consultation_id)]
+        with self._lock:
+            live = [job for job in self._live.values() if job.consultation_id == consultation_id]
+        for job in live:
+            job.cancel_token.cancel(reason)
+        if self.store is not None:
+            self.store.cancel_jobs(consultation_id, reason)
+        # Queued jobs never reach a worker; release their admission slots here
+        for job in removed:
+            with self._lock:
+                self._queued_ids.discard(job.job_id)
+            self._finish_cancelled(job)
+        if live:
+            logger.info(f"Cancelled {len(live)} job(s) of consultation {consultation_id} ({reason})")
+        return len(live)
+
+    def _wait_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for priority in PRIORITIES:
+            waits = sorted(self._waits[priority])
+            stats[priority] = {
+                "samples": len(waits),
+                "p50_ms": round(percentile(waits, 50) * 1000, 1) if waits else None,
+                "p95_ms": round(percentile(waits, 95) * 1000, 1) if waits else None,
+                "max_ms": round(waits[-1] * 1000, 1) if waits else None,
+            }
+        return stats
+
+    def queue_depth(self) -> Dict[str, Any]:
+        queued = {stage: q.counts() for stage, q in self._queues.items()}
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "capacity": self.max_pending,
+                "stages": {
+                    stage: {
+                        "queued": sum(queued[stage].values()),
+                        "queued_by_priority": queued[stage],
+                        "running": self._running[stage],
+                        "workers": self.workers[stage],
+                    }
+                    for stage in self._queues
+                },
+                "aging_seconds": next(iter(self._queues.values())).aging_seconds if self._queues else None,
+                "queue_wait": self._wait_stats(),
+                "completed": self._completed,
+                "failed": self._failed,
+                "retried": self._retried,
+                "rejected": self._rejected,
+                "recovered": self._recovered,
+                "cancelled": self._cancelled,
+                "durable": self.store is not None,
+            }
+
+    def _put(self, job: PipelineJob) -> int:
+        job.enqueued_at = time.time()
+        with self._lock:
+            if job.job_id is not None:
+                self._queued_ids.add(job.job_id)
+            self._live[id(job)] = job
+            return self._queues[job.stage].put(job)
+
+    def _claim(self, job: PipelineJob) -> bool:
+        """Lease the job in the store. In-memory jobs are always 'claimed'."""
+        if self.store is None or job.job_id is None:
+            job.attempts += 1
+            return True
+        owner = uuid.uuid4().hex
+        attempts = self.store.claim_job(job.job_id, owner, self.lease_seconds)
+        if attempts is None:
+            return False
+        job.lease_owner = owner
+        job.attempts = attempts
+        return True
+
+    def _worker_loop(self, stage: str):
+        q = self._queues[stage]
+        handler = self.handlers[stage]
+        while True:
+            job = q.get()
+            wait = max(0.0, time.time() - job.enqueued_at)
+            PIPELINE_QUEUE_WAIT.observe(wait, stage=stage, priority=job.priority)
+            with self._lock:
+                self._queued_ids.discard(job.job_id)
+                self._running[stage] += 1
+                self._waits[job.priority].append(wait)
+            try:
+                with cancel_scope(job.cancel_token):
+                    self._run(stage, handler, job)
+            finally:
+                with self._lock:
+                    self._running[stage] -= 1
+
+    def _run(self, stage: str, handler, job: PipelineJob):
+        if job.cancel_token.cancelled:
+            self._finish_cancelled(job)
+            return
+
+        if not self._claim(job):
+            # Another worker (or a reaped copy) owns this job now
+            logger.info(f"{job} is leased elsewhere; skipping")
+            self._finish(None, job)
+            return
+
+        owner = job.lease_owner
+        if owner is None:
+            self._run_claimed(stage, handler, job)
+            return
+        # The reaper renews this lease until the stage is over
+        with self._lock:
+            self._leased[job.job_id] = owner
+        try:
+            self._run_claimed(stage, handler, job)
+        finally:
+            with self._lock:
+                # The job may already be leased again by the next stage's worker
+                if self._leased.get(job.job_id) == owner:
+                    del self._leased[job.job_id]
+
+    def _run_claimed(self, stage: str, handler, job: PipelineJob):
+        durable = self.store is not None and job.job_id is not None
+
+        if job.attempts > self.max_attempts:
+            error = RuntimeError(f"Gave up after {self.max_attempts} attempts")
+            self._report_error(job, error)
+            if durable:
+                self.store.finish_job(job.job_id, job.lease_owner, status='failed', error=str(error))
+            self._finish(False, job)
+            return
+
+        try:
+            job.stage = stage
+            next_stage = handler(job)
+        except JobCancelled:
+            self._finish_cancelled(job)
+            return
+        except Exception as e:
+            if job.cancel_token.cancelled:
+                self._finish_cancelled(job)
+                return
+            logger.error(f"Pipeline stage '{stage}' failed for {job} (attempt {job.attempts}): {e}")
+            if job.attempts < self.max_attempts:
+                if durable and not self.store.release_job(job.job_id, job.lease_owner, error=str(e)):
+                    self._finish(None, job)
+                    return
+                with self._lock:
+                    self._retried += 1
+                self._retry_later(job)
+                return
+            self._report_error(job, e)
+            if durable:
+                self.store.finish_job(job.job_id, job.lease_owner, status='failed', error=str(e))
+            self._finish(False, job)
+            return
+
+        if job.cancel_token.cancelled:
+            # Cancelled while the stage was finishing; its result is dropped
+            self._finish_cancelled(job)
+            return
+
+        if next_stage and next_stage not in self._queues:
+            logger.error(f"Unknown next stage '{next_stage}' for {job}; dropping")
+            if durable:
+                self.store.finish_job(job.job_id, job.lease_owner, status='failed',
+                                      error=f"Unknown stage {next_stage}")
+            self._finish(False, job)
+            return
+
+        if next_stage:
+            if durable and not self.store.advance_job(job.job_id, job.lease_owner, next_stage,
+                                                      job.to_payload()):
+                logger.warning(f"Lost lease on {job}; another worker will continue it")
+                self._finish(None, job)
+                return
+            job.stage = next_stage
+            job.attempts = 0
+            job.lease_owner = None
+            self._put(job)
+            return
+
+        if durable:
+            self.store.finish_job(job.job_id, job.lease_owner, status='done')
+        self._finish(True, job)
+
+    def _retry_later(self, job: PipelineJob):
+        """Re-enqueue a failed job after an exponential backoff (it stays live, so cancel() still reaches it)."""
+        delay = self.retry_backoff * 2 ** max(0, job.attempts - 1)
+        if delay <= 0:
+            self._put(job)
+            return
+        logger.info(f"Retrying {job} in {delay:.1f}s")
+        timer = threading.Timer(delay, self._put, args=(job,))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, succeeded: Optional[bool], job: PipelineJob = None):
+        """Release the job's admission slot. succeeded=None means it was handed off, not run."""
+        if job is not None and succeeded is not None:
+            PIPELINE_JOB_DURATION.observe(max(0.0, time.time() - job.submitted_at), priority=job.priority,
+                                          outcome="done" if succeeded else "failed")
+        with self._lock:
+            if job is not None:
+                self._live.pop(id(job), None)
+            self._pending = max(0, self._pending - 1)
+            if succeeded is True:
+                self._completed += 1
+            elif succeeded is False:
+                self._failed += 1
+
+    def _finish_cancelled(self, job: PipelineJob):
+        logger.info(f"{job} cancelled ({job.cancel_token.reason})")
+        with self._lock:
+            self._cancelled += 1
+        self._finish(None, job)
+
+    def _report_error(self, job: PipelineJob, error: Exception):
+        if self.on_error:
+            try:
+                self.on_error(job, error)
+            except Exception as cb_err:
+                logger.error(f"Pipeline error handler failed: {cb_err}")
+
+    def _reaper_loop(self):
+        """
+        Renew the leases of stages running here, then put jobs whose lease
+        expired (hung or crashed worker) back on their stage queue.
+        """
+        interval = max(1.0, self.lease_seconds / 4)
+        while True:
+            time.sleep(interval)
+            try:
+                with self._lock:
+                    leased = list(self._leased.items())
+                for job_id, owner in leased:
+                    if not self.store.renew_lease(job_id, owner, self.lease_seconds):
+                        logger.debug(f"Job {job_id} is no longer leased by its worker")
+                for record in self.store.get_expired_jobs():
+                    with self._lock:
+                        if (record['id'] in self._queued_ids or record['id'] in self._leased
+                                or record['stage'] not in self._queues):
+                            continue
+                        self._pending += 1
+                    logger.warning(f"Lease expired for job {record['id']}; re-enqueuing")
+                    self._put(PipelineJob.from_record(record))
+            except Exception as e:
+                logger.error(f"Job reaper error: {e}")
@@ -0,0 +1,178 @@
+import json
+import re
+import logging
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_UNQUOTED_KEY_RE = re.compile(r'([{,]\s*)([A-Za-z_][\w\-]*)(\s*:)')
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _strip_fences(text: str) -> str:
+    if "```json" in text:
+        text = text.split("```json", 1)[1]
+    elif "```" in text:
+        text = text.split("```", 1)[1]
+    return text.split("```", 1)[0] if "```" in text else text
+
+
+def _close_truncated(text: str) -> str:
+    """
+    Close whatever a truncated generation left open: an unterminated string,
+    a dangling key or comma, and every open array/object, innermost first.
+    """
+    stack = []
+    in_string = False
+    escape = False
+    last_safe = 0  # end of the last complete value/element, for dropping a partial tail
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            last_safe = i + 1
+        elif ch == ",":
+            last_safe = i
+
+    if not stack:
+        return text
+
+    if in_string:
+        text += '"'
+    tail = text.rstrip()
+    # A key without a value ("key": or "key") can't be completed; cut back to the last element
+    if tail.endswith(":") or tail.endswith(",") or re.search(r'[{,]\s*"[^"]*"$', tail):
+        text = text[:last_safe].rstrip().rstrip(",")
+        # Re-scan: cutting may have closed/removed containers
+        return _close_truncated(text) if text else text
+    return text + "".join(reversed(stack))
+
+
+def repair_json(text: str) -> Dict[str, Any]:
+    """
+    Best-effort parse of a model's almost-JSON reply: markdown fences, prose
+    around the object, trailing commas, unquoted keys, single-quoted strings,
+    Python literals and output truncated mid-array/object. Raises
+    json.JSONDecodeError if it still can't be read.
+    """
+    text = _strip_fences(text or "")
+    start = text.find("{")
+    if start < 0:
+        raise json.JSONDecodeError("No JSON object found", text, 0)
+    text = text[start:]
+    end = text.rfind("}")
+
+    # Whole text first (a truncated tail may hold complete fields past the last
+    # '}'), then cut at the last '}' to drop prose after the object
+    candidates = [text]
+    if 0 < end < len(text.rstrip()) - 1:
+        candidates.append(text[:end + 1])
+
+    last_error = None
+    for candidate in candidates:
+        for fixed in _fix_variants(candidate):
+            try:
+                value = json.loads(fixed)
+                if isinstance(value, dict):
+                    return value
+            except json.JSONDecodeError as e:
+                last_error = e
+    raise last_error or json.JSONDecodeError("Unrepairable JSON", text, 0)
+
+
+def _outside_strings(text: str, fix) -> str:
+    """Apply `fix` only to the parts of `text` that aren't inside double-quoted strings."""
+    parts, start, i, in_string = [], 0, 0, False
+    while i < len(text):
+        ch = text[i]
+        if in_string and ch == "\\":
+            i += 2
+            continue
+        if ch == '"':
+            segment = text[start:i + 1] if in_string else fix(text[start:i]) + '"'
+            parts.append(segment)
+            start = i + 1
+            in_string = not in_string
+        i += 1
+    tail = text[start:]
+    parts.append(tail if in_string else fix(tail))
+    return "".join(parts)
+
+
+def _closing_quote(text: str, start: int):
+    """Index of the ' closing a single-quoted string opened before `start`, or None."""
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "'":
+            rest = text[i + 1:].lstrip()
+            # An apostrophe inside a word (O'Brien) isn't followed by a delimiter
+            if not rest or rest[0] in ",:}]":
+                return i
+        i += 1
+    return None
+
+
+def _requote(text: str) -> str:
+    """Rewrite 'single-quoted' keys and values as double-quoted JSON strings."""
+    parts, i, in_string, previous = [], 0, False, ""
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            parts.append(text[i:i + 2] if ch == "\\" else ch)
+            if ch == "\\":
+                i += 2
+                continue
+            in_string = ch != '"'
+        elif ch == "'" and previous in ("", "{", "[", ",", ":"):
+            end = _closing_quote(text, i + 1)
+            if end is not None:
+                body = text[i + 1:end].replace("\\'", "'")
+                parts.append('"' + re.sub(r'(?<!\\)"', r'\\"', body) + '"')
+                previous = '"'
+                i = end + 1
+                continue
+            parts.append(ch)
+        else:
+            parts.append(ch)
+            in_string = ch == '"'
+        if not ch.isspace():
+            previous = ch
+        i += 1
+    return "".join(parts)
+
+
+def _fix_syntax(segment: str) -> str:
+    segment = _UNQUOTED_KEY_RE.sub(r'\1"\2"\3', segment)
+    for py, js in _PY_LITERALS.items():
+        segment = re.sub(rf"\b{py}\b", js, segment)
+    return _strip_trailing_commas(segment)
+
+
+def _strip_trailing_commas(segment: str) -> str:
+    return _TRAILING_COMMA_RE.sub(r"\1", segment)
+
+
+def _fix_variants(text: str):
+    """Progressively more aggressive rewrites of `text`."""
+    yield text
+    # Single quotes first, so the bare keys quoted next and the strings agree on '"'
+    fixed = _outside_strings(_requote(text), _fix_syntax)
+    yield fixed
+    yield _outside_strings(_close_truncated(fixed), _strip_trailing_commas)
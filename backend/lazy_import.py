@@ -0,0 +1,85 @@
+import importlib
+import importlib.util
+import threading
+import time
+import types
+import logging
+from typing import Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a heavy module (cv2, easyocr/torch, PyMuPDF, ...) that is only
+    imported on first attribute access, so importing the server or the GUI
+    doesn't pay for it. `cv2 = lazy_import("cv2")` then `cv2.imread(...)`
+    behaves like the real module; a missing module raises ImportError at that
+    first use.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+        self.__dict__["_lazy_lock"] = threading.Lock()
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_lazy_module"]
+        if module is not None:
+            return module
+        with self.__dict__["_lazy_lock"]:
+            module = self.__dict__["_lazy_module"]
+            if module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self.__name__)
+                self.__dict__["_lazy_module"] = module
+                _load_seconds[self.__name__] = time.perf_counter() - start
+                logger.info(f"Imported {self.__name__} in {_load_seconds[self.__name__]:.2f}s")
+        return module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.__dict__["_lazy_module"] is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return f"<lazy module {self.__name__!r} ({'loaded' if self.is_loaded else 'not loaded'})>"
+
+
+_load_seconds: Dict[str, float] = {}
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def is_available(name: str) -> bool:
+    """Whether `name` could be imported, without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def preload(modules: Iterable[LazyModule]) -> threading.Thread:
+    """Import `modules` in a background thread, so first use doesn't wait for them."""
+    def load_all():
+        for module in modules:
+            try:
+                module._load()
+            except Exception as e:
+                logger.warning(f"Background import of {module.__name__} failed: {e}")
+
+    thread = threading.Thread(target=load_all, name="lazy-import-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def import_stats() -> Dict[str, float]:
+    """Seconds each lazily imported module took to load."""
+    return {name: round(seconds, 3) for name, seconds in _load_seconds.items()}
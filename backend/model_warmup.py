@@ -0,0 +1,251 @@
+import copy
+import threading
+import time
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def parse_clinic_hours(value: str) -> Optional[tuple]:
+    """"07:00-20:00" -> ((7, 0), (20, 0)); empty or malformed means always open."""
+    try:
+        start, end = (part.strip() for part in value.split("-", 1))
+        return tuple(tuple(int(x) for x in t.split(":", 1)) for t in (start, end))
+    except (AttributeError, ValueError):
+        return None
+
+
+class ModelWarmup:
+    """
+    Keeps the models the pipeline needs loaded, so the first consultation of
+    the day doesn't pay Ollama's model-load time (or Whisper's on the first
+    voice note).
+
+    At start every Ollama model is loaded on each host that can serve it (an
+    empty chat with `keep_alive` and the pool's options for that model, so it
+    is loaded with the num_ctx real requests use) and every
+    registered local loader (e.g. Whisper) runs once. After that a background
+    thread re-sends the load request every `ping_interval` seconds during clinic
+    hours, which only refreshes the residency timer, and skips hosts busy with
+    real requests since those keep the model warm anyway. Outside clinic hours
+    models are left to expire. status() reports per-model readiness, refreshed
+    from `ollama ps`; a model resident with a different context length than
+    the pool's num_ctx counts as cold, since the next real request reloads it.
+    """
+
+    COLD = "cold"
+    LOADING = "loading"
+    READY = "ready"
+    ERROR = "error"
+
+    def __init__(self, pool_provider: Callable[[], Any], models: List[str], keep_alive: Any = None,
+                 ping_interval: float = 600, clinic_hours: str = "", clinic_days: List[int] = None,
+                 clock: Callable[[], datetime] = datetime.now):
+        self.pool_provider = pool_provider
+        self.models = list(dict.fromkeys(models))
+        self.keep_alive = keep_alive
+        self.ping_interval = ping_interval
+        self.clinic_hours = parse_clinic_hours(clinic_hours)
+        self.clinic_days = set(clinic_days) if clinic_days else None
+        self.clock = clock
+
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._status: Dict[str, Dict[str, Any]] = {
+            m: {"kind": "ollama", "state": self.COLD, "hosts": {}, "last_warmed": None, "error": None}
+            for m in self.models
+        }
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ─── Lifecycle ───────────────────────────────────────────────
+
+    def start(self) -> Optional[threading.Thread]:
+        """Warm everything up in the background, then keep it warm (no-op if already running)."""
+        with self._lock:
+            if self._thread is not None:
+                return self._thread
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="model-warmup", daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+    def add_loader(self, name: str, load: Callable[[], Any]):
+        """
+        Register a local (non-Ollama) model. It's loaded once in the background,
+        straight away if the warm-up is already running.
+        """
+        with self._lock:
+            self._loaders[name] = load
+            self._status[name] = {"kind": "local", "state": self.COLD, "load_seconds": None, "error": None}
+            running = self._thread is not None
+        if running:
+            threading.Thread(target=self._load_local, args=(name,), name=f"warmup-{name}", daemon=True).start()
+
+    def _run(self):
+        for name in list(self._loaders):
+            threading.Thread(target=self._load_local, args=(name,), name=f"warmup-{name}", daemon=True).start()
+        try:
+            self.warm_all()
+        except Exception as e:
+            logger.error(f"Model warm-up failed: {e}")
+        while not self._stop.wait(self.ping_interval):
+            try:
+                if self.in_clinic_hours():
+                    self.warm_all(skip_busy=True)
+                else:
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"Keep-warm ping failed: {e}")
+
+    # ─── Warming ─────────────────────────────────────────────────
+
+    def in_clinic_hours(self, now: datetime = None) -> bool:
+        now = now or self.clock()
+        if self.clinic_days is not None and now.weekday() not in self.clinic_days:
+            return False
+        if self.clinic_hours is None:
+            return True
+        (start_h, start_m), (end_h, end_m) = self.clinic_hours
+        minutes = now.hour * 60 + now.minute
+        start, end = start_h * 60 + start_m, end_h * 60 + end_m
+        # A range like 20:00-06:00 wraps past midnight
+        return start <= minutes < end if start <= end else minutes >= start or minutes < end
+
+    def warm_all(self, skip_busy: bool = False):
+        pool = self.pool_provider()
+        for model in self.models:
+            self.warm_model(pool, model, skip_busy=skip_busy)
+        self.refresh(pool)
+
+    def warm_model(self, pool, model: str, skip_busy: bool = False) -> bool:
+        """Load (or re-touch) `model` on every host that can serve it. True if any host has it."""
+        warmed = False
+        for backend in pool.candidates(model):
+            if skip_busy and backend.outstanding > 0:
+                warmed = True
+                continue
+            with self._lock:
+                if self._status[model]["state"] != self.READY:
+                    self._status[model]["state"] = self.LOADING
+            start = time.perf_counter()
+            try:
+                backend.load(model, keep_alive=self.keep_alive, options=pool.options_for(model) or None)
+            except Exception as e:
+                logger.warning(f"Warm-up of {model} on {backend.host} failed: {e}")
+                with self._lock:
+                    self._status[model]["hosts"][backend.host] = {"loaded": False, "error": str(e)}
+                continue
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._status[model]["hosts"][backend.host] = {"loaded": True, "load_seconds": round(seconds, 2)}
+            warmed = True
+            if seconds > 1:
+                logger.info(f"Loaded {model} on {backend.host} in {seconds:.1f}s")
+
+        with self._lock:
+            status = self._status[model]
+            if warmed:
+                status.update(state=self.READY, last_warmed=time.time(), error=None)
+            else:
+                errors = [h.get("error") for h in status["hosts"].values() if h.get("error")]
+                status.update(state=self.ERROR, error=errors[-1] if errors else "No Ollama host serves this model")
+        return warmed
+
+    def refresh(self, pool=None):
+        """Update readiness from what each host actually has resident (`ollama ps`)."""
+        pool = pool or self.pool_provider()
+        running_by_host = {}
+        for backend in pool.backends:
+            try:
+                running_by_host[backend.host] = backend.running_models()
+            except Exception as e:
+                logger.debug(f"ollama ps failed on {backend.host}: {e}")
+
+        with self._lock:
+            for model in self.models:
+                status = self._status[model]
+                if status["state"] == self.LOADING:
+                    continue
+                key = model if ":" in model else f"{model}:latest"
+                expected_ctx = pool.options_for(model).get("num_ctx")
+                resident = False
+                for host, running in running_by_host.items():
+                    if host not in status["hosts"] and key not in running:
+                        continue  # host doesn't serve this model
+                    entry = status["hosts"].setdefault(host, {})
+                    info = running.get(key) or {}
+                    context_length = info.get("context_length")
+                    matches = not (expected_ctx and context_length and context_length != expected_ctx)
+                    entry["loaded"] = key in running and matches
+                    entry["expires_at"] = info.get("expires_at")
+                    entry["context_length"] = context_length
+                    if key in running and not matches:
+                        entry["error"] = f"Loaded with num_ctx {context_length}, requests use {expected_ctx}"
+                    else:
+                        entry.pop("error", None)
+                    resident = resident or entry["loaded"]
+                if running_by_host:
+                    status["state"] = self.READY if resident else self.COLD
+
+    def _load_local(self, name: str):
+        load = self._loaders.get(name)
+        if load is None:
+            return
+        self._set(name, state=self.LOADING, error=None)
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            logger.error(f"Warm-up of {name} failed: {e}")
+            self._set(name, state=self.ERROR, error=str(e))
+            return
+        seconds = time.perf_counter() - start
+        self._set(name, state=self.READY, load_seconds=round(seconds, 2))
+        logger.info(f"{name} ready in {seconds:.1f}s")
+
+    # ─── Readiness ───────────────────────────────────────────────
+
+    def _set(self, name: str, **fields):
+        with self._lock:
+            self._status[name].update(fields)
+
+    def is_ready(self, name: str = None) -> bool:
+        """Whether `name` (or every tracked model) is loaded."""
+        with self._lock:
+            names = [name] if name else list(self._status)
+            return all(self._status.get(n, {}).get("state") == self.READY for n in names)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            models = copy.deepcopy(self._status)
+        return {
+            "enabled": self._thread is not None,
+            "keep_alive": self.keep_alive,
+            "ping_interval": self.ping_interval,
+            "in_clinic_hours": self.in_clinic_hours(),
+            "models": models,
+        }
+
+
+def _default_pool():
+    from backend.engine_registry import engine_registry
+    return engine_registry.get_engine().pool
+
+
+# Global instance
+model_warmup = ModelWarmup(
+    _default_pool,
+    [config.OLLAMA_VISION_MODEL, config.OLLAMA_LOGIC_MODEL],
+    keep_alive=config.OLLAMA_KEEP_ALIVE,
+    ping_interval=config.WARMUP_PING_INTERVAL,
+    clinic_hours=config.CLINIC_HOURS,
+    clinic_days=config.CLINIC_DAYS,
+)
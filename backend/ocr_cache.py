@@ -0,0 +1,159 @@
+import sqlite3
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DB_NAME = os.path.join(BASE_DIR, "ocr_cache.db")
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OCRCache:
+    """
+    Content-addressed cache of text extraction results.
+
+    Entries are keyed by the SHA-256 of the image bytes plus the engine
+    ('easyocr' / 'vision'), the model and the prompt version, so a re-upload of
+    the same photo skips EasyOCR and the vision model entirely, while a model or
+    prompt change naturally misses. The cache lives in its own SQLite file and
+    is bounded by total stored text size with least-recently-used eviction.
+    """
+
+    def __init__(self, db_name: str = CACHE_DB_NAME, max_bytes: int = 64 * 1024 * 1024):
+        self.db_name = db_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.init_db()
+
+    def _get_connection(self):
+        return sqlite3.connect(self.db_name)
+
+    def init_db(self):
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS ocr_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        image_sha256 TEXT NOT NULL,
+                        engine TEXT NOT NULL,
+                        model TEXT,
+                        prompt_version TEXT,
+                        text TEXT NOT NULL,
+                        confidence REAL,
+                        size_bytes INTEGER NOT NULL,
+                        created_at REAL,
+                        last_accessed REAL,
+                        hits INTEGER DEFAULT 0
+                    )
+                """)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_lru ON ocr_cache(last_accessed)")
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error initializing OCR cache: {e}")
+
+    @staticmethod
+    def make_key(image_sha256: str, engine: str, model: str = "", prompt_version: str = "") -> str:
+        return f"{image_sha256}:{engine}:{model}:{prompt_version}"
+
+    def get(self, image_sha256: str, engine: str, model: str = "",
+            prompt_version: str = "") -> Optional[Dict[str, Any]]:
+        key = self.make_key(image_sha256, engine, model, prompt_version)
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT text, confidence FROM ocr_cache WHERE cache_key = ?", (key,))
+                row = cursor.fetchone()
+                if row is None:
+                    with self._lock:
+                        self.misses += 1
+                    return None
+                cursor.execute(
+                    "UPDATE ocr_cache SET last_accessed = ?, hits = hits + 1 WHERE cache_key = ?",
+                    (time.time(), key)
+                )
+                conn.commit()
+                with self._lock:
+                    self.hits += 1
+                return {"text": row[0], "confidence": row[1], "engine": engine}
+        except sqlite3.Error as e:
+            logger.error(f"Error reading OCR cache: {e}")
+            return None
+
+    def contains(self, image_sha256: str, engine: str, model: str = "", prompt_version: str = "") -> bool:
+        """Presence check that doesn't count as a hit or refresh the entry."""
+        key = self.make_key(image_sha256, engine, model, prompt_version)
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM ocr_cache WHERE cache_key = ?", (key,))
+                return cursor.fetchone() is not None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading OCR cache: {e}")
+            return False
+
+    def put(self, image_sha256: str, engine: str, text: str, confidence: float = None,
+            model: str = "", prompt_version: str = ""):
+        key = self.make_key(image_sha256, engine, model, prompt_version)
+        size = len(text.encode("utf-8"))
+        now = time.time()
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT OR REPLACE INTO ocr_cache (cache_key, image_sha256, engine, model,
+                        prompt_version, text, confidence, size_bytes, created_at, last_accessed, hits)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                """, (key, image_sha256, engine, model, prompt_version, text, confidence, size, now, now))
+                self._evict(cursor)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error writing OCR cache: {e}")
+
+    def _evict(self, cursor):
+        cursor.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM ocr_cache")
+        total = cursor.fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        cursor.execute("SELECT cache_key, size_bytes FROM ocr_cache ORDER BY last_accessed ASC")
+        victims = []
+        for key, size in cursor.fetchall():
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        cursor.executemany("DELETE FROM ocr_cache WHERE cache_key = ?", victims)
+        logger.info(f"OCR cache evicted {len(victims)} entries")
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM ocr_cache")
+                entries, size = cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading OCR cache stats: {e}")
+            entries, size = 0, 0
+        with self._lock:
+            return {
+                "entries": entries,
+                "size_bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,601 @@
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import httpx
+import ollama
+
+from backend.cancellation import CancelToken, JobCancelled, current_token
+from backend.prometheus_metrics import OLLAMA_LATENCY, OLLAMA_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+class NoBackendAvailable(Exception):
+    """No Ollama host could serve the request."""
+
+
+class OllamaTimeout(Exception):
+    """An Ollama request ran past its deadline."""
+
+
+def is_connection_error(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, httpx.ConnectError, httpx.ConnectTimeout, NoBackendAvailable)):
+        return True
+    message = str(error)
+    return "Connection refused" in message or "Failed to connect" in message
+
+
+def is_timeout(error: Exception) -> bool:
+    # A connect timeout means the host is unreachable (fail over); a read timeout means it hung
+    return isinstance(error, OllamaTimeout) or \
+        (isinstance(error, httpx.TimeoutException) and not isinstance(error, httpx.ConnectTimeout))
+
+
+def error_kind(error: Exception) -> str:
+    """Label for the Ollama error counter: timeout, connection or error."""
+    if is_timeout(error):
+        return "timeout"
+    return "connection" if is_connection_error(error) else "error"
+
+
+def _normalize_model(name: str) -> str:
+    return name if ":" in name else f"{name}:latest"
+
+
+def _field(obj: Any, *names: str) -> Any:
+    for name in names:
+        try:
+            value = obj[name]
+        except (KeyError, TypeError, IndexError):
+            value = getattr(obj, name, None)
+        if value is not None:
+            return value
+    return None
+
+
+class CircuitBreaker:
+    """
+    Fails fast on a host that keeps failing. After `failure_threshold`
+    consecutive connection errors or timeouts the breaker opens and the host
+    gets no requests for `reset_timeout` seconds; then a single trial request
+    is let through (half-open) and its outcome closes or re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _cooled_down(self) -> bool:
+        return self.clock() - self._opened_at >= self.reset_timeout
+
+    def available(self) -> bool:
+        """Whether a request could be sent now (doesn't claim the half-open trial)."""
+        with self._lock:
+            if self.state == self.OPEN:
+                return self._cooled_down()
+            return self.state == self.CLOSED or not self._trial
+
+    def acquire(self) -> bool:
+        """Claim permission to send a request."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if not self._cooled_down():
+                    return False
+                self.state = self.HALF_OPEN
+            if self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial = False
+
+    def release(self):
+        """A request ended without an outcome (it was cancelled): free the half-open trial, nothing else."""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            retry_in = max(0.0, self.reset_timeout - (self.clock() - self._opened_at)) \
+                if self.state == self.OPEN else None
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "trips": self.trips,
+                "retry_in": round(retry_in, 1) if retry_in is not None else None,
+            }
+
+
+class LatencyStats:
+    """Recent successful request latencies for one model, plus timeout/hedge counters."""
+
+    def __init__(self, window: int = 500):
+        self.samples = deque(maxlen=window)
+        self.timeouts = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    def status(self) -> Dict[str, Any]:
+        def ms(p):
+            value = self.percentile(p)
+            return round(value * 1000) if value is not None else None
+        return {
+            "samples": len(self.samples),
+            "p50_ms": ms(50),
+            "p95_ms": ms(95),
+            "p99_ms": ms(99),
+            "timeouts": self.timeouts,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class OllamaBackend:
+    """One Ollama host: its client, the models it has pulled and its live load."""
+
+    def __init__(self, host: str, client_factory: Callable[..., Any] = ollama.Client,
+                 breaker: CircuitBreaker = None, **client_kwargs):
+        self.host = host
+        self.client_factory = client_factory
+        self.client_kwargs = client_kwargs
+        self.client = client_factory(host=host, **client_kwargs)
+        # The HTTP timeout is fixed per client, so each stage deadline gets its own
+        self._timed_clients: Dict[float, Any] = {}
+        self._clients_lock = threading.Lock()
+        self.breaker = breaker or CircuitBreaker()
+        self.models: set = set()
+        self.healthy = True  # optimistic until the first probe says otherwise
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_check: Optional[float] = None
+
+    def probe(self) -> bool:
+        """Active health check: list the host's models."""
+        try:
+            response = self.client.list()
+            models = _field(response, "models") or []
+            self.models = {_normalize_model(n) for n in (_field(m, "model", "name") for m in models) if n}
+            self.healthy = True
+            self.last_error = None
+        except Exception as e:
+            self.healthy = False
+            self.last_error = str(e)
+        self.last_check = time.time()
+        return self.healthy
+
+    def client_for(self, timeout: Optional[float] = None):
+        if not timeout:
+            return self.client
+        with self._clients_lock:
+            client = self._timed_clients.get(timeout)
+            if client is None:
+                client = self.client_factory(host=self.host, timeout=timeout, **self.client_kwargs)
+                self._timed_clients[timeout] = client
+            return client
+
+    def load(self, model: str, keep_alive: Any = None, options: Dict[str, Any] = None):
+        """
+        Load `model` into memory without generating (a chat with no messages).
+        `options` must match what real requests send (num_ctx in particular),
+        or the first real request reloads the model anyway.
+        """
+        kwargs = {"keep_alive": keep_alive} if keep_alive is not None else {}
+        if options:
+            kwargs["options"] = options
+        self.client.chat(model=model, messages=[], **kwargs)
+
+    def running_models(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Models currently resident on this host (`ollama ps`), with their unload
+        deadline and the context length they were loaded with (None if the
+        server doesn't report it).
+        """
+        response = self.client.ps()
+        running = {}
+        for entry in _field(response, "models") or []:
+            name = _field(entry, "model", "name")
+            if name:
+                expires_at = _field(entry, "expires_at")
+                context_length = _field(entry, "context_length")
+                running[_normalize_model(name)] = {
+                    "expires_at": str(expires_at) if expires_at is not None else None,
+                    "context_length": int(context_length) if context_length else None,
+                }
+        return running
+
+    def serves(self, model: str) -> bool:
+        # Before the first successful probe we don't know; let the request find out
+        return not self.models or _normalize_model(model) in self.models
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "models": sorted(self.models),
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_check": self.last_check,
+            "breaker": self.breaker.status(),
+        }
+
+
+class OllamaPool:
+    """
+    Routes chat requests across several Ollama hosts.
+
+    Requests go to the healthy host with the fewest outstanding requests that
+    has the model pulled. If a host refuses the connection it is marked
+    unhealthy and the request fails over to the next candidate; a background
+    probe (`client.list()` every `health_interval` seconds) brings hosts back
+    and refreshes their model lists. `model_routes` optionally pins a model to
+    a subset of hosts, e.g. vision on the GPU box and logic elsewhere.
+
+    Each host has a circuit breaker, so a host that keeps refusing or hanging
+    is skipped outright instead of costing every request a timeout. `chat`
+    takes a `timeout` (seconds) that bounds the call: OllamaTimeout is raised
+    instead of holding the caller's thread forever. With `hedge_percentile`
+    set, a non-streaming request that hasn't answered after that latency
+    percentile of the model's recent requests is also sent to the next host;
+    the first answer wins.
+
+    The pool exposes `chat(**kwargs)` with the same signature as
+    ollama.Client.chat, so it can stand in for a single client. `keep_alive`
+    is sent with every request that doesn't set its own, so ordinary traffic
+    doesn't shorten the residency the warm-up asked for. `model_options`
+    ({model: {"num_ctx": ...}}) is merged under every request's `options` for
+    that model: Ollama reloads the runner whenever num_ctx changes, so all
+    calls to one model must agree on it.
+    """
+
+    def __init__(self, hosts: List[str], model_routes: Dict[str, List[str]] = None,
+                 health_interval: float = 30, client_factory: Callable[..., Any] = ollama.Client,
+                 keep_alive: Any = None, breaker_failures: int = 3, breaker_reset: float = 30,
+                 hedge_percentile: float = 0, hedge_min_samples: int = 20, hedge_workers: int = 16,
+                 model_options: Dict[str, Dict[str, Any]] = None, **client_kwargs):
+        if not hosts:
+            raise ValueError("OllamaPool needs at least one host")
+        self.backends: List[OllamaBackend] = [
+            OllamaBackend(h, client_factory=client_factory,
+                          breaker=CircuitBreaker(breaker_failures, breaker_reset), **client_kwargs)
+            for h in dict.fromkeys(hosts)
+        ]
+        self.model_routes = {_normalize_model(m): set(h) for m, h in (model_routes or {}).items() if h}
+        self.health_interval = health_interval
+        self.keep_alive = keep_alive
+        self.model_options = {_normalize_model(m): dict(o) for m, o in (model_options or {}).items() if o}
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_workers = hedge_workers
+        self._latency: Dict[str, LatencyStats] = {}
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._health_thread: Optional[threading.Thread] = None
+
+    def start_health_checks(self):
+        with self._lock:
+            if self._health_thread is not None or self.health_interval <= 0:
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, name="ollama-health",
+                                                   daemon=True)
+            self._health_thread.start()
+
+    def check_health(self):
+        for backend in self.backends:
+            was_healthy = backend.healthy
+            healthy = backend.probe()
+            if healthy != was_healthy:
+                logger.info(f"Ollama host {backend.host} is now {'healthy' if healthy else 'unhealthy'}")
+
+    def _health_loop(self):
+        while True:
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"Ollama health check error: {e}")
+            time.sleep(self.health_interval)
+
+    def candidates(self, model: str) -> List[OllamaBackend]:
+        """Backends able to serve `model`, best first. Hosts with an open breaker are left out."""
+        allowed = self.model_routes.get(_normalize_model(model))
+        with self._lock:
+            eligible = [b for b in self.backends
+                        if (allowed is None or b.host in allowed) and b.serves(model) and b.breaker.available()]
+            healthy = [b for b in eligible if b.healthy]
+            # If every host looks down, try them anyway: one may have just come back
+            pool = healthy or eligible
+            return sorted(pool, key=lambda b: b.outstanding)
+
+    def _acquire(self, backend: OllamaBackend) -> bool:
+        if not backend.breaker.acquire():
+            return False
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+        return True
+
+    def _release(self, backend: OllamaBackend, error: Exception = None, cancelled: bool = False):
+        with self._lock:
+            backend.outstanding -= 1
+            if error is not None:
+                backend.failures += 1
+                backend.last_error = str(error)
+                if is_connection_error(error):
+                    backend.healthy = False
+        if cancelled:
+            # Says nothing about the host (a half-open breaker must not close on it)
+            backend.breaker.release()
+        # Only "host unreachable / hung" trips the breaker; an error reply means the host is up
+        elif error is not None and (is_connection_error(error) or is_timeout(error)):
+            backend.breaker.record_failure()
+        else:
+            backend.breaker.record_success()
+
+    def _stats(self, model: str) -> LatencyStats:
+        with self._lock:
+            return self._latency.setdefault(_normalize_model(model), LatencyStats())
+
+    def _attempt(self, backend: OllamaBackend, model: str, timeout: Optional[float], kwargs: Dict[str, Any],
+                 token: CancelToken = None):
+        """
+        One request to an acquired backend, with accounting. With a cancel
+        token the reply is streamed and assembled here, so a cancel can drop
+        the connection between chunks (Ollama stops generating when the client
+        goes away) instead of waiting for the whole generation.
+        """
+        start = time.perf_counter()
+        try:
+            if token is None:
+                response = backend.client_for(timeout).chat(model=model, **kwargs)
+            else:
+                response = self._collect(backend, model, timeout, kwargs, token)
+        except JobCancelled:
+            self._release(backend, cancelled=True)
+            OLLAMA_ERRORS.inc(host=backend.host, model=model, kind="cancelled")
+            raise
+        except Exception as e:
+            self._release(backend, e)
+            OLLAMA_ERRORS.inc(host=backend.host, model=model, kind=error_kind(e))
+            if is_timeout(e):
+                self._stats(model).timeouts += 1
+                raise OllamaTimeout(f"Ollama host {backend.host} did not answer {model} within {timeout}s") from e
+            raise
+        self._release(backend)
+        elapsed = time.perf_counter() - start
+        self._stats(model).samples.append(elapsed)
+        OLLAMA_LATENCY.observe(elapsed, host=backend.host, model=model)
+        return response
+
+    def _collect(self, backend: OllamaBackend, model: str, timeout: Optional[float], kwargs: Dict[str, Any],
+                 token: CancelToken) -> Dict[str, Any]:
+        """Stream a chat reply and assemble it into the non-streaming shape, checking `token` per chunk."""
+        token.raise_if_cancelled()
+        deadline = time.monotonic() + timeout if timeout else None
+        stream = backend.client_for(timeout).chat(model=model, **dict(kwargs, stream=True))
+        parts = []
+        try:
+            for chunk in stream:
+                token.raise_if_cancelled()
+                if deadline is not None and time.monotonic() > deadline:
+                    raise OllamaTimeout(f"Ollama host {backend.host} did not finish {model} within {timeout}s")
+                parts.append(chunk['message']['content'] or "")
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        return {"model": model, "message": {"role": "assistant", "content": "".join(parts)}, "done": True}
+
+    def chat(self, model: str, timeout: Optional[float] = None, **kwargs):
+        """
+        Chat on the best available host. Inside a cancellable job (see
+        backend.cancellation) the call is aborted once the job is cancelled.
+        """
+        self.start_health_checks()
+        if self.keep_alive is not None:
+            kwargs.setdefault("keep_alive", self.keep_alive)
+        defaults = self.options_for(model)
+        if defaults:
+            kwargs["options"] = dict(defaults, **(kwargs.get("options") or {}))
+        token = current_token()
+        if kwargs.get("stream"):
+            return self._chat_stream(model, timeout, kwargs, token)
+
+        candidates = self.candidates(model)
+        hedge_after = self._hedge_delay(model)
+        if hedge_after is not None and len(candidates) > 1:
+            return self._chat_hedged(model, candidates, timeout, hedge_after, kwargs, token)
+
+        last_error: Optional[Exception] = None
+        for backend in candidates:
+            if not self._acquire(backend):
+                continue
+            try:
+                return self._attempt(backend, model, timeout, kwargs, token)
+            except Exception as e:
+                if not is_connection_error(e):
+                    raise
+                logger.warning(f"Ollama host {backend.host} unreachable, failing over: {e}")
+                last_error = e
+
+        raise NoBackendAvailable(f"No Ollama host available for model {model}: {last_error or 'circuit open'}")
+
+    def options_for(self, model: str) -> Dict[str, Any]:
+        """Options every request for `model` carries (num_ctx, ...)."""
+        return dict(self.model_options.get(_normalize_model(model), {}))
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        if self.hedge_percentile <= 0:
+            return None
+        stats = self._stats(model)
+        if len(stats.samples) < self.hedge_min_samples:
+            return None
+        return stats.percentile(self.hedge_percentile)
+
+    def _chat_hedged(self, model: str, candidates: List[OllamaBackend], timeout: Optional[float],
+                     hedge_after: float, kwargs: Dict[str, Any], token: CancelToken = None):
+        """
+        Send to the best backend; if it hasn't answered after `hedge_after`
+        seconds (or failed to connect), also send to the next one and return
+        whichever answers first. Each attempt streams under its own child
+        token, so the slower one is aborted once the other answers (or when
+        the job is cancelled).
+        """
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=self.hedge_workers,
+                                                          thread_name_prefix="ollama-hedge")
+            executor = self._hedge_executor
+
+        remaining = list(candidates)
+        futures = {}
+        tokens = {}
+
+        def launch() -> bool:
+            while remaining:
+                backend = remaining.pop(0)
+                if self._acquire(backend):
+                    attempt_token = token.child() if token is not None else CancelToken()
+                    future = executor.submit(self._attempt, backend, model, timeout, kwargs, attempt_token)
+                    futures[future] = backend
+                    tokens[future] = attempt_token
+                    return True
+            return False
+
+        def abort_others(winner=None):
+            for future, attempt_token in tokens.items():
+                if future is not winner:
+                    attempt_token.cancel("hedge lost")
+
+        if not launch():
+            raise NoBackendAvailable(f"No Ollama host available for model {model}")
+        primary = next(iter(futures))
+        done, _ = wait([primary], timeout=hedge_after)
+        if not done or (primary.exception() is not None and is_connection_error(primary.exception())):
+            if launch():
+                self._stats(model).hedged += 1
+                logger.info(f"Hedging {model} request to {futures[list(futures)[-1]].host} "
+                            f"after {hedge_after:.1f}s")
+
+        last_error: Optional[BaseException] = None
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is not primary:
+                            self._stats(model).hedge_wins += 1
+                        abort_others(future)
+                        return future.result()
+                    last_error = future.exception()
+        finally:
+            # Also covers this thread being interrupted: don't leave attempts generating
+            abort_others()
+        raise last_error
+
+    def _chat_stream(self, model: str, timeout: Optional[float], kwargs: Dict[str, Any],
+                     token: CancelToken = None) -> Iterator[Any]:
+        """
+        Streaming variant: fails over only if no chunk has been produced yet.
+        `timeout` bounds both the gap between chunks and the whole stream;
+        a cancelled `token` stops it at the next chunk.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        last_error: Optional[Exception] = None
+        for backend in self.candidates(model):
+            if not self._acquire(backend):
+                continue
+            started = False
+            error = None
+            cancelled = False
+            start = time.perf_counter()
+            stream = None
+            try:
+                stream = backend.client_for(timeout).chat(model=model, **kwargs)
+                for chunk in stream:
+                    started = True
+                    if token is not None:
+                        token.raise_if_cancelled()
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise OllamaTimeout(f"Ollama host {backend.host} did not finish {model} "
+                                            f"within {timeout}s")
+                    yield chunk
+            except JobCancelled:
+                cancelled = True
+                OLLAMA_ERRORS.inc(host=backend.host, model=model, kind="cancelled")
+                raise
+            except Exception as e:
+                error = e
+                OLLAMA_ERRORS.inc(host=backend.host, model=model, kind=error_kind(e))
+                if is_timeout(e):
+                    self._stats(model).timeouts += 1
+                    if not isinstance(e, OllamaTimeout):
+                        raise OllamaTimeout(f"Ollama host {backend.host} stalled streaming {model}") from e
+                    raise
+                if started or not is_connection_error(e):
+                    raise
+                logger.warning(f"Ollama host {backend.host} unreachable, failing over: {e}")
+                last_error = e
+                continue
+            finally:
+                # Also runs if the consumer stops iterating early (or the job was cancelled):
+                # closing the response drops the connection and Ollama stops generating
+                close = getattr(stream, "close", None)
+                if close is not None:
+                    close()
+                self._release(backend, error, cancelled=cancelled)
+            elapsed = time.perf_counter() - start
+            self._stats(model).samples.append(elapsed)
+            OLLAMA_LATENCY.observe(elapsed, host=backend.host, model=model)
+            return
+
+        raise NoBackendAvailable(f"No Ollama host available for model {model}: {last_error or 'circuit open'}")
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [b.status() for b in self.backends]
+
+    def latency_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {model: stats.status() for model, stats in self._latency.items()}
@@ -0,0 +1,140 @@
+import json
+import logging
+from typing import Any, Callable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Frame:
+    __slots__ = ("kind", "path", "start", "key", "index", "expecting_key")
+
+    def __init__(self, kind: str, path: tuple, start: int):
+        self.kind = kind          # 'object' or 'array'
+        self.path = path
+        self.start = start
+        self.key: Optional[str] = None
+        self.index = 0
+        self.expecting_key = kind == "object"
+
+    def child_path(self) -> tuple:
+        return self.path + ((self.key,) if self.kind == "object" else (self.index,))
+
+
+class IncrementalJSONParser:
+    """
+    Incremental scanner for a JSON object arriving in chunks (e.g. an LLM token stream).
+
+    It does not build the document itself; it tracks nesting and string state
+    so that, as soon as a value at a watched path is closed, that value's text
+    is decoded and handed to `on_value(path, value)`. Paths are dotted keys
+    ("summary", "plan.medications"). With no `watch` list every top-level key
+    is reported. Anything before the first '{' (e.g. a markdown fence) is ignored.
+    """
+
+    def __init__(self, on_value: Callable[[str, Any], None], watch: Iterable[str] = None):
+        self.on_value = on_value
+        self.watch = set(watch) if watch else None
+        self._text = ""
+        self._pos = 0
+        self._stack: List[_Frame] = []
+        self._in_string = False
+        self._string_start = 0
+        self._string_is_key = False
+        self._escape = False
+        self._primitive_start: Optional[int] = None
+        self._done = False
+        self.emitted: List[str] = []
+
+    def feed(self, chunk: str):
+        if not chunk or self._done:
+            return
+        self._text += chunk
+        text = self._text
+        while self._pos < len(text) and not self._done:
+            self._step(text[self._pos])
+            self._pos += 1
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def _step(self, ch: str):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                frame = self._stack[-1]
+                raw = self._text[self._string_start:self._pos + 1]
+                if self._string_is_key:
+                    frame.key = self._decode(raw)
+                else:
+                    self._complete(frame.child_path(), self._string_start, self._pos + 1)
+            return
+
+        if not self._stack:
+            # Skip preamble until the root object opens
+            if ch == "{":
+                self._stack.append(_Frame("object", (), self._pos))
+            return
+
+        frame = self._stack[-1]
+
+        if self._primitive_start is not None and (ch in ",}]" or ch.isspace()):
+            self._complete(frame.child_path(), self._primitive_start, self._pos)
+            self._primitive_start = None
+
+        if ch.isspace():
+            return
+        if ch == '"':
+            self._in_string = True
+            self._string_start = self._pos
+            self._string_is_key = frame.kind == "object" and frame.expecting_key
+        elif ch in "{[":
+            self._stack.append(_Frame("object" if ch == "{" else "array", frame.child_path(), self._pos))
+        elif ch in "}]":
+            closed = self._stack.pop()
+            if not self._stack:
+                self._done = True
+                return
+            self._complete(closed.path, closed.start, self._pos + 1)
+        elif ch == ":":
+            frame.expecting_key = False
+        elif ch == ",":
+            if frame.kind == "object":
+                frame.expecting_key = True
+                frame.key = None
+            else:
+                frame.index += 1
+        elif self._primitive_start is None:
+            self._primitive_start = self._pos
+
+    def _complete(self, path: tuple, start: int, end: int):
+        if not path:
+            return
+        dotted = ".".join(str(p) for p in path)
+        if self.watch is None:
+            if len(path) != 1:
+                return
+        elif dotted not in self.watch:
+            return
+        value = self._decode(self._text[start:end])
+        if value is _INVALID:
+            return
+        self.emitted.append(dotted)
+        try:
+            self.on_value(dotted, value)
+        except Exception as e:
+            logger.error(f"Partial JSON callback failed for '{dotted}': {e}")
+
+    @staticmethod
+    def _decode(raw: str):
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return _INVALID
+
+
+_INVALID = object()
@@ -0,0 +1,67 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Stages in pipeline order, for stable output; unknown stages are listed after these
+STAGES = ("upload", "queue_wait", "ocr", "vision_fallback", "classify", "analysis", "persist",
+          "broadcast", "total")
+
+
+class StageTimer:
+    """
+    Accumulates wall-clock seconds per pipeline stage into `timings`, a plain
+    dict so it can travel in the job payload between stages (and survive a
+    restart). Stages that run on several threads at once (the vision fallback
+    of a multi-page document) add up their time, so they can exceed the wall
+    clock of the stage around them.
+    """
+
+    def __init__(self, timings: Dict[str, float] = None):
+        self.timings = timings if timings is not None else {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + max(0.0, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+def timed(timer: Optional[StageTimer], stage: str):
+    """`with timed(timer, "ocr"):` that is a no-op when there's no timer."""
+    return timer.stage(stage) if timer is not None else nullcontext()
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))]
+
+
+def summarize_timings(rows: List[Tuple[str, float]]) -> Dict[str, Dict[str, Any]]:
+    """(stage, seconds) rows -> per-stage count, mean and p50/p95/p99 in milliseconds."""
+    by_stage: Dict[str, List[float]] = {}
+    for stage, seconds in rows:
+        by_stage.setdefault(stage, []).append(seconds)
+
+    order = [s for s in STAGES if s in by_stage] + sorted(s for s in by_stage if s not in STAGES)
+    summary = {}
+    for stage in order:
+        values = sorted(by_stage[stage])
+        summary[stage] = {
+            "count": len(values),
+            "mean_ms": round(sum(values) / len(values) * 1000, 1),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+    return summary
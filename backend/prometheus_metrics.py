@@ -0,0 +1,248 @@
+import bisect
+import os
+import sqlite3
+import threading
+import time
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import psutil  # optional; /proc is used when it's missing
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+logger = logging.getLogger(__name__)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OLLAMA_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+SQLITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """
+    Minimal Prometheus metric: values keyed by label tuple, guarded by a lock.
+    Updates are a dict lookup and an addition, cheap enough for every request
+    and every SQLite query.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(_Metric):
+    """
+    Gauge whose value is either set() or read at scrape time from `collect`,
+    which returns a number, or a {label tuple: number} dict for labelled gauges.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 collect: Callable[[], Any] = None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> Iterator[Sample]:
+        if self.collect is not None:
+            try:
+                value = self.collect()
+            except Exception as e:
+                logger.debug(f"Collecting {self.name} failed: {e}")
+                return
+            if value is None:
+                return
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(tuple(key)), value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (the last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", dict(labels, le=_format_value(bound)), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    rendered = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{rendered}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(Counter(
+    "megi_http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status")))
+HTTP_LATENCY = registry.register(Histogram(
+    "megi_http_request_duration_seconds", "HTTP request latency until the response starts.", ("method", "route")))
+OLLAMA_LATENCY = registry.register(Histogram(
+    "megi_ollama_request_duration_seconds", "Successful Ollama chat calls.", ("host", "model"),
+    buckets=OLLAMA_BUCKETS))
+OLLAMA_ERRORS = registry.register(Counter(
+    "megi_ollama_errors_total", "Failed Ollama chat calls by kind (connection, timeout, error, cancelled).",
+    ("host", "model", "kind")))
+PIPELINE_QUEUE_WAIT = registry.register(Histogram(
+    "megi_pipeline_queue_wait_seconds", "Time a job waited in a stage queue before a worker took it.",
+    ("stage", "priority"), buckets=OLLAMA_BUCKETS))
+PIPELINE_JOB_DURATION = registry.register(Histogram(
+    "megi_pipeline_job_duration_seconds", "Submission to completion of a pipeline job.",
+    ("priority", "outcome"), buckets=OLLAMA_BUCKETS))
+DUPLICATE_UPLOADS = registry.register(Counter(
+    "megi_duplicate_uploads_total", "Uploads answered with an existing consultation.", ("match",)))
+SQLITE_LATENCY = registry.register(Histogram(
+    "megi_sqlite_query_duration_seconds", "SQLite statement latency by statement type.", ("operation",),
+    buckets=SQLITE_BUCKETS))
+
+
+# ─── Process ─────────────────────────────────────────────────
+
+def _resident_memory_bytes() -> Optional[float]:
+    if HAS_PSUTIL:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+registry.register(Gauge("megi_process_resident_memory_bytes", "Resident set size of the server process.",
+                        collect=_resident_memory_bytes))
+registry.register(Gauge("megi_process_cpu_seconds_total", "User + system CPU time of the server process.",
+                        collect=lambda: sum(os.times()[:2])))
+_started = time.time()
+registry.register(Gauge("megi_process_start_time_seconds", "Process start time (epoch seconds).",
+                        collect=lambda: _started))
+
+
+# ─── SQLite ──────────────────────────────────────────────────
+
+_SQL_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "CREATE", "ALTER", "PRAGMA", "DROP"}
+
+
+def _operation(sql: str) -> str:
+    head = sql.lstrip().split(None, 1)
+    keyword = head[0].upper() if head else ""
+    return keyword if keyword in _SQL_OPERATIONS else "OTHER"
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQLITE_LATENCY.observe(time.perf_counter() - start, operation=_operation(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQLITE_LATENCY.observe(time.perf_counter() - start, operation=_operation(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection factory that times every statement (sqlite3.connect(..., factory=TimedConnection))."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
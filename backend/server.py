@@ -2,9 +2,12 @@ import os
 import shutil
 import json
 import threading
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Depends, WebSocket, WebSocketDisconnect
+import time
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Depends, WebSocket, WebSocketDisconnect, Request
 from fastapi.responses import HTMLResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
+from starlette.routing import Match
 from datetime import datetime
 import logging
 import asyncio
@@ -13,13 +16,27 @@ from pydantic import BaseModel
 from database.db_manager import DBManager
 from backend.session_manager import session_manager
 from backend.document_generator import MedicalDocumentGenerator
+from backend.engine_registry import engine_registry
+from backend.model_warmup import model_warmup
+from backend.job_scheduler import JobScheduler, PipelineJob, QueueFullError, normalize_priority
+from backend.cancellation import check_cancelled
+from backend.correction_index import CorrectionIndex
+from backend.pipeline_metrics import StageTimer, timed, summarize_timings
+from backend.lazy_import import lazy_import, is_available, preload, import_stats
+from backend import prometheus_metrics
+from backend.prometheus_metrics import Gauge, TimedConnection, HTTP_REQUESTS, HTTP_LATENCY, DUPLICATE_UPLOADS
+from backend.upload_dedup import UploadDeduplicator
+from config import config
+
+# Heavy modules load on first use (or in the startup warm-up), not at import
+cv2 = lazy_import("cv2")  # camera capture
+fitz = lazy_import("fitz")  # PyMuPDF, only needed to rasterize PDF uploads
+HAS_PYMUPDF = is_available("fitz")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-import cv2
-
 app = FastAPI()
 
 # Capture the event loop at startup for thread-safe broadcasts
@@ -29,6 +46,43 @@ global_loop = None
 async def startup_event():
     global global_loop
     global_loop = asyncio.get_running_loop()
+    # Load EasyOCR + Ollama clients off the request path
+    engine_registry.warm_up()
+    # Camera and PDF support are imported in the background instead of on first use
+    preload([cv2] + ([fitz] if HAS_PYMUPDF else []))
+    # Preload the Ollama models and keep them resident during clinic hours
+    if config.WARMUP_ENABLED:
+        model_warmup.start()
+    # Resume jobs a previous run left queued or half-processed
+    scheduler.recover()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    model_warmup.stop()
+
+def _route_template(request: Request) -> str:
+    """Path template ("/api/patients/{patient_id}") so metrics don't get a label per id."""
+    route = request.scope.get("route")
+    if route is None:
+        for candidate in app.router.routes:
+            if candidate.matches(request.scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", None) or "unmatched"
+
+if config.METRICS_ENABLED:
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = _route_template(request)
+            HTTP_REQUESTS.inc(method=request.method, route=route, status=status)
+            HTTP_LATENCY.observe(time.perf_counter() - start, method=request.method, route=route)
 
 # Directory setup - Use absolute paths
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -46,7 +100,16 @@ logger.info(f"WEB_DIR: {WEB_DIR}")
 app.mount("/static", StaticFiles(directory=WEB_DIR), name="static")
 
 # Database Instance
-db = DBManager()
+db = DBManager(connection_factory=TimedConnection if config.METRICS_ENABLED else None)
+
+# Few-shot examples for the vision model, picked by similarity to the page being read
+correction_index = CorrectionIndex(db, max_examples=config.FEW_SHOT_MAX_EXAMPLES,
+                                   token_budget=config.FEW_SHOT_TOKEN_BUDGET,
+                                   min_score=config.FEW_SHOT_MIN_SCORE)
+
+# Retries / double taps / re-captures answered with the consultation already created
+upload_dedup = UploadDeduplicator(db, window_seconds=config.DUPLICATE_WINDOW_SECONDS,
+                                  max_distance=config.DUPLICATE_MAX_DISTANCE)
 
 # Document Generator
 doc_generator = MedicalDocumentGenerator()
@@ -95,12 +158,17 @@ class PatientUpdate(BaseModel):
 class TextConsultation(BaseModel):
     text: str
     patient_id: Optional[int] = None
+    priority: Optional[str] = None  # urgent / normal / low
+
+class PriorityUpdate(BaseModel):
+    priority: str
 
 class LinkPatient(BaseModel):
     patient_id: int
 
 class RegenerateRequest(BaseModel):
     raw_text: Optional[str] = None
+    fresh: Optional[bool] = False  # bypass cached AI results and sample again
 
 class UserCreate(BaseModel):
     username: str
@@ -356,6 +424,78 @@ async def get_patient_lab_results(patient_id: int, user_id: str = Depends(verify
 
 # ─── Consultations ────────────────────────────────────────────
 
+def _queue_full_exception(e: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"Processing queue is full ({e.pending}/{e.capacity}). Try again shortly.",
+        headers={"Retry-After": "30"}
+    )
+
+
+def _save_upload(file: UploadFile, path: str):
+    with open(path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+
+async def _find_duplicate(paths: List[str], user_id: str, allow_duplicate: bool = False, perceptual: bool = True):
+    """
+    Fingerprint an upload and look for a consultation it duplicates.
+    Returns (fingerprint, duplicate, similar): `duplicate` is a byte-identical
+    upload, answered with the existing consultation; `similar` is a perceptual
+    match, which is processed anyway and only flagged (see _possible_duplicate).
+    All None when deduplication is off.
+    Hashing (and decoding the image for dHash) runs in the threadpool; the
+    lookup doesn't, so there's no await between it and the caller creating
+    the consultation, and two requests can't both miss each other.
+    """
+    if not upload_dedup.enabled:
+        return None, None, None
+    try:
+        fingerprint = await run_in_threadpool(upload_dedup.fingerprint, paths, perceptual=perceptual)
+    except OSError as e:
+        logger.warning(f"Could not fingerprint upload {paths[0]}: {e}")
+        return None, None, None
+    match = None if allow_duplicate else upload_dedup.find(user_id, fingerprint)
+    if match and match['match'] != "exact":
+        return fingerprint, None, match
+    return fingerprint, match, None
+
+
+def _duplicate_response(duplicate: Dict, new_paths: List[str]) -> Dict:
+    """Drop the re-uploaded files and point the client at the existing consultation."""
+    for path in new_paths:
+        if os.path.exists(path) and path != duplicate.get('image_path'):
+            os.remove(path)
+    DUPLICATE_UPLOADS.inc(match=duplicate['match'])
+    logger.info(f"Upload duplicates consultation {duplicate['id']} ({duplicate['match']}, "
+                f"distance {duplicate['distance']}); no new pipeline run")
+    return {"status": "duplicate", "consultation_id": duplicate['id'], "duplicate_of": duplicate['id'],
+            "match": duplicate['match'], "distance": duplicate['distance'],
+            "consultation_status": duplicate.get('status'),
+            "message": "This document was already uploaded; returning the existing consultation."}
+
+
+def _possible_duplicate(similar: Optional[Dict]) -> Dict:
+    """Response fields pointing the client at a consultation the upload resembles."""
+    if not similar:
+        return {}
+    logger.info(f"Upload resembles consultation {similar['id']} (distance {similar['distance']}); "
+                f"processing it anyway")
+    return {"possible_duplicate_of": similar['id'], "distance": similar['distance']}
+
+
+def _store_fingerprint(queued, fingerprint: Optional[Dict]):
+    if fingerprint and isinstance(queued, dict) and queued.get("consultation_id"):
+        db.set_consultation_fingerprint(queued["consultation_id"], **fingerprint)
+
+
+def _parse_priority(value: Optional[str]) -> str:
+    try:
+        return normalize_priority(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 def _flatten_consultation(c: Dict) -> Dict:
     """Flatten a consultation for API response."""
     analysis = c.get('ai_analysis', {}) or {}
@@ -373,6 +513,7 @@ def _flatten_consultation(c: Dict) -> Dict:
         "priority": c.get('priority', 'normal'),
         "summary": analysis.get('summary', ''),
         "confidence_score": analysis.get('confidence_score', 0),
+        "page_count": c.get('page_count') or 1,
         "created_at": c.get('created_at', ''),
         "reviewed_at": c.get('reviewed_at'),
     }
@@ -419,8 +560,11 @@ async def get_consultation_detail(consultation_id: int, user_id: str = Depends(v
             "document_type": c.get('document_type', 'consultation'),
             "status": c.get('status', 'pending'),
             "priority": c.get('priority', 'normal'),
+            "pipeline_mode": c.get('pipeline_mode'),
             "raw_text": c.get('raw_text', ''),
             "image_path": c.get('image_path', ''),
+            "page_count": c.get('page_count') or 1,
+            "pages": db.get_pages(consultation_id) if (c.get('page_count') or 1) > 1 else [],
             "ai_analysis": analysis,
             "prescriptions": prescriptions,
             "created_at": c.get('created_at', ''),
@@ -435,22 +579,26 @@ async def get_consultation_detail(consultation_id: int, user_id: str = Depends(v
 @app.post("/api/consultations/text")
 async def create_text_consultation(data: TextConsultation, user_id: str = Depends(verify_user_and_pin)):
     try:
+        priority = _parse_priority(data.priority)
         consultation_id = db.add_consultation(
             user_id=user_id,
             patient_id=data.patient_id,
-            raw_text=data.text
+            raw_text=data.text,
+            priority=priority
         )
         if consultation_id < 0:
             raise HTTPException(status_code=500, detail="Failed to create consultation")
 
-        # Process in background
-        def process():
-            _process_text_consultation(consultation_id, data.text, user_id, data.patient_id)
-
-        thread = threading.Thread(target=process, daemon=True)
-        thread.start()
-
-        return {"status": "success", "consultation_id": consultation_id, "message": "Consultation created and processing started."}
+        try:
+            position = scheduler.submit(PipelineJob(consultation_id, user_id, patient_id=data.patient_id,
+                                                    text=data.text, pipeline_mode=config.PIPELINE_MODE,
+                                                    priority=priority))
+        except QueueFullError as e:
+            db.delete_consultation(consultation_id)
+            raise _queue_full_exception(e)
+
+        return {"status": "success", "consultation_id": consultation_id, "queue_position": position,
+                "message": "Consultation created and queued for processing."}
     except HTTPException:
         raise
     except Exception as e:
@@ -463,6 +611,8 @@ async def delete_consultation(consultation_id: int, user_id: str = Depends(verif
         c = db.get_consultation_by_id(consultation_id, user_id=user_id)
         if not c:
             raise HTTPException(status_code=404, detail="Consultation not found or unauthorized")
+        # Stop its pipeline job first, so nothing writes results for the deleted row
+        scheduler.cancel(consultation_id, reason="deleted")
         success = db.delete_consultation(consultation_id)
         if success:
             return {"status": "success", "message": "Consultation deleted"}
@@ -486,25 +636,51 @@ async def regenerate_consultation(consultation_id: int, data: RegenerateRequest,
             raise HTTPException(status_code=400, detail="No text available for regeneration")
 
         if data.raw_text:
+            # An edited transcription of an image is a learning example for future OCR
+            if c.get('image_path') and data.raw_text != c.get('raw_text'):
+                db.save_correction(c['image_path'], data.raw_text)
             db.update_consultation_text(consultation_id, raw_text)
 
         db.update_consultation_status(consultation_id, 'processing')
 
-        patient_id = c.get('patient_id')
-
-        def process():
-            _process_text_consultation(consultation_id, raw_text, user_id, patient_id, is_regeneration=True)
-
-        thread = threading.Thread(target=process, daemon=True)
-        thread.start()
-
-        return {"status": "success", "message": "Consultation queued for regeneration"}
+        try:
+            # Supersede any earlier regeneration still queued or running: only the latest text is analyzed
+            position = scheduler.submit(PipelineJob(consultation_id, user_id, patient_id=c.get('patient_id'),
+                                                    text=raw_text, fresh=bool(data.fresh),
+                                                    pipeline_mode=config.PIPELINE_MODE,
+                                                    priority=c.get('priority') or 'normal'),
+                                        supersede=True)
+        except QueueFullError as e:
+            db.update_consultation_status(consultation_id, c.get('status', 'pending'))
+            raise _queue_full_exception(e)
+
+        return {"status": "success", "queue_position": position, "message": "Consultation queued for regeneration"}
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error regenerating consultation {consultation_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.put("/api/consultations/{consultation_id}/priority")
+async def set_consultation_priority(consultation_id: int, data: PriorityUpdate,
+                                    user_id: str = Depends(verify_user_and_pin)):
+    """Change a consultation's priority; a job still queued or running moves in its queue right away."""
+    try:
+        priority = _parse_priority(data.priority)
+        c = db.get_consultation_by_id(consultation_id, user_id=user_id)
+        if not c:
+            raise HTTPException(status_code=404, detail="Consultation not found or unauthorized")
+        if not db.update_consultation_priority(consultation_id, priority):
+            raise HTTPException(status_code=500, detail="Failed to update priority")
+        queued = scheduler.reprioritize(consultation_id, priority)
+        return {"status": "success", "priority": priority, "queued": queued,
+                "queue": scheduler.queue_depth()["stages"]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error updating priority of consultation {consultation_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/consultations/{consultation_id}/review")
 async def review_consultation(consultation_id: int, user_id: str = Depends(verify_user_and_pin)):
     try:
@@ -611,26 +787,123 @@ async def download_prescription(consultation_id: int, user_id: str = Depends(ver
 # ─── Upload & Capture ────────────────────────────────────────
 
 @app.post("/api/upload")
-async def upload_image(file: UploadFile = File(...), user_id: str = Depends(verify_user_and_pin)):
+async def upload_image(file: UploadFile = File(...), priority: Optional[str] = None,
+                       allow_duplicate: bool = False, user_id: str = Depends(verify_user_and_pin)):
     try:
+        priority = _parse_priority(priority)
         timestamp = int(datetime.now().timestamp())
         filename = f"mobile_capture_{timestamp}.jpg"
         file_path = os.path.join(CAPTURES_DIR, filename)
 
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        write_start = time.perf_counter()
+        await run_in_threadpool(_save_upload, file, file_path)
+        upload_seconds = time.perf_counter() - write_start
 
         logger.info(f"File uploaded from mobile: {file_path} by user {user_id}")
 
         abs_file_path = os.path.abspath(file_path)
-        if on_upload_callback:
-            on_upload_callback(abs_file_path, user_id)
+        fingerprint, duplicate, similar = await _find_duplicate([abs_file_path], user_id, allow_duplicate)
+        if duplicate:
+            return dict(_duplicate_response(duplicate, [abs_file_path]), filename=filename)
 
-        return {"status": "success", "filename": filename, "message": "Image uploaded and processing started."}
+        queued = None
+        if on_upload_callback:
+            queued = on_upload_callback(abs_file_path, user_id, priority=priority)
+            _store_fingerprint(queued, fingerprint)
+
+        response = {"status": "success", "filename": filename, "message": "Image uploaded and processing started.",
+                    **_possible_duplicate(similar)}
+        if isinstance(queued, dict):
+            response.update(queued)
+            if queued.get("consultation_id"):
+                db.add_consultation_timings(queued["consultation_id"], {"upload": upload_seconds})
+        return response
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        raise _queue_full_exception(e)
     except Exception as e:
         logger.error(f"Upload failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _rasterize_pdf(pdf_path: str, prefix: str) -> List[str]:
+    """Render each PDF page to a PNG in CAPTURES_DIR; returns the image paths."""
+    if not HAS_PYMUPDF:
+        raise HTTPException(status_code=415, detail="PDF uploads require PyMuPDF (pip install pymupdf)")
+    paths = []
+    with fitz.open(pdf_path) as pdf:
+        if pdf.page_count > config.UPLOAD_MAX_PAGES:
+            raise HTTPException(status_code=413,
+                                detail=f"Too many pages ({pdf.page_count} > {config.UPLOAD_MAX_PAGES})")
+        for page in pdf:
+            pixmap = page.get_pixmap(dpi=config.PDF_RENDER_DPI)
+            page_path = os.path.join(CAPTURES_DIR, f"{prefix}_p{page.number + 1}.png")
+            pixmap.save(page_path)
+            paths.append(os.path.abspath(page_path))
+    return paths
+
+@app.post("/api/upload/pages")
+async def upload_pages(files: List[UploadFile] = File(...), priority: Optional[str] = None,
+                       allow_duplicate: bool = False, user_id: str = Depends(verify_user_and_pin)):
+    """
+    Upload one document made of several pages: N images (in page order) or
+    PDFs, which are rasterized page by page. All pages become one consultation
+    with a single analysis pass.
+    """
+    priority = _parse_priority(priority)
+    saved = []
+    try:
+        write_start = time.perf_counter()
+        timestamp = int(datetime.now().timestamp())
+        image_paths = []
+        uploaded = []
+        for i, file in enumerate(files):
+            ext = os.path.splitext(file.filename or "")[1].lower() or ".jpg"
+            file_path = os.path.abspath(os.path.join(CAPTURES_DIR, f"mobile_capture_{timestamp}_{i + 1}{ext}"))
+            await run_in_threadpool(_save_upload, file, file_path)
+            saved.append(file_path)
+            uploaded.append(file_path)
+
+            if ext == ".pdf" or file.content_type == "application/pdf":
+                pages = await run_in_threadpool(_rasterize_pdf, file_path, f"mobile_capture_{timestamp}_{i + 1}")
+                saved.extend(pages)
+                image_paths.extend(pages)
+            else:
+                image_paths.append(file_path)
+
+        if not image_paths:
+            raise HTTPException(status_code=400, detail="No pages uploaded")
+        if len(image_paths) > config.UPLOAD_MAX_PAGES:
+            raise HTTPException(status_code=413,
+                                detail=f"Too many pages ({len(image_paths)} > {config.UPLOAD_MAX_PAGES})")
+
+        logger.info(f"{len(image_paths)}-page document uploaded by user {user_id}")
+        upload_seconds = time.perf_counter() - write_start
+        # A multi-page document only matches exactly: documents sharing a cover page aren't the same one
+        fingerprint, duplicate, similar = await _find_duplicate(uploaded, user_id, allow_duplicate,
+                                                                perceptual=uploaded == image_paths)
+        if duplicate:
+            return dict(_duplicate_response(duplicate, saved), pages=len(image_paths))
+
+        queued = process_medical_pages_background(image_paths, user_id, priority=priority)
+        _store_fingerprint(queued, fingerprint)
+        db.add_consultation_timings(queued["consultation_id"], {"upload": upload_seconds})
+
+        response = {"status": "success", "pages": len(image_paths),
+                    "message": "Document uploaded and processing started.", **_possible_duplicate(similar)}
+        response.update(queued)
+        return response
+    except (HTTPException, QueueFullError) as e:
+        for path in saved:
+            if os.path.exists(path):
+                os.remove(path)
+        if isinstance(e, QueueFullError):
+            raise _queue_full_exception(e)
+        raise
+    except Exception as e:
+        logger.error(f"Multi-page upload failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/upload_audio")
 async def upload_audio(file: UploadFile = File(...), user_id: str = Depends(verify_user_and_pin)):
     try:
@@ -706,7 +979,7 @@ async def video_feed():
     return StreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
 
 @app.post("/api/capture_webcam")
-async def capture_webcam(user_id: str = Depends(verify_user_and_pin)):
+async def capture_webcam(allow_duplicate: bool = False, user_id: str = Depends(verify_user_and_pin)):
     try:
         frame = camera_manager.capture_image()
         timestamp = int(datetime.now().timestamp())
@@ -717,11 +990,22 @@ async def capture_webcam(user_id: str = Depends(verify_user_and_pin)):
         logger.info(f"Webcam capture saved: {file_path}")
 
         abs_file_path = os.path.abspath(file_path)
-        if on_upload_callback:
-            on_upload_callback(abs_file_path, user_id)
+        fingerprint, duplicate, similar = await _find_duplicate([abs_file_path], user_id, allow_duplicate)
+        if duplicate:
+            return dict(_duplicate_response(duplicate, [abs_file_path]), filename=filename)
 
-        return {"status": "success", "filename": filename, "file_path": abs_file_path,
-                "message": "Image captured and processing started."}
+        queued = None
+        if on_upload_callback:
+            queued = on_upload_callback(abs_file_path, user_id)
+            _store_fingerprint(queued, fingerprint)
+
+        response = {"status": "success", "filename": filename, "file_path": abs_file_path,
+                    "message": "Image captured and processing started.", **_possible_duplicate(similar)}
+        if isinstance(queued, dict):
+            response.update(queued)
+        return response
+    except QueueFullError as e:
+        raise _queue_full_exception(e)
     except Exception as e:
         logger.error(f"Webcam capture failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -731,7 +1015,49 @@ async def capture_webcam(user_id: str = Depends(verify_user_and_pin)):
 
 @app.get("/api/status")
 async def get_status():
-    return {"status": "running", "service": "MEGI Records - Expedientes Médicos Digitales"}
+    return {
+        "status": "running",
+        "service": "MEGI Records - Expedientes Médicos Digitales",
+        "ai_engine": engine_registry.status(),
+        "models": model_warmup.status(),
+        "imports": import_stats(),
+        "caches": engine_registry.get_engine().cache_stats() if engine_registry.is_ready() else None,
+        "preprocessing": engine_registry.get_engine().preprocessing_stats() if engine_registry.is_ready() else None,
+        "analysis_json": engine_registry.get_engine().json_repair_stats() if engine_registry.is_ready() else None
+    }
+
+@app.get("/metrics")
+async def get_prometheus_metrics():
+    if not config.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Métricas deshabilitadas")
+    return Response(content=prometheus_metrics.registry.render(), media_type=prometheus_metrics.CONTENT_TYPE)
+
+@app.get("/api/queue")
+async def get_queue_status(user_id: str = Depends(verify_user_and_pin)):
+    return scheduler.queue_depth()
+
+@app.get("/api/ai/backends")
+async def get_ai_backends(user_id: str = Depends(verify_user_and_pin)):
+    if not engine_registry.is_ready():
+        return {"ai_engine": engine_registry.status(), "backends": [], "latency": {}}
+    pool = engine_registry.get_engine().pool
+    return {"ai_engine": engine_registry.status(), "backends": pool.status(), "latency": pool.latency_stats()}
+
+@app.get("/api/metrics/pipeline")
+async def get_pipeline_metrics(window_hours: Optional[float] = None, document_type: Optional[str] = None,
+                               vision_fallback: Optional[bool] = None, priority: Optional[str] = None,
+                               user_id: str = Depends(verify_user_and_pin)):
+    """p50/p95/p99 per pipeline stage over the last `window_hours` (queue_wait/total per priority for SLOs)."""
+    window_hours = window_hours or config.PIPELINE_METRICS_WINDOW_HOURS
+    if priority:
+        priority = _parse_priority(priority)
+    rows = db.get_stage_timings(time.time() - window_hours * 3600, document_type=document_type,
+                                vision_fallback=vision_fallback, priority=priority)
+    return {
+        "window_hours": window_hours,
+        "filters": {"document_type": document_type, "vision_fallback": vision_fallback, "priority": priority},
+        "stages": summarize_timings(rows),
+    }
 
 @app.get("/api/stats")
 async def get_stats(user_id: str = Depends(verify_user_and_pin)):
@@ -744,181 +1070,274 @@ async def get_stats(user_id: str = Depends(verify_user_and_pin)):
 
 # ─── Background Processing ───────────────────────────────────
 
-def _process_text_consultation(consultation_id: int, text: str, user_id: str,
-                                patient_id: int = None, is_regeneration: bool = False):
-    """Process a text consultation with AI analysis in background."""
-    try:
-        from backend.ai_manager import AIEngine
-        ai = AIEngine()
-
-        if not is_regeneration:
-            db.update_consultation_status(consultation_id, 'processing')
-
-        broadcast_update_sync(user_id, json.dumps({
-            "type": "consultation_update",
-            "consultation_id": consultation_id,
-            "status": "processing"
-        }))
-
-        # Classify document
-        classification = ai.classify_document(text)
-        doc_type = classification.get('document_type', 'consultation')
-
-        # Full medical analysis
-        analysis = ai.analyze_medical_text(text)
-
-        if 'error' in analysis:
-            db.update_consultation_error(consultation_id, analysis['error'])
-            broadcast_update_sync(user_id, json.dumps({
-                "type": "consultation_update",
-                "consultation_id": consultation_id,
-                "status": "error",
-                "error": analysis['error']
+def _broadcast_consultation(user_id: str, consultation_id: int, status: str, **extra):
+    payload = {
+        "type": "consultation_update",
+        "consultation_id": consultation_id,
+        "status": status
+    }
+    payload.update(extra)
+    broadcast_update_sync(user_id, json.dumps(payload))
+
+
+def _job_timer(job: PipelineJob) -> StageTimer:
+    """Stage timings for this run; they live in the job context so they follow it between stages."""
+    timer = StageTimer(job.context.setdefault('timings', {}))
+    timer.add("queue_wait", time.time() - job.enqueued_at)
+    return timer
+
+
+def _record_timings(job: PipelineJob):
+    timings = job.context.pop('timings', None) or {}
+    timings["total"] = time.time() - job.submitted_at
+    db.add_consultation_timings(job.consultation_id, timings)
+
+
+def _start_job(job: PipelineJob, timer: StageTimer = None):
+    """Mark the consultation as processing the first time a worker picks the job up."""
+    if job.context.get('started'):
+        return
+    job.context['started'] = True
+    db.update_consultation_status(job.consultation_id, 'processing')
+    with timed(timer, "broadcast"):
+        _broadcast_consultation(job.user_id, job.consultation_id, "processing")
+
+
+def _fail_job(job: PipelineJob, error: str):
+    db.update_consultation_error(job.consultation_id, error)
+    _broadcast_consultation(job.user_id, job.consultation_id, "error", error=error)
+    _record_timings(job)
+
+
+def _stage_ocr(job: PipelineJob) -> Optional[str]:
+    """Pipeline stage: extract text from the consultation image."""
+    timer = _job_timer(job)
+    ai = engine_registry.get_engine()
+    _start_job(job, timer)
+
+    with timer.stage("ocr"):
+        if len(job.image_paths) > 1:
+            raw_text = _ocr_pages(ai, job, timer)
+        else:
+            raw_text = ai.extract_text_from_image(job.image_path, select_examples=correction_index.select,
+                                                  timer=timer)
+
+    check_cancelled()
+    if raw_text.startswith("Error"):
+        _fail_job(job, raw_text)
+        return None
+
+    with timer.stage("persist"):
+        db.update_consultation_text(job.consultation_id, raw_text)
+    job.text = raw_text
+    return job.text_stage
+
+
+def _ocr_pages(ai, job: PipelineJob, timer: StageTimer = None) -> str:
+    """OCR every page of a multi-page consultation; returns the pages joined in order."""
+    texts = ai.extract_text_from_pages(job.image_paths, select_examples=correction_index.select, timer=timer)
+    check_cancelled()
+    sections = []
+    for number, text in enumerate(texts, start=1):
+        failed = text.startswith("Error")
+        db.update_page_text(job.consultation_id, number, text, status='error' if failed else 'done')
+        if failed:
+            logger.warning(f"Page {number} of consultation {job.consultation_id} failed: {text}")
+        else:
+            sections.append(f"--- Página {number} ---\n{text}")
+
+    if not sections:
+        return texts[0] if texts else "Error: No pages to process."
+    return "\n\n".join(sections)
+
+
+def _stage_classify(job: PipelineJob) -> Optional[str]:
+    """Pipeline stage: classify the document type."""
+    timer = _job_timer(job)
+    ai = engine_registry.get_engine()
+    _start_job(job, timer)
+
+    with timer.stage("classify"):
+        classification = ai.classify_document(job.text, fresh=job.fresh)
+    job.context['document_type'] = classification.get('document_type', 'consultation')
+    return "analyze"
+
+
+def _stage_analyze(job: PipelineJob) -> Optional[str]:
+    """
+    Pipeline stage: full SOAP analysis, then persist prescriptions and lab results.
+    In single-pass mode this is also where the document type comes from.
+    """
+    timer = _job_timer(job)
+    ai = engine_registry.get_engine()
+    _start_job(job, timer)
+
+    on_section = None
+    if config.STREAM_ANALYSIS:
+        def on_section(section, value):
+            broadcast_update_sync(job.user_id, json.dumps({
+                "type": "consultation_partial",
+                "consultation_id": job.consultation_id,
+                "section": section,
+                "data": value
             }))
-            return
-
-        analysis['document_type'] = doc_type
-        db.update_consultation_analysis(consultation_id, analysis)
-
-        # Extract and save prescriptions
-        if patient_id:
-            prescriptions = ai.extract_prescriptions(analysis)
-            for rx in prescriptions:
-                db.add_prescription(
-                    consultation_id=consultation_id,
-                    patient_id=patient_id,
-                    drug_name=rx.get('drug_name', ''),
-                    dose=rx.get('dose', ''),
-                    frequency=rx.get('frequency', ''),
-                    duration=rx.get('duration', ''),
-                    instructions=rx.get('instructions', '')
-                )
-
-            # Extract and save lab results
-            lab_results = ai.extract_lab_results(analysis)
-            for lab in lab_results:
-                db.add_lab_result(
-                    patient_id=patient_id,
-                    consultation_id=consultation_id,
-                    test_name=lab.get('test_name', ''),
-                    value=lab.get('value', ''),
-                    unit=lab.get('unit', ''),
-                    reference_range=lab.get('reference_range', ''),
-                    is_abnormal=lab.get('is_abnormal', 0)
-                )
-
-        broadcast_update_sync(user_id, json.dumps({
-            "type": "consultation_update",
-            "consultation_id": consultation_id,
-            "status": "processed"
-        }))
-
-        logger.info(f"Consultation {consultation_id} processed successfully.")
-
-    except Exception as e:
-        logger.error(f"Error processing consultation {consultation_id}: {e}")
-        db.update_consultation_error(consultation_id, str(e))
-        broadcast_update_sync(user_id, json.dumps({
-            "type": "consultation_update",
-            "consultation_id": consultation_id,
-            "status": "error",
-            "error": str(e)
-        }))
 
+    with timer.stage("analysis"):
+        analysis = ai.analyze_medical_text(job.text, fresh=job.fresh, on_section=on_section)
+
+    # Deleted or superseded meanwhile: don't write (or fail) a consultation that moved on
+    check_cancelled()
+    if 'error' in analysis:
+        _fail_job(job, analysis['error'])
+        return None
+
+    if job.pipeline_mode == "single":
+        analysis['document_type'] = ai.normalize_document_type(analysis.get('document_type'))
+    else:
+        analysis['document_type'] = job.context.get('document_type', 'consultation')
+    with timer.stage("persist"):
+        _persist_analysis(ai, job, analysis)
+
+    with timer.stage("broadcast"):
+        _broadcast_consultation(job.user_id, job.consultation_id, "processed")
+    _record_timings(job)
+    logger.info(f"Consultation {job.consultation_id} processed successfully.")
+    return None
+
+
+def _persist_analysis(ai, job: PipelineJob, analysis: Dict):
+    """Store the analysis, plus prescriptions and lab results if a patient is linked."""
+    db.update_consultation_analysis(job.consultation_id, analysis, pipeline_mode=job.pipeline_mode)
+
+    if job.patient_id:
+        prescriptions = ai.extract_prescriptions(analysis)
+        for rx in prescriptions:
+            db.add_prescription(
+                consultation_id=job.consultation_id,
+                patient_id=job.patient_id,
+                drug_name=rx.get('drug_name', ''),
+                dose=rx.get('dose', ''),
+                frequency=rx.get('frequency', ''),
+                duration=rx.get('duration', ''),
+                instructions=rx.get('instructions', '')
+            )
+
+        lab_results = ai.extract_lab_results(analysis)
+        for lab in lab_results:
+            db.add_lab_result(
+                patient_id=job.patient_id,
+                consultation_id=job.consultation_id,
+                test_name=lab.get('test_name', ''),
+                value=lab.get('value', ''),
+                unit=lab.get('unit', ''),
+                reference_range=lab.get('reference_range', ''),
+                is_abnormal=lab.get('is_abnormal')
+            )
+
+
+def _on_pipeline_error(job: PipelineJob, error: Exception):
+    logger.error(f"Error processing consultation {job.consultation_id}: {error}")
+    _fail_job(job, str(error))
+
+
+scheduler = JobScheduler(
+    handlers={
+        "ocr": _stage_ocr,
+        "classify": _stage_classify,
+        "analyze": _stage_analyze,
+    },
+    workers={
+        "ocr": config.PIPELINE_OCR_WORKERS,
+        "classify": config.PIPELINE_CLASSIFY_WORKERS,
+        "analyze": config.PIPELINE_ANALYZE_WORKERS,
+    },
+    max_pending=config.PIPELINE_MAX_PENDING,
+    on_error=_on_pipeline_error,
+    store=db,
+    lease_seconds=config.PIPELINE_JOB_LEASE_SECONDS,
+    max_attempts=config.PIPELINE_JOB_MAX_ATTEMPTS,
+    retry_backoff=config.PIPELINE_RETRY_BACKOFF_SECONDS,
+    pipeline_mode=config.PIPELINE_MODE,
+    aging_seconds=config.PIPELINE_PRIORITY_AGING_SECONDS
+)
+
+
+# ─── Prometheus Gauges (read at scrape time) ─────────────────
+
+def _stage_depths(field: str) -> Dict[tuple, int]:
+    return {(stage,): info[field] for stage, info in scheduler.queue_depth()["stages"].items()}
+
+prometheus_metrics.registry.register(Gauge(
+    "megi_websocket_connections", "Open WebSocket connections.",
+    collect=lambda: sum(len(c) for c in list(manager.active_connections.values()))))
+prometheus_metrics.registry.register(Gauge(
+    "megi_pipeline_pending_jobs", "Consultations accepted and not yet finished.",
+    collect=lambda: scheduler.queue_depth()["pending"]))
+prometheus_metrics.registry.register(Gauge(
+    "megi_pipeline_queue_capacity", "Pending consultations accepted before uploads get a 429.",
+    collect=lambda: scheduler.max_pending))
+prometheus_metrics.registry.register(Gauge(
+    "megi_pipeline_queued_jobs", "Jobs waiting per pipeline stage.", ("stage",),
+    collect=lambda: _stage_depths("queued")))
+prometheus_metrics.registry.register(Gauge(
+    "megi_pipeline_running_jobs", "Jobs running per pipeline stage.", ("stage",),
+    collect=lambda: _stage_depths("running")))
+
+
+def process_medical_pages_background(image_paths: List[str], user_id: str, patient_id: int = None,
+                                     priority: str = "normal") -> Dict:
+    """
+    Create one consultation for a multi-page document and queue it: every page
+    is OCR'd, and the pages' text gets a single analysis pass.
+    Raises QueueFullError when the pipeline is saturated.
+    """
+    if len(image_paths) == 1:
+        return process_medical_document_background(image_paths[0], user_id, patient_id=patient_id,
+                                                   priority=priority)
+
+    consultation_id = db.add_consultation(
+        user_id=user_id,
+        patient_id=patient_id,
+        image_path=image_paths[0],
+        priority=priority
+    )
+    if consultation_id < 0 or not db.add_pages(consultation_id, image_paths):
+        if consultation_id >= 0:
+            db.delete_consultation(consultation_id, remove_image=False)
+        raise RuntimeError("Failed to create consultation record")
 
-def process_medical_document_background(image_path: str, user_id: str, patient_id: int = None):
-    """Process a medical document image with OCR + AI analysis. Called from callbacks."""
     try:
-        from backend.ai_manager import AIEngine
-        ai = AIEngine()
-
-        # Create consultation record
-        consultation_id = db.add_consultation(
-            user_id=user_id,
-            patient_id=patient_id,
-            image_path=image_path
-        )
-
-        if consultation_id < 0:
-            logger.error("Failed to create consultation record")
-            return
-
-        db.update_consultation_status(consultation_id, 'processing')
-        broadcast_update_sync(user_id, json.dumps({
-            "type": "consultation_update",
-            "consultation_id": consultation_id,
-            "status": "processing"
-        }))
-
-        # OCR
-        examples = db.get_recent_corrections(limit=3)
-        raw_text = ai.extract_text_from_image(image_path, examples)
-
-        if raw_text.startswith("Error"):
-            db.update_consultation_error(consultation_id, raw_text)
-            broadcast_update_sync(user_id, json.dumps({
-                "type": "consultation_update",
-                "consultation_id": consultation_id,
-                "status": "error",
-                "error": raw_text
-            }))
-            return
+        position = scheduler.submit(PipelineJob(consultation_id, user_id, patient_id=patient_id,
+                                                image_paths=image_paths, pipeline_mode=config.PIPELINE_MODE,
+                                                priority=priority))
+    except QueueFullError:
+        db.delete_consultation(consultation_id, remove_image=False)
+        raise
 
-        db.update_consultation_text(consultation_id, raw_text)
+    return {"consultation_id": consultation_id, "queue_position": position}
 
-        # Classify
-        classification = ai.classify_document(raw_text)
-        doc_type = classification.get('document_type', 'consultation')
 
-        # Full analysis
-        analysis = ai.analyze_medical_text(raw_text)
+def process_medical_document_background(image_path: str, user_id: str, patient_id: int = None,
+                                        priority: str = "normal") -> Dict:
+    """
+    Create a consultation for an uploaded image and queue it for OCR + AI analysis.
+    Can be registered as the upload callback. Raises QueueFullError when the pipeline is saturated.
+    """
+    consultation_id = db.add_consultation(
+        user_id=user_id,
+        patient_id=patient_id,
+        image_path=image_path,
+        priority=priority
+    )
+    if consultation_id < 0:
+        raise RuntimeError("Failed to create consultation record")
 
-        if 'error' in analysis:
-            db.update_consultation_error(consultation_id, analysis['error'])
-            broadcast_update_sync(user_id, json.dumps({
-                "type": "consultation_update",
-                "consultation_id": consultation_id,
-                "status": "error",
-                "error": analysis['error']
-            }))
-            return
-
-        analysis['document_type'] = doc_type
-        db.update_consultation_analysis(consultation_id, analysis)
-
-        # Extract prescriptions and lab results if patient is linked
-        if patient_id:
-            prescriptions = ai.extract_prescriptions(analysis)
-            for rx in prescriptions:
-                db.add_prescription(
-                    consultation_id=consultation_id,
-                    patient_id=patient_id,
-                    drug_name=rx.get('drug_name', ''),
-                    dose=rx.get('dose', ''),
-                    frequency=rx.get('frequency', ''),
-                    duration=rx.get('duration', ''),
-                    instructions=rx.get('instructions', '')
-                )
-
-            lab_results = ai.extract_lab_results(analysis)
-            for lab in lab_results:
-                db.add_lab_result(
-                    patient_id=patient_id,
-                    consultation_id=consultation_id,
-                    test_name=lab.get('test_name', ''),
-                    value=lab.get('value', ''),
-                    unit=lab.get('unit', ''),
-                    reference_range=lab.get('reference_range', ''),
-                    is_abnormal=lab.get('is_abnormal', 0)
-                )
-
-        broadcast_update_sync(user_id, json.dumps({
-            "type": "consultation_update",
-            "consultation_id": consultation_id,
-            "status": "processed"
-        }))
-
-        logger.info(f"Medical document {consultation_id} processed successfully.")
+    try:
+        position = scheduler.submit(PipelineJob(consultation_id, user_id, patient_id=patient_id,
+                                                image_path=image_path, pipeline_mode=config.PIPELINE_MODE,
+                                                priority=priority))
+    except QueueFullError:
+        db.delete_consultation(consultation_id, remove_image=False)
+        raise
 
-    except Exception as e:
-        logger.error(f"Error processing medical document: {e}")
+    return {"consultation_id": consultation_id, "queue_position": position}
@@ -1,6 +1,6 @@
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
-from backend.server import app
+from backend.server import app, set_upload_callback, process_medical_document_background
 import logging
 
 # Configure logging
@@ -17,6 +17,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Without the desktop GUI, uploads go straight to the server's processing queue
+set_upload_callback(process_medical_document_background)
+
 if __name__ == "__main__":
     logger.info("Starting Tauri Backend Server...")
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,72 @@
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from backend.image_preprocessing import dhash, hamming_distance
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(paths: List[str], chunk_size: int = 1 << 20) -> str:
+    """SHA-256 over the bytes of `paths` in order (one file, or every page of a document)."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadDeduplicator:
+    """
+    Finds an existing consultation for an upload that was already received:
+    a mobile retry or a double tap (byte-identical, found via the indexed
+    `content_sha256` column) or, with `max_distance` >= 0, possibly the same
+    page captured twice (perceptual dHash within `max_distance` bits,
+    compared against the user's uploads of the last `window_seconds`, which
+    keeps the scan small). A 64-bit dHash can't tell two patients' reports on
+    the same form apart, so callers only merge "exact" matches. Only
+    consultations of the same user are matched, and failed ones never are,
+    so a re-upload after an error is processed again.
+    """
+
+    def __init__(self, db, window_seconds: float = 600, max_distance: int = -1):
+        self.db = db
+        self.window_seconds = window_seconds
+        self.max_distance = max_distance
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_seconds > 0
+
+    def fingerprint(self, paths: List[str], perceptual: bool = True) -> Dict[str, Optional[str]]:
+        """Exact hash of all files, plus a perceptual hash when `paths` is a single image."""
+        image_hash = dhash(paths[0]) if perceptual and len(paths) == 1 else None
+        return {
+            "content_sha256": file_sha256(paths),
+            "image_dhash": f"{image_hash:016x}" if image_hash is not None else None,
+        }
+
+    def find(self, user_id: str, fingerprint: Dict[str, Optional[str]]) -> Optional[Dict[str, Any]]:
+        """The matching consultation with "match" ("exact"/"perceptual") and "distance", or None."""
+        if not self.enabled:
+            return None
+        since = datetime.now() - timedelta(seconds=self.window_seconds)
+
+        existing = self.db.find_consultation_by_sha256(user_id, fingerprint["content_sha256"], since)
+        if existing:
+            return dict(existing, match="exact", distance=0)
+
+        if fingerprint.get("image_dhash") is None or self.max_distance < 0:
+            return None
+        query = int(fingerprint["image_dhash"], 16)
+        best = None
+        for candidate in self.db.get_recent_image_hashes(user_id, since):
+            try:
+                distance = hamming_distance(query, int(candidate["image_dhash"], 16))
+            except ValueError:
+                continue
+            if distance <= self.max_distance and (best is None or distance < best["distance"]):
+                best = dict(candidate, match="perceptual", distance=distance)
+        return best
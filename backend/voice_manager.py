@@ -1,6 +1,7 @@
 # import whisper
 import os
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -8,17 +9,24 @@ class VoiceManager:
     def __init__(self, model_size="base"):
         self.model_size = model_size
         self.model = None
-        
+        # The warm-up thread and the first voice note may both try to load
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self.model is not None
+
     def load_model(self):
-        if self.model is None:
-            logger.info(f"Loading Whisper model: {self.model_size}...")
-            try:
-                import whisper
-                self.model = whisper.load_model(self.model_size)
-                logger.info("Whisper model loaded successfully.")
-            except Exception as e:
-                logger.error(f"Failed to load Whisper model: {e}")
-                raise e
+        with self._load_lock:
+            if self.model is None:
+                logger.info(f"Loading Whisper model: {self.model_size}...")
+                try:
+                    import whisper
+                    self.model = whisper.load_model(self.model_size)
+                    logger.info("Whisper model loaded successfully.")
+                except Exception as e:
+                    logger.error(f"Failed to load Whisper model: {e}")
+                    raise e
 
     def transcribe(self, audio_path):
         """
@@ -6,8 +6,125 @@ class Config:
     def __init__(self):
         self.SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
         self.OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+        self.OLLAMA_VISION_MODEL = os.getenv("OLLAMA_VISION_MODEL", "qwen3-vl:8b")
+        self.OLLAMA_LOGIC_MODEL = os.getenv("OLLAMA_LOGIC_MODEL", "qwen3:8b")
+        # Comma-separated Ollama hosts for load balancing; vision/logic may be pinned to a subset
+        self.OLLAMA_HOSTS = self._split_list(os.getenv("OLLAMA_HOSTS")) or [self.OLLAMA_HOST]
+        self.OLLAMA_VISION_HOSTS = self._split_list(os.getenv("OLLAMA_VISION_HOSTS"))
+        self.OLLAMA_LOGIC_HOSTS = self._split_list(os.getenv("OLLAMA_LOGIC_HOSTS"))
+        self.OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", 30))
+        # Per-stage deadlines for Ollama calls (seconds); a hung host can't hold a pipeline thread
+        self.OLLAMA_VISION_TIMEOUT = float(os.getenv("OLLAMA_VISION_TIMEOUT", 180))
+        self.OLLAMA_CLASSIFY_TIMEOUT = float(os.getenv("OLLAMA_CLASSIFY_TIMEOUT", 60))
+        self.OLLAMA_ANALYSIS_TIMEOUT = float(os.getenv("OLLAMA_ANALYSIS_TIMEOUT", 300))
+        # Circuit breaker per host: consecutive failures before failing fast, seconds before a retry
+        self.OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", 3))
+        self.OLLAMA_BREAKER_RESET_SECONDS = float(os.getenv("OLLAMA_BREAKER_RESET_SECONDS", 30))
+        # Hedge a slow request to a second host past this latency percentile (0 = off)
+        self.OLLAMA_HEDGE_PERCENTILE = float(os.getenv("OLLAMA_HEDGE_PERCENTILE", 0))
+        self.OLLAMA_HEDGE_MIN_SAMPLES = int(os.getenv("OLLAMA_HEDGE_MIN_SAMPLES", 20))
+        # How long Ollama keeps a model resident after a request ("30m", seconds, -1 = forever)
+        self.OLLAMA_KEEP_ALIVE = self._duration(os.getenv("OLLAMA_KEEP_ALIVE", "30m"))
         self.PIN_CODE = self._generate_pin()
 
+        # AI pipeline scheduling
+        self.PIPELINE_OCR_WORKERS = int(os.getenv("PIPELINE_OCR_WORKERS", 1))
+        self.PIPELINE_CLASSIFY_WORKERS = int(os.getenv("PIPELINE_CLASSIFY_WORKERS", 1))
+        self.PIPELINE_ANALYZE_WORKERS = int(os.getenv("PIPELINE_ANALYZE_WORKERS", 2))
+        self.PIPELINE_MAX_PENDING = int(os.getenv("PIPELINE_MAX_PENDING", 20))
+        self.PIPELINE_JOB_LEASE_SECONDS = float(os.getenv("PIPELINE_JOB_LEASE_SECONDS", 600))
+        self.PIPELINE_JOB_MAX_ATTEMPTS = int(os.getenv("PIPELINE_JOB_MAX_ATTEMPTS", 3))
+        # Delay before retrying a failed stage; doubles with every further attempt
+        self.PIPELINE_RETRY_BACKOFF_SECONDS = float(os.getenv("PIPELINE_RETRY_BACKOFF_SECONDS", 5))
+        # Head start per priority class (urgent > normal > low); also how long a lower class
+        # waits at most behind newer higher-priority work
+        self.PIPELINE_PRIORITY_AGING_SECONDS = float(os.getenv("PIPELINE_PRIORITY_AGING_SECONDS", 300))
+        # "single": document type comes from the SOAP analysis call (one LLM round-trip)
+        # "two_pass": separate classification call before the analysis
+        self.PIPELINE_MODE = os.getenv("PIPELINE_MODE", "single")
+        # Stream the SOAP analysis and push each finished section over the WebSocket
+        self.STREAM_ANALYSIS = os.getenv("STREAM_ANALYSIS", "1") == "1"
+        # Default sliding window for /api/metrics/pipeline percentiles
+        self.PIPELINE_METRICS_WINDOW_HOURS = float(os.getenv("PIPELINE_METRICS_WINDOW_HOURS", 24))
+        # Prometheus /metrics endpoint and the per-request/per-query instrumentation behind it
+        self.METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+        # Image preprocessing before OCR / vision (long edge in pixels, 0 = keep original size)
+        self.OCR_MAX_IMAGE_EDGE = int(os.getenv("OCR_MAX_IMAGE_EDGE", 2048))
+        self.OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "1") == "1"
+        self.OCR_NORMALIZE_CONTRAST = os.getenv("OCR_NORMALIZE_CONTRAST", "1") == "1"
+        self.VISION_MAX_IMAGE_EDGE = int(os.getenv("VISION_MAX_IMAGE_EDGE", 1536))
+        self.VISION_GRAYSCALE = os.getenv("VISION_GRAYSCALE", "0") == "1"
+        self.VISION_NORMALIZE_CONTRAST = os.getenv("VISION_NORMALIZE_CONTRAST", "0") == "1"
+        # Vision request payloads: re-encoded format/quality, model patch size (0 = off), cache size
+        self.VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "jpeg")
+        self.VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", 85))
+        self.VISION_PATCH_SIZE = int(os.getenv("VISION_PATCH_SIZE", 28))
+        self.VISION_PAYLOAD_CACHE_MB = int(os.getenv("VISION_PAYLOAD_CACHE_MB", 32))
+
+        # Below this average EasyOCR confidence the page goes to the vision model
+        self.OCR_CONFIDENCE_THRESHOLD = float(os.getenv("OCR_CONFIDENCE_THRESHOLD", 0.80))
+        # Hybrid fallback: only low-confidence boxes are cropped and sent to the vision model
+        self.OCR_REGION_FALLBACK = os.getenv("OCR_REGION_FALLBACK", "1") == "1"
+        self.OCR_REGION_CONFIDENCE = float(os.getenv("OCR_REGION_CONFIDENCE", 0.80))
+        self.OCR_REGION_MAX_CROPS = int(os.getenv("OCR_REGION_MAX_CROPS", 16))
+        # Above this share of the page, one full-page transcription is cheaper than crops
+        self.OCR_REGION_MAX_AREA = float(os.getenv("OCR_REGION_MAX_AREA", 0.6))
+        self.OCR_REGION_WORKERS = int(os.getenv("OCR_REGION_WORKERS", 4))
+
+        # Multi-page documents: pages OCR'd in parallel, EasyOCR batch size, PDF rasterization
+        self.OCR_PAGE_WORKERS = int(os.getenv("OCR_PAGE_WORKERS", 4))
+        self.OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", 4))
+        self.UPLOAD_MAX_PAGES = int(os.getenv("UPLOAD_MAX_PAGES", 20))
+        self.PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", 200))
+        # Byte-identical uploads (retries, double taps) within this many seconds return the
+        # existing consultation (0 = off)
+        self.DUPLICATE_WINDOW_SECONDS = float(os.getenv("DUPLICATE_WINDOW_SECONDS", 600))
+        # Perceptual match up to N differing dHash bits (-1 = off). Only reported as a possible
+        # duplicate: reports printed on the same form template can hash alike
+        self.DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", -1))
+
+        # Few-shot examples for the vision prompt, retrieved by similarity from past corrections
+        self.FEW_SHOT_MAX_EXAMPLES = int(os.getenv("FEW_SHOT_MAX_EXAMPLES", 3))
+        self.FEW_SHOT_TOKEN_BUDGET = int(os.getenv("FEW_SHOT_TOKEN_BUDGET", 800))
+        self.FEW_SHOT_MIN_SCORE = float(os.getenv("FEW_SHOT_MIN_SCORE", 0.1))
+
+        # SOAP analysis context budget; longer documents are analyzed in chunks and merged
+        self.ANALYSIS_NUM_CTX = int(os.getenv("ANALYSIS_NUM_CTX", 8192))
+        # Context of every vision call. Ollama reloads a model whenever num_ctx changes, so each
+        # model is always called (and warmed up) with one context size
+        self.VISION_NUM_CTX = int(os.getenv("VISION_NUM_CTX", 8192))
+        self.ANALYSIS_RESPONSE_TOKENS = int(os.getenv("ANALYSIS_RESPONSE_TOKENS", 2048))
+        self.ANALYSIS_CHUNK_OVERLAP_TOKENS = int(os.getenv("ANALYSIS_CHUNK_OVERLAP_TOKENS", 64))
+        self.ANALYSIS_CHUNK_WORKERS = int(os.getenv("ANALYSIS_CHUNK_WORKERS", 2))
+
+        # Constrain the analysis to the SOAP JSON schema (needs Ollama >= 0.5; 0 = plain JSON mode)
+        self.ANALYSIS_JSON_SCHEMA = os.getenv("ANALYSIS_JSON_SCHEMA", "1") == "1"
+
+        # Rule-based extraction of vitals/labs/doses before the LLM (its output is merged back)
+        self.PRE_EXTRACT_VALUES = os.getenv("PRE_EXTRACT_VALUES", "1") == "1"
+
+        # Model warm-up: preload at startup, keep-warm pings during clinic hours (local time)
+        self.WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+        self.WARMUP_PING_INTERVAL = float(os.getenv("WARMUP_PING_INTERVAL", 600))
+        self.CLINIC_HOURS = os.getenv("CLINIC_HOURS", "07:00-20:00")
+        self.CLINIC_DAYS = [int(d) for d in self._split_list(os.getenv("CLINIC_DAYS", "0,1,2,3,4,5"))]  # 0 = Monday
+        self.WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "base")
+
+        # Caches
+        self.OCR_CACHE_MAX_MB = int(os.getenv("OCR_CACHE_MAX_MB", 64))
+        self.LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 256))
+        self.LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", 3600))
+
+    @staticmethod
+    def _duration(value):
+        # Ollama takes durations as strings ("30m") or plain seconds
+        return int(value) if value.lstrip("-").isdigit() else value
+
+    @staticmethod
+    def _split_list(value):
+        return [item.strip() for item in value.split(",") if item.strip()] if value else []
+
     def _generate_pin(self):
         """Generates a random 4-digit PIN."""
         return ''.join(random.choices(string.digits, k=4))
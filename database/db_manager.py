@@ -2,6 +2,7 @@ import sqlite3
 import json
 import logging
 import os
+import time
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
@@ -15,12 +16,15 @@ PROJECT_ROOT = os.path.dirname(BASE_DIR)
 DB_NAME = os.path.join(PROJECT_ROOT, "megirecords.db")
 
 class DBManager:
-    def __init__(self, db_name=DB_NAME):
+    def __init__(self, db_name=DB_NAME, connection_factory=None):
         self.db_name = db_name
+        # sqlite3.Connection subclass (e.g. one that times queries for /metrics)
+        self.connection_factory = connection_factory or sqlite3.Connection
+        self._correction_listeners = []
         self.init_db()
 
     def _get_connection(self):
-        return sqlite3.connect(self.db_name)
+        return sqlite3.connect(self.db_name, factory=self.connection_factory)
 
     def init_db(self):
         """Initialize the database with medical tables."""
@@ -116,11 +120,82 @@ class DBManager:
                     )
                 """)
 
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS pages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        consultation_id INTEGER NOT NULL,
+                        page_number INTEGER NOT NULL,
+                        image_path TEXT NOT NULL,
+                        raw_text TEXT,
+                        status TEXT DEFAULT 'pending',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE (consultation_id, page_number),
+                        FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+                    )
+                """)
+
+                # Columns added after the initial schema
+                self._ensure_column(cursor, "consultations", "pipeline_mode", "TEXT")
+                self._ensure_column(cursor, "consultations", "page_count", "INTEGER DEFAULT 1")
+                # Upload fingerprints for duplicate detection: SHA-256 of the file(s) and a
+                # 64-bit perceptual dHash of the image, as hex (too wide for a signed INTEGER)
+                self._ensure_column(cursor, "consultations", "content_sha256", "TEXT")
+                self._ensure_column(cursor, "consultations", "image_dhash", "TEXT")
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_consultations_sha256 ON consultations(user_id, content_sha256)"
+                )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_consultations_user_created ON consultations(user_id, created_at)"
+                )
+
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        consultation_id INTEGER NOT NULL,
+                        user_id TEXT NOT NULL,
+                        patient_id INTEGER,
+                        stage TEXT NOT NULL,
+                        payload TEXT,
+                        status TEXT DEFAULT 'queued',
+                        attempts INTEGER DEFAULT 0,
+                        max_attempts INTEGER DEFAULT 3,
+                        lease_owner TEXT,
+                        lease_expires_at REAL,
+                        last_error TEXT,
+                        created_at REAL,
+                        updated_at REAL,
+                        FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+                    )
+                """)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, lease_expires_at)")
+
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS consultation_timings (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        consultation_id INTEGER NOT NULL,
+                        stage TEXT NOT NULL,
+                        seconds REAL NOT NULL,
+                        recorded_at REAL NOT NULL,
+                        FOREIGN KEY (consultation_id) REFERENCES consultations(id)
+                    )
+                """)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_timings_recorded ON consultation_timings(recorded_at)")
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_timings_consultation ON consultation_timings(consultation_id, stage)"
+                )
+
                 conn.commit()
                 logger.info("Database initialized successfully.")
         except sqlite3.Error as e:
             logger.error(f"Error initializing database: {e}")
 
+    def _ensure_column(self, cursor, table: str, column: str, declaration: str):
+        """Add a column to an existing table if an older database doesn't have it yet."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+            logger.info(f"Added column {table}.{column}")
+
     # ─── User Methods ───────────────────────────────────────────
 
     def create_user(self, username: str, pin: str) -> bool:
@@ -178,7 +253,11 @@ class DBManager:
 
     # ─── Correction Methods ─────────────────────────────────────
 
-    def save_correction(self, image_path: str, corrected_text: str):
+    def add_correction_listener(self, callback):
+        """callback(correction_dict) runs after every save_correction (e.g. to update a retrieval index)."""
+        self._correction_listeners.append(callback)
+
+    def save_correction(self, image_path: str, corrected_text: str) -> int:
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
@@ -187,8 +266,29 @@ class DBManager:
                     (image_path, corrected_text, datetime.now())
                 )
                 conn.commit()
+                correction_id = cursor.lastrowid
         except sqlite3.Error as e:
             logger.error(f"Error saving correction: {e}")
+            return -1
+
+        correction = {"id": correction_id, "image_path": image_path, "corrected_text": corrected_text}
+        for callback in self._correction_listeners:
+            try:
+                callback(correction)
+            except Exception as e:
+                logger.error(f"Correction listener failed: {e}")
+        return correction_id
+
+    def get_all_corrections(self) -> List[Dict[str, Any]]:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id, image_path, corrected_text FROM corrections ORDER BY id ASC")
+                return [{"id": row[0], "image_path": row[1], "corrected_text": row[2]}
+                        for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching corrections: {e}")
+            return []
 
     def get_recent_corrections(self, limit: int = 3) -> List[Dict[str, Any]]:
         try:
@@ -354,15 +454,16 @@ class DBManager:
     # ─── Consultation Methods ───────────────────────────────────
 
     def add_consultation(self, user_id: str, patient_id: int = None, image_path: str = "",
-                         raw_text: str = "", document_type: str = "consultation") -> int:
+                         raw_text: str = "", document_type: str = "consultation",
+                         priority: str = "normal") -> int:
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO consultations (patient_id, user_id, document_type, image_path,
-                        raw_text, status, created_at)
-                    VALUES (?, ?, ?, ?, ?, 'pending', ?)
-                """, (patient_id, user_id, document_type, image_path, raw_text, datetime.now()))
+                        raw_text, status, priority, created_at)
+                    VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
+                """, (patient_id, user_id, document_type, image_path, raw_text, priority, datetime.now()))
                 conn.commit()
                 logger.info(f"Consultation added with ID: {cursor.lastrowid}")
                 return cursor.lastrowid
@@ -443,7 +544,8 @@ class DBManager:
             logger.error(f"Error fetching consultations: {e}")
             return []
 
-    def update_consultation_analysis(self, consultation_id: int, analysis: Dict[str, Any]):
+    def update_consultation_analysis(self, consultation_id: int, analysis: Dict[str, Any],
+                                     pipeline_mode: str = None):
         try:
             doc_type = analysis.get("document_type", "consultation")
             analysis_json = json.dumps(analysis)
@@ -451,9 +553,10 @@ class DBManager:
                 cursor = conn.cursor()
                 cursor.execute("""
                     UPDATE consultations
-                    SET ai_analysis = ?, status = 'processed', document_type = ?
+                    SET ai_analysis = ?, status = 'processed', document_type = ?,
+                        pipeline_mode = COALESCE(?, pipeline_mode)
                     WHERE id = ?
-                """, (analysis_json, doc_type, consultation_id))
+                """, (analysis_json, doc_type, pipeline_mode, consultation_id))
                 conn.commit()
                 logger.info(f"Consultation {consultation_id} updated with analysis.")
         except sqlite3.Error as e:
@@ -471,6 +574,69 @@ class DBManager:
         except sqlite3.Error as e:
             logger.error(f"Error updating consultation status {consultation_id}: {e}")
 
+    def set_consultation_fingerprint(self, consultation_id: int, content_sha256: str = None,
+                                     image_dhash: str = None) -> bool:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "UPDATE consultations SET content_sha256 = ?, image_dhash = ? WHERE id = ?",
+                    (content_sha256, image_dhash, consultation_id)
+                )
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error saving fingerprint of consultation {consultation_id}: {e}")
+            return False
+
+    def find_consultation_by_sha256(self, user_id: str, content_sha256: str,
+                                    since: datetime) -> Optional[Dict[str, Any]]:
+        """Newest consultation of `user_id` created after `since` with this exact content (not failed ones)."""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, status, priority, image_path, created_at FROM consultations
+                    WHERE user_id = ? AND content_sha256 = ? AND created_at >= ? AND status != 'error'
+                    ORDER BY created_at DESC LIMIT 1
+                """, (user_id, content_sha256, since))
+                row = cursor.fetchone()
+                return dict(row) if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error looking up upload hash: {e}")
+            return None
+
+    def get_recent_image_hashes(self, user_id: str, since: datetime, limit: int = 200) -> List[Dict[str, Any]]:
+        """Perceptual hashes of `user_id`'s consultations created after `since`, newest first."""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, status, priority, image_path, image_dhash, created_at FROM consultations
+                    WHERE user_id = ? AND created_at >= ? AND image_dhash IS NOT NULL AND status != 'error'
+                    ORDER BY created_at DESC LIMIT ?
+                """, (user_id, since, limit))
+                return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching recent image hashes: {e}")
+            return []
+
+    def update_consultation_priority(self, consultation_id: int, priority: str) -> bool:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "UPDATE consultations SET priority = ? WHERE id = ?",
+                    (priority, consultation_id)
+                )
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error updating consultation priority {consultation_id}: {e}")
+            return False
+
     def update_consultation_text(self, consultation_id: int, text: str):
         try:
             with self._get_connection() as conn:
@@ -525,27 +691,353 @@ class DBManager:
             logger.error(f"Error linking consultation {consultation_id} to patient {patient_id}: {e}")
             return False
 
-    def delete_consultation(self, consultation_id: int) -> bool:
+    def delete_consultation(self, consultation_id: int, remove_image: bool = True) -> bool:
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT image_path FROM consultations WHERE id = ?", (consultation_id,))
                 row = cursor.fetchone()
+                cursor.execute("SELECT image_path FROM pages WHERE consultation_id = ?", (consultation_id,))
+                image_paths = {r[0] for r in cursor.fetchall() if r[0]}
+                if row and row[0]:
+                    image_paths.add(row[0])
                 cursor.execute("DELETE FROM prescriptions WHERE consultation_id = ?", (consultation_id,))
                 cursor.execute("DELETE FROM lab_results WHERE consultation_id = ?", (consultation_id,))
+                cursor.execute("DELETE FROM pages WHERE consultation_id = ?", (consultation_id,))
+                cursor.execute("DELETE FROM consultation_timings WHERE consultation_id = ?", (consultation_id,))
+                cursor.execute("DELETE FROM jobs WHERE consultation_id = ?", (consultation_id,))
                 cursor.execute("DELETE FROM consultations WHERE id = ?", (consultation_id,))
                 conn.commit()
-                if row and row[0]:
-                    try:
-                        if os.path.exists(row[0]):
-                            os.remove(row[0])
-                    except OSError:
-                        pass
+                if remove_image:
+                    for path in image_paths:
+                        try:
+                            if os.path.exists(path):
+                                os.remove(path)
+                        except OSError:
+                            pass
                 return True
         except sqlite3.Error as e:
             logger.error(f"Error deleting consultation {consultation_id}: {e}")
             return False
 
+    # ─── Page Methods ───────────────────────────────────────────
+    # Multi-page consultations keep one row per scanned page; the consultation's
+    # image_path points at page 1 and raw_text holds the concatenated pages.
+
+    def add_pages(self, consultation_id: int, image_paths: List[str]) -> bool:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    INSERT INTO pages (consultation_id, page_number, image_path, status, created_at)
+                    VALUES (?, ?, ?, 'pending', ?)
+                """, [(consultation_id, i + 1, path, datetime.now()) for i, path in enumerate(image_paths)])
+                cursor.execute(
+                    "UPDATE consultations SET page_count = ? WHERE id = ?",
+                    (len(image_paths), consultation_id)
+                )
+                conn.commit()
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Error adding pages to consultation {consultation_id}: {e}")
+            return False
+
+    def get_pages(self, consultation_id: int) -> List[Dict[str, Any]]:
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT * FROM pages WHERE consultation_id = ? ORDER BY page_number ASC",
+                    (consultation_id,)
+                )
+                return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching pages for consultation {consultation_id}: {e}")
+            return []
+
+    def update_page_text(self, consultation_id: int, page_number: int, text: str, status: str = 'done'):
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "UPDATE pages SET raw_text = ?, status = ? WHERE consultation_id = ? AND page_number = ?",
+                    (text, status, consultation_id, page_number)
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error updating page {page_number} of consultation {consultation_id}: {e}")
+
+    # ─── Job Queue Methods ──────────────────────────────────────
+    # Durable backing store for backend.job_scheduler. Timestamps are epoch
+    # seconds so leases can be compared directly in SQL.
+
+    def enqueue_job(self, consultation_id: int, user_id: str, stage: str, payload: Dict[str, Any],
+                    patient_id: int = None, max_attempts: int = 3) -> int:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                now = time.time()
+                cursor.execute("""
+                    INSERT INTO jobs (consultation_id, user_id, patient_id, stage, payload, status,
+                        attempts, max_attempts, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?)
+                """, (consultation_id, user_id, patient_id, stage, json.dumps(payload),
+                      max_attempts, now, now))
+                conn.commit()
+                return cursor.lastrowid
+        except sqlite3.Error as e:
+            logger.error(f"Error enqueuing job for consultation {consultation_id}: {e}")
+            return -1
+
+    def claim_job(self, job_id: int, owner: str, lease_seconds: float) -> Optional[int]:
+        """
+        Atomically lease a job that is queued or whose previous lease expired.
+        Returns the new attempt count, or None if someone else holds it.
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                now = time.time()
+                cursor.execute("""
+                    UPDATE jobs
+                    SET status = 'leased', lease_owner = ?, lease_expires_at = ?,
+                        attempts = attempts + 1, updated_at = ?
+                    WHERE id = ? AND (status = 'queued' OR (status = 'leased' AND lease_expires_at < ?))
+                """, (owner, now + lease_seconds, now, job_id, now))
+                conn.commit()
+                if cursor.rowcount != 1:
+                    return None
+                cursor.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,))
+                return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Error claiming job {job_id}: {e}")
+            return None
+
+    def renew_lease(self, job_id: int, owner: str, lease_seconds: float) -> bool:
+        """Extend a lease still held by `owner` (heartbeat for a stage that's still running)."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                now = time.time()
+                cursor.execute("""
+                    UPDATE jobs SET lease_expires_at = ?, updated_at = ?
+                    WHERE id = ? AND status = 'leased' AND lease_owner = ?
+                """, (now + lease_seconds, now, job_id, owner))
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error renewing lease of job {job_id}: {e}")
+            return False
+
+    def advance_job(self, job_id: int, owner: str, stage: str, payload: Dict[str, Any]) -> bool:
+        """Hand a leased job to its next stage. Attempts are counted per stage."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE jobs
+                    SET stage = ?, payload = ?, status = 'queued', attempts = 0,
+                        lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+                    WHERE id = ? AND lease_owner = ?
+                """, (stage, json.dumps(payload), time.time(), job_id, owner))
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error advancing job {job_id}: {e}")
+            return False
+
+    def release_job(self, job_id: int, owner: str, error: str = None) -> bool:
+        """Give a leased job back to the queue for another attempt."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE jobs
+                    SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL,
+                        last_error = ?, updated_at = ?
+                    WHERE id = ? AND lease_owner = ?
+                """, (error, time.time(), job_id, owner))
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error releasing job {job_id}: {e}")
+            return False
+
+    def finish_job(self, job_id: int, owner: str, status: str = 'done', error: str = None) -> bool:
+        """Mark a leased job as 'done' or 'failed'."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE jobs
+                    SET status = ?, last_error = ?, lease_owner = NULL, lease_expires_at = NULL,
+                        updated_at = ?
+                    WHERE id = ? AND lease_owner = ?
+                """, (status, error, time.time(), job_id, owner))
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error finishing job {job_id}: {e}")
+            return False
+
+    def cancel_jobs(self, consultation_id: int, reason: str = None) -> int:
+        """
+        Mark a consultation's queued or leased jobs 'cancelled'. Clearing the
+        lease makes a worker still running one lose it, so it can't advance or
+        finish the job afterwards.
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE jobs
+                    SET status = 'cancelled', last_error = ?, lease_owner = NULL, lease_expires_at = NULL,
+                        updated_at = ?
+                    WHERE consultation_id = ? AND status IN ('queued', 'leased')
+                """, (reason, time.time(), consultation_id))
+                conn.commit()
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error cancelling jobs of consultation {consultation_id}: {e}")
+            return 0
+
+    def get_unfinished_jobs(self) -> List[Dict[str, Any]]:
+        """Jobs that are queued or leased, oldest first (used for crash recovery)."""
+        return self._fetch_jobs("j.status IN ('queued', 'leased')", ())
+
+    def get_expired_jobs(self) -> List[Dict[str, Any]]:
+        return self._fetch_jobs("j.status = 'leased' AND j.lease_expires_at < ?", (time.time(),))
+
+    def reset_leases(self) -> int:
+        """Return every leased job to the queue. Only safe at startup, before workers run."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL,
+                        updated_at = ?
+                    WHERE status = 'leased'
+                """, (time.time(),))
+                conn.commit()
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error resetting job leases: {e}")
+            return 0
+
+    def purge_jobs(self, older_than_seconds: float = 7 * 24 * 3600) -> int:
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+                    (time.time() - older_than_seconds,)
+                )
+                conn.commit()
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error purging jobs: {e}")
+            return 0
+
+    def get_orphaned_consultations(self) -> List[Dict[str, Any]]:
+        """Consultations stuck in 'processing' with no live job behind them."""
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, user_id, patient_id, raw_text, image_path, page_count, priority FROM consultations
+                    WHERE status = 'processing' AND id NOT IN (
+                        SELECT consultation_id FROM jobs WHERE status IN ('queued', 'leased')
+                    )
+                    ORDER BY created_at ASC
+                """)
+                return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching orphaned consultations: {e}")
+            return []
+
+    def _fetch_jobs(self, where: str, params: tuple) -> List[Dict[str, Any]]:
+        try:
+            with self._get_connection() as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                # The consultation's priority comes along: it can change while the job is queued
+                cursor.execute(f"""
+                    SELECT j.*, c.priority AS priority FROM jobs j
+                    LEFT JOIN consultations c ON c.id = j.consultation_id
+                    WHERE {where} ORDER BY j.id ASC
+                """, params)
+                jobs = []
+                for row in cursor.fetchall():
+                    job = dict(row)
+                    try:
+                        job['payload'] = json.loads(job['payload']) if job.get('payload') else {}
+                    except json.JSONDecodeError:
+                        job['payload'] = {}
+                    jobs.append(job)
+                return jobs
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching jobs: {e}")
+            return []
+
+    # ─── Timing Methods ─────────────────────────────────────────
+    # One row per stage per pipeline run (a regeneration adds another run).
+    # recorded_at is epoch seconds, like the job queue.
+
+    def add_consultation_timings(self, consultation_id: int, timings: Dict[str, float]) -> bool:
+        if not timings:
+            return True
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                now = time.time()
+                cursor.executemany("""
+                    INSERT INTO consultation_timings (consultation_id, stage, seconds, recorded_at)
+                    VALUES (?, ?, ?, ?)
+                """, [(consultation_id, stage, seconds, now) for stage, seconds in timings.items()])
+                conn.commit()
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving timings for consultation {consultation_id}: {e}")
+            return False
+
+    def get_stage_timings(self, since: float, document_type: str = None,
+                          vision_fallback: bool = None, priority: str = None,
+                          limit: int = 50000) -> List[tuple]:
+        """
+        (stage, seconds) rows recorded after `since`, newest first. Filters apply
+        per consultation: its current document type and priority, and whether
+        any of its runs went through the vision fallback.
+        """
+        where = ["t.recorded_at >= ?"]
+        params: List[Any] = [since]
+        if document_type:
+            where.append("c.document_type = ?")
+            params.append(document_type)
+        if priority:
+            where.append("c.priority = ?")
+            params.append(priority)
+        if vision_fallback is not None:
+            where.append(("" if vision_fallback else "NOT ") + """EXISTS (
+                SELECT 1 FROM consultation_timings v
+                WHERE v.consultation_id = t.consultation_id AND v.stage = 'vision_fallback')""")
+        params.append(limit)
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"""
+                    SELECT t.stage, t.seconds FROM consultation_timings t
+                    JOIN consultations c ON c.id = t.consultation_id
+                    WHERE {" AND ".join(where)}
+                    ORDER BY t.recorded_at DESC
+                    LIMIT ?
+                """, params)
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching stage timings: {e}")
+            return []
+
     # ─── Prescription Methods ───────────────────────────────────
 
     def add_prescription(self, consultation_id: int, patient_id: int, drug_name: str,
@@ -598,7 +1090,7 @@ class DBManager:
 
     def add_lab_result(self, patient_id: int, consultation_id: int = None, test_name: str = "",
                        value: str = "", unit: str = "", reference_range: str = "",
-                       is_abnormal: int = 0, test_date: str = None) -> int:
+                       is_abnormal: Optional[int] = 0, test_date: str = None) -> int:
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
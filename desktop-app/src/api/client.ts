@@ -143,7 +143,7 @@ export interface LabResult {
     value?: string;
     unit?: string;
     reference_range?: string;
-    is_abnormal: number;
+    is_abnormal: number | null;
     test_date?: string;
     created_at?: string;
 }
@@ -1,10 +1,5 @@
 import customtkinter as ctk
 from typing import List, Dict, Any
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib
-
-matplotlib.use("TkAgg")
 
 class Dashboard(ctk.CTkFrame):
     def __init__(self, master):
@@ -26,6 +21,12 @@ class Dashboard(ctk.CTkFrame):
         self.chart3_frame.grid(row=1, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
 
     def update_stats(self, notes: List[Dict[str, Any]]):
+        # matplotlib is imported on first draw instead of at GUI startup
+        import matplotlib
+        matplotlib.use("TkAgg")
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
         # Clear previous charts
         for widget in self.chart1_frame.winfo_children(): widget.destroy()
         for widget in self.chart2_frame.winfo_children(): widget.destroy()
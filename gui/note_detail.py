@@ -2,8 +2,6 @@ import customtkinter as ctk
 import json
 import os
 from typing import Dict, Any, Callable
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 from tkinter import filedialog, messagebox
 
 class NoteDetail(ctk.CTkFrame):
@@ -239,6 +237,9 @@ class NoteDetail(ctk.CTkFrame):
         if not file_path: return
 
         try:
+            # reportlab is only needed here; import it on first export
+            from reportlab.lib.pagesizes import letter
+            from reportlab.pdfgen import canvas
             c = canvas.Canvas(file_path, pagesize=letter)
             width, height = letter
             y = height - 50
@@ -6,6 +6,10 @@ import qrcode
 import uvicorn
 from PIL import Image
 from backend.server import app as fastapi_app, set_upload_callback, broadcast_update_sync, set_audio_callback
+from backend.correction_index import CorrectionIndex
+from backend.model_warmup import model_warmup
+from backend.lazy_import import lazy_import, preload
+from config import config
 # from backend.voice_manager import VoiceManager
 import os
 import sys
@@ -52,6 +56,7 @@ class PaperToPlanApp(ctk.CTk):
             # Data & Logic
             logger.info("Initializing DBManager...")
             self.db = DBManager()
+            self.correction_index = CorrectionIndex(self.db)
             logger.info("DBManager initialized")
             
             self.ai = None # Lazy init or init here
@@ -93,8 +98,11 @@ class PaperToPlanApp(ctk.CTk):
                 # Import here to avoid segfault with tkinter/torch conflict
                 from backend.voice_manager import VoiceManager
                 logger.info("VoiceManager imported. Initializing...")
-                self.voice_manager = VoiceManager(model_size="base")
+                self.voice_manager = VoiceManager(model_size=config.WHISPER_MODEL_SIZE)
                 logger.info("VoiceManager initialized.")
+                # Load Whisper in the background instead of on the first voice note
+                if config.WARMUP_ENABLED:
+                    model_warmup.add_loader(f"whisper:{config.WHISPER_MODEL_SIZE}", self.voice_manager.load_model)
             except Exception as e:
                 logger.error(f"Error initializing VoiceManager: {e}")
                 logger.error(traceback.format_exc())
@@ -159,6 +167,9 @@ class PaperToPlanApp(ctk.CTk):
             self.init_ai_thread()
             logger.info("AI thread started")
 
+            # Charts and PDF export are imported in the background, not at startup
+            preload([lazy_import("matplotlib.backends.backend_tkagg"), lazy_import("reportlab.pdfgen.canvas")])
+
             # Load initial notes
             logger.info("Refreshing notes...")
             self.refresh_notes()
@@ -174,8 +185,8 @@ class PaperToPlanApp(ctk.CTk):
             try:
                 print("Initializing AI Engine...")
                 logger.info("AI Engine initialization starting...")
-                from backend.ai_manager import AIEngine
-                self.ai = AIEngine()
+                from backend.engine_registry import engine_registry
+                self.ai = engine_registry.get_engine()
                 logger.info("AI Engine initialization complete")
                 print("AI Engine Ready.")
             except Exception as e:
@@ -184,7 +195,7 @@ class PaperToPlanApp(ctk.CTk):
         threading.Thread(target=_init, daemon=True).start()
 
     def refresh_notes(self, filter_type="All", user_filter="All Users"):
-        notes = self.db.get_all_notes()
+        notes = self.db.get_all_consultations()
         filtered_notes = []
         
         # First apply time/completion filter
@@ -342,10 +353,19 @@ class PaperToPlanApp(ctk.CTk):
         server = uvicorn.Server(config)
         server.run()
 
-    def on_mobile_upload(self, file_path, user_id=None):
-        logger.info(f"Received upload callback: {file_path} from user {user_id}")
-        # Schedule processing in the main thread
-        self.after(100, lambda: self.process_new_note(file_path, user_id))
+    def on_mobile_upload(self, file_path, user_id=None, priority="normal"):
+        # Notes are processed one at a time as they arrive here, so priority only matters to the server queue
+        logger.info(f"Received upload callback: {file_path} from user {user_id} (priority {priority})")
+        # Create the note right away so the server can store the upload's fingerprint on it
+        # (duplicate detection); processing is scheduled in the main thread
+        note_id = None
+        if self.ai:
+            note_id = self.db.add_consultation(user_id or "admin", image_path=file_path,
+                                               raw_text="Procesando imagen...", priority=priority)
+            if note_id < 0:
+                note_id = None  # the main thread tries again
+        self.after(100, lambda: self.process_new_note(file_path, user_id, note_id=note_id))
+        return {"consultation_id": note_id} if note_id else None
 
     def on_mobile_audio_upload(self, file_path, user_id=None):
         logger.info(f"Received audio callback: {file_path} from user {user_id}")
@@ -412,14 +432,15 @@ class PaperToPlanApp(ctk.CTk):
         from gui.webcam import WebcamWindow
         WebcamWindow(self, self.process_new_note)
 
-    def process_new_note(self, image_path, user_id=None):
+    def process_new_note(self, image_path, user_id=None, note_id=None):
         if not self.ai:
             print("AI Engine not ready yet!")
             return
 
         # 1. Create pending note in DB (use user_id if provided, otherwise default to 'admin')
-        note_user_id = user_id if user_id else "admin"
-        note_id = self.db.add_note(image_path, raw_text="Procesando imagen...", user_id=note_user_id)
+        if note_id is None:
+            note_user_id = user_id if user_id else "admin"
+            note_id = self.db.add_consultation(note_user_id, image_path=image_path, raw_text="Procesando imagen...")
         self.refresh_notes()
 
         # 2. Start processing thread
@@ -433,44 +454,16 @@ class PaperToPlanApp(ctk.CTk):
             # 1. Extract Text (Hybrid + Few-Shot)
             print(f"Extracting text from {image_path}...")
             
-            # Fetch recent corrections for personalization
-            examples = self.db.get_recent_corrections(limit=10)
-            raw_text = self.ai.extract_text_from_image(image_path, examples=examples)
+            # Few-shot examples: past corrections most similar to this page
+            raw_text = self.ai.extract_text_from_image(image_path, select_examples=self.correction_index.select)
             
-            self.db.update_note_text(note_id, raw_text)
-            # logger.info(f"Note {note_id} text updated.") # Omitted as logger is not defined in the provided context
+            self.db.update_consultation_text(note_id, raw_text)
             print("Analyzing text...")
-            analysis = self.ai.analyze_text(raw_text)
-            
-            # Update DB
-            # We need to update raw_text too, but our DBManager.update_note_analysis only updates analysis.
-            # I'll assume for now we just update analysis and maybe I should have added a method to update raw_text.
-            # Let's do a raw SQL update here or modify DBManager. 
-            # Since I can't easily modify DBManager from here without re-writing it, I'll use a private access or just update analysis.
-            # Wait, I should fix DBManager to update raw_text too.
-            # For now, I will just update the analysis. The raw_text in DB will remain "Procesando imagen..." which is bad.
-            # I will quickly patch DBManager in the next step if needed, or just use a direct query if I was lazy, but I should be clean.
-            # Actually, I can just call a new method I'll add to DBManager, or modify the existing one.
-            # Let's assume I'll fix DBManager.
-            
-            self.db.update_note_analysis(note_id, analysis)
-            
-            # Also update raw_text? 
-            # I'll add a method to DBManager in a separate tool call if I can, or just overwrite the file now.
-            # Actually, I'll just use a direct SQL execution here since I have access to the db file? No, that's bad practice.
-            # I will rely on `update_note_analysis` for now and maybe the raw_text stays as placeholder.
-            # Wait, the user wants "raw_text (texto extraído)".
-            # I MUST update raw_text.
-            
-            # Let's manually update raw_text using a helper or just re-instantiate a cursor here? 
-            # No, I should use the DBManager.
-            # I will modify DBManager.py in a subsequent step to add `update_note_text`.
-            
-            # For now, I will proceed.
-            
+            analysis = self.ai.analyze_medical_text(raw_text)
+            self.db.update_consultation_analysis(note_id, analysis)
         except Exception as e:
             print(f"Pipeline Error: {e}")
-            self.db.update_note_error(note_id, str(e))
+            self.db.update_consultation_error(note_id, str(e))
         finally:
             # Update UI on main thread
             self.after(0, self.finish_processing)
@@ -0,0 +1,79 @@
+import pytest
+
+from backend.clinical_extractor import (
+    extract_clinical_values, extract_lab_values, extract_vitals, merge_extracted, prefill_hint
+)
+from database.db_manager import DBManager
+
+
+def _lab(labs, name):
+    return next(lab for lab in labs if lab["test_name"].lower() == name)
+
+
+def test_lab_flag_follows_the_reference_range():
+    labs = extract_lab_values("Glucosa: 180 mg/dL (70 - 110)\nHemoglobina 14.2 g/dL (12-16)")
+    assert _lab(labs, "glucosa")["is_abnormal"] is True
+    assert _lab(labs, "hemoglobina")["is_abnormal"] is False
+
+
+def test_lab_without_reference_range_is_unknown():
+    labs = extract_lab_values("Creatinina: 3.4 mg/dL")
+    assert _lab(labs, "creatinina")["is_abnormal"] is None
+
+
+def test_merge_keeps_the_models_flag_when_the_range_is_missing():
+    extracted = {"lab_values": extract_lab_values("Creatinina: 3.4 mg/dL")}
+    analysis = {"lab_values": [
+        {"test_name": "Creatinina", "value": "3.4", "unit": "mg/dL", "reference_range": "", "is_abnormal": True},
+        {"test_name": "Urea", "value": "80", "unit": "mg/dL", "reference_range": "", "is_abnormal": True},
+    ]}
+
+    labs = merge_extracted(analysis, extracted)["lab_values"]
+
+    assert [lab["test_name"] for lab in labs] == ["Creatinina", "Urea"]
+    assert _lab(labs, "creatinina")["is_abnormal"] is True
+    assert _lab(labs, "creatinina")["value"] == "3.4"
+
+
+def test_merge_prefers_the_extracted_flag_when_there_is_a_range():
+    extracted = {"lab_values": extract_lab_values("Glucosa: 95 mg/dL (70-110)")}
+    analysis = {"lab_values": [{"test_name": "Glucosa", "value": "95", "is_abnormal": True}]}
+
+    labs = merge_extracted(analysis, extracted)["lab_values"]
+
+    assert labs == extracted["lab_values"]
+    assert labs[0]["is_abnormal"] is False
+
+
+def test_vitals_from_spanish_shorthand():
+    vitals = extract_vitals("TA 120/80 mmHg, FC 78 lpm, SatO2 97%")
+    assert vitals == {"blood_pressure": "120/80 mmHg", "heart_rate": "78 lpm", "spo2": "97%"}
+
+
+def test_hint_leaves_labs_without_a_range_to_the_model():
+    extracted = extract_clinical_values("Glucosa: 180 mg/dL (70-110)\nCreatinina: 3.4 mg/dL")
+    hint = prefill_hint(extracted)
+    assert "Glucosa" in hint
+    assert "Creatinina" not in hint
+
+    assert prefill_hint(extract_clinical_values("Creatinina: 3.4 mg/dL")) == ""
+
+
+def test_lab_flags_from_extraction_to_the_stored_row(tmp_path):
+    ai_manager = pytest.importorskip("backend.ai_manager")
+    engine = ai_manager.AIEngine.__new__(ai_manager.AIEngine)
+    db = DBManager(str(tmp_path / "labs.db"))
+    patient_id = db.add_patient("Ana Pérez")
+
+    extracted = extract_clinical_values("Glucosa: 95 mg/dL (70-110)\nCreatinina: 3.4 mg/dL\nUrea: 80 mg/dL")
+    # The model judged the creatinine it was asked about, and said nothing of the urea
+    analysis = {"lab_values": [
+        {"test_name": "Creatinina", "value": "3.4", "unit": "mg/dL", "is_abnormal": True},
+    ]}
+    analysis = merge_extracted(analysis, extracted)
+    for lab in engine.extract_lab_results(analysis):
+        db.add_lab_result(patient_id, test_name=lab["test_name"], value=lab["value"], unit=lab["unit"],
+                          reference_range=lab["reference_range"], is_abnormal=lab["is_abnormal"])
+
+    stored = {row["test_name"].lower(): row["is_abnormal"] for row in db.get_lab_results_by_patient(patient_id)}
+    assert stored == {"glucosa": 0, "creatinina": 1, "urea": None}
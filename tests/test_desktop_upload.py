@@ -0,0 +1,112 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+
+for module in ("customtkinter", "qrcode", "uvicorn", "fastapi", "PIL"):
+    pytest.importorskip(module)
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from database.db_manager import DBManager
+
+
+class FakeAI:
+    def extract_text_from_image(self, image_path, select_examples=None):
+        return "TA 120/80 mmHg"
+
+    def analyze_medical_text(self, text):
+        return {"document_type": "consultation", "summary": "Control"}
+
+
+@pytest.fixture
+def desktop(tmp_path, monkeypatch):
+    """The desktop app's upload callback wired into the API server, on a temporary database."""
+    # backend.server and main open the project database at import; point it elsewhere
+    defaults = DBManager.__init__.__defaults__
+    DBManager.__init__.__defaults__ = (str(tmp_path / "import.db"), None)
+    try:
+        import main
+        from backend import server
+    finally:
+        DBManager.__init__.__defaults__ = defaults
+
+    db = DBManager(str(tmp_path / "megi.db"))
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server.upload_dedup, "db", db)
+    monkeypatch.setattr(server, "CAPTURES_DIR", str(tmp_path))
+
+    # No Tk window: only the state the upload path uses
+    app = main.PaperToPlanApp.__new__(main.PaperToPlanApp)
+    app.db = db
+    app.ai = FakeAI()
+    app.correction_index = SimpleNamespace(select=None)
+    app.scheduled = []
+    app.after = lambda ms, callback: app.scheduled.append(callback)
+    monkeypatch.setattr(server, "on_upload_callback", app.on_mobile_upload)
+
+    server.app.dependency_overrides[server.verify_user_and_pin] = lambda: "dr_lopez"
+    yield app, TestClient(server.app)
+    server.app.dependency_overrides.clear()
+
+
+def png_bytes(shade=(200, 10, 10)) -> bytes:
+    buffer = io.BytesIO()
+    image = Image.new("RGB", (32, 24), shade)
+    image.paste((20, 20, 20), (4, 4, 16, 20))
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def upload(client, data):
+    return client.post("/api/upload", files={"file": ("nota.png", data, "image/png")})
+
+
+def test_desktop_upload_creates_the_consultation_and_dedups_a_retry(desktop):
+    app, client = desktop
+    data = png_bytes()
+
+    first = upload(client, data)
+    assert first.status_code == 200
+    consultation_id = first.json()["consultation_id"]
+    consultation = app.db.get_consultation_by_id(consultation_id)
+    assert consultation["user_id"] == "dr_lopez"
+    assert consultation["content_sha256"]
+    assert len(app.scheduled) == 1
+
+    retry = upload(client, data)
+    assert retry.status_code == 200
+    assert retry.json()["status"] == "duplicate"
+    assert retry.json()["consultation_id"] == consultation_id
+    assert len(app.scheduled) == 1
+
+
+def test_similar_upload_is_processed_and_only_flagged(desktop, monkeypatch):
+    from backend import server
+
+    app, client = desktop
+    # Same layout, different pixels: like another patient's report on the same form
+    first = upload(client, png_bytes()).json()
+    second = upload(client, png_bytes(shade=(190, 12, 12))).json()
+    assert second["status"] == "success" and "possible_duplicate_of" not in second
+
+    monkeypatch.setattr(server.upload_dedup, "max_distance", 4)
+    third = upload(client, png_bytes(shade=(180, 14, 14))).json()
+    assert third["status"] == "success"
+    assert third["possible_duplicate_of"] in (first["consultation_id"], second["consultation_id"])
+    assert third["consultation_id"] not in (first["consultation_id"], second["consultation_id"])
+    assert len(app.scheduled) == 3
+
+
+def test_desktop_pipeline_updates_the_consultation(desktop):
+    app, client = desktop
+    consultation_id = upload(client, png_bytes()).json()["consultation_id"]
+    image_path = app.db.get_consultation_by_id(consultation_id)["image_path"]
+
+    app.ai_pipeline(consultation_id, image_path)
+
+    consultation = app.db.get_consultation_by_id(consultation_id)
+    assert consultation["raw_text"] == "TA 120/80 mmHg"
+    assert consultation["status"] == "processed"
+    assert consultation["ai_analysis"]["summary"] == "Control"
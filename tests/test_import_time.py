@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("cv2", "torch", "numpy", "fitz")
+# Startup budget for `import backend.server`; slow CI machines can raise it
+IMPORT_BUDGET_SECONDS = float(os.getenv("IMPORT_BUDGET_SECONDS", 3.0))
+
+# Runs in a fresh interpreter so nothing the test session already imported hides a regression.
+# The module-level DBManager is pointed at a temporary file instead of the project database.
+IMPORT_SCRIPT = """
+import json, sys, time
+from database import db_manager
+db_manager.DBManager.__init__.__defaults__ = ({db!r}, None)
+start = time.perf_counter()
+import backend.server
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def test_server_import_is_fast_and_defers_heavy_modules(tmp_path):
+    script = IMPORT_SCRIPT.format(db=str(tmp_path / "import.db"), heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True,
+                            text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    assert report["loaded"] == [], f"imported at startup: {report['loaded']}"
+    assert report["seconds"] < IMPORT_BUDGET_SECONDS, f"import took {report['seconds']:.2f}s"
@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+
+from backend.job_scheduler import JobScheduler, PipelineJob, QueueFullError
+from database.db_manager import DBManager
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def jobs(db, consultation_id):
+    return db._fetch_jobs("j.consultation_id = ?", (consultation_id,))
+
+
+def test_stage_running_past_its_lease_is_not_run_twice(tmp_path):
+    db = DBManager(str(tmp_path / "jobs.db"))
+    calls = []
+
+    def analyze(job):
+        calls.append(time.time())
+        time.sleep(2.5)
+        return None
+
+    scheduler = JobScheduler({"analyze": analyze}, {"analyze": 2}, store=db, lease_seconds=1.2)
+    scheduler.submit(PipelineJob(1, "u1", text="nota", stage="analyze"))
+
+    assert wait_for(lambda: scheduler.queue_depth()["completed"] == 1)
+    assert len(calls) == 1
+    assert jobs(db, 1)[0]["status"] == "done"
+
+
+def test_failed_stage_is_retried_after_a_backoff(tmp_path):
+    db = DBManager(str(tmp_path / "jobs.db"))
+    calls = []
+
+    def analyze(job):
+        calls.append(time.time())
+        if len(calls) < 3:
+            raise RuntimeError("ollama down")
+        return None
+
+    scheduler = JobScheduler({"analyze": analyze}, {"analyze": 1}, store=db, retry_backoff=0.2)
+    scheduler.submit(PipelineJob(1, "u1", text="nota", stage="analyze"))
+
+    assert wait_for(lambda: scheduler.queue_depth()["completed"] == 1)
+    assert calls[1] - calls[0] >= 0.2
+    assert calls[2] - calls[1] >= 0.4
+    assert scheduler.queue_depth()["retried"] == 2
+
+
+def test_job_cancelled_during_its_backoff_is_not_retried(tmp_path):
+    db = DBManager(str(tmp_path / "jobs.db"))
+    calls = []
+
+    def analyze(job):
+        calls.append(job)
+        raise RuntimeError("ollama down")
+
+    scheduler = JobScheduler({"analyze": analyze}, {"analyze": 1}, store=db, retry_backoff=0.5)
+    scheduler.submit(PipelineJob(1, "u1", text="nota", stage="analyze"))
+    assert wait_for(lambda: scheduler.queue_depth()["retried"] == 1)
+    scheduler.cancel(1)
+
+    assert wait_for(lambda: scheduler.queue_depth()["cancelled"] == 1)
+    assert len(calls) == 1
+    assert scheduler.queue_depth()["pending"] == 0
+
+
+def test_deleting_a_consultation_deletes_its_jobs(tmp_path):
+    db = DBManager(str(tmp_path / "jobs.db"))
+    db.enqueue_job(7, "u1", "analyze", {"text": "nota"})
+    db.enqueue_job(8, "u1", "analyze", {"text": "otra"})
+
+    assert db.delete_consultation(7)
+
+    assert jobs(db, 7) == []
+    assert len(jobs(db, 8)) == 1
+
+
+def test_full_queue_rejects_without_cancelling_the_running_job():
+    release = threading.Event()
+    started = threading.Event()
+
+    def analyze(job):
+        started.set()
+        release.wait(5)
+        return None
+
+    scheduler = JobScheduler({"analyze": analyze}, {"analyze": 1}, max_pending=1)
+    running = PipelineJob(1, "u1", text="nota", stage="analyze")
+    scheduler.submit(running)
+    assert started.wait(5)
+
+    with pytest.raises(QueueFullError):
+        scheduler.submit(PipelineJob(2, "u1", text="otra", stage="analyze"), supersede=True)
+
+    assert not running.cancel_token.cancelled
+    release.set()
+    assert wait_for(lambda: scheduler.queue_depth()["completed"] == 1)
+
+
+def test_regeneration_replaces_the_running_job_in_a_full_queue():
+    release = threading.Event()
+    started = threading.Event()
+    texts = []
+
+    def analyze(job):
+        texts.append(job.text)
+        started.set()
+        while not release.is_set():
+            job.cancel_token.raise_if_cancelled()
+            time.sleep(0.01)
+        return None
+
+    scheduler = JobScheduler({"analyze": analyze}, {"analyze": 1}, max_pending=1)
+    running = PipelineJob(1, "u1", text="v1", stage="analyze")
+    scheduler.submit(running)
+    assert started.wait(5)
+
+    scheduler.submit(PipelineJob(1, "u1", text="v2", stage="analyze"), supersede=True)
+    release.set()
+
+    assert running.cancel_token.cancelled
+    assert wait_for(lambda: scheduler.queue_depth()["completed"] == 1)
+    assert texts == ["v1", "v2"]
+    assert scheduler.queue_depth()["pending"] == 0
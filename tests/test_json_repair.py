@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from backend.json_repair import repair_json
+
+
+def test_valid_json_is_unchanged():
+    assert repair_json('{"a": 1, "b": [1, 2]}') == {"a": 1, "b": [1, 2]}
+
+
+def test_fences_and_surrounding_prose():
+    assert repair_json('Aquí está:\n```json\n{"a": 1}\n```\nListo.') == {"a": 1}
+
+
+def test_trailing_commas():
+    assert repair_json('{"a": [1, 2,], "b": 2,}') == {"a": [1, 2], "b": 2}
+
+
+def test_trailing_comma_inside_a_string_is_kept():
+    assert repair_json('{"a": "x, }", "b": 2,}') == {"a": "x, }", "b": 2}
+
+
+def test_bare_keys_with_single_quoted_values():
+    assert repair_json("{a: 1, b: 'x'}") == {"a": 1, "b": "x"}
+
+
+def test_single_quotes_mixed_with_double_quotes():
+    assert repair_json("""{'name': 'Juan "Pepe" O'Brien', "age": 40, 'ok': True}""") == {
+        "name": 'Juan "Pepe" O\'Brien', "age": 40, "ok": True,
+    }
+
+
+def test_apostrophes_inside_double_quoted_strings_are_kept():
+    assert repair_json('{"note": "it\'s fine", "x": None,}') == {"note": "it's fine", "x": None}
+
+
+def test_truncated_output_is_closed():
+    assert repair_json('{"a": 1, "b": [1, 2, {"c": "trunc') == {"a": 1, "b": [1, 2, {"c": "trunc"}]}
+
+
+def test_unrepairable_raises():
+    with pytest.raises(json.JSONDecodeError):
+        repair_json("no json here")
@@ -0,0 +1,68 @@
+from backend.model_warmup import ModelWarmup
+
+
+class FakeBackend:
+    def __init__(self, host, context_length):
+        self.host = host
+        self.outstanding = 0
+        self.context_length = context_length
+        self.loads = []
+
+    def load(self, model, keep_alive=None, options=None):
+        self.loads.append((model, keep_alive, options))
+        self.context_length = (options or {}).get("num_ctx", 2048)
+
+    def running_models(self):
+        return {"medllama:latest": {"expires_at": "2026-01-01T12:00:00", "context_length": self.context_length}}
+
+
+class FakePool:
+    def __init__(self, backends, options):
+        self.backends = backends
+        self.options = options
+
+    def candidates(self, model):
+        return list(self.backends)
+
+    def options_for(self, model):
+        return dict(self.options.get(model, {}))
+
+
+def make_warmup(pool):
+    return ModelWarmup(lambda: pool, ["medllama"], keep_alive="30m")
+
+
+def test_warm_up_uses_the_models_request_options():
+    backend = FakeBackend("http://a:11434", context_length=None)
+    pool = FakePool([backend], {"medllama": {"num_ctx": 8192}})
+    warmup = make_warmup(pool)
+
+    warmup.warm_all()
+
+    assert backend.loads == [("medllama", "30m", {"num_ctx": 8192})]
+    host = warmup.status()["models"]["medllama"]["hosts"]["http://a:11434"]
+    assert host["loaded"] and host["context_length"] == 8192
+    assert warmup.is_ready("medllama")
+
+
+def test_model_resident_with_another_context_is_cold():
+    backend = FakeBackend("http://a:11434", context_length=2048)
+    pool = FakePool([backend], {"medllama": {"num_ctx": 8192}})
+    warmup = make_warmup(pool)
+
+    warmup.refresh()
+
+    host = warmup.status()["models"]["medllama"]["hosts"]["http://a:11434"]
+    assert not host["loaded"]
+    assert "8192" in host["error"]
+    assert not warmup.is_ready("medllama")
+
+
+def test_unknown_context_length_is_not_a_mismatch():
+    backend = FakeBackend("http://a:11434", context_length=None)
+    pool = FakePool([backend], {"medllama": {"num_ctx": 8192}})
+    warmup = make_warmup(pool)
+
+    warmup.refresh()
+
+    assert warmup.is_ready("medllama")
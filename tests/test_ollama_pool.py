@@ -0,0 +1,202 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("ollama")
+
+from backend.cancellation import CancelToken, JobCancelled, cancel_scope
+from backend.ollama_pool import CircuitBreaker, NoBackendAvailable, OllamaPool, OllamaTimeout
+
+MODEL = "medllama"
+
+
+class StubOllama:
+    """
+    Minimal Ollama server on localhost: /api/tags and /api/chat, streaming or
+    not. `delay` holds the reply back; a streamed reply is sent as `chunks`
+    chunks, `chunk_delay` apart.
+    """
+
+    def __init__(self, reply="ok", delay=0.0, chunks=1, chunk_delay=0.0):
+        self.reply = reply
+        self.delay = delay
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._send_json({"models": [{"model": f"{MODEL}:latest", "name": f"{MODEL}:latest"}]})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                stub.requests.append(request)
+                time.sleep(stub.delay)
+                try:
+                    if not request.get("stream"):
+                        self._send_json(stub._message(stub.reply, done=True))
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.end_headers()
+                    parts = [stub.reply] + [""] * (stub.chunks - 1)
+                    for i, part in enumerate(parts):
+                        if i:
+                            time.sleep(stub.chunk_delay)
+                        line = json.dumps(stub._message(part, done=i == len(parts) - 1)) + "\n"
+                        self.wfile.write(line.encode())
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client dropped the connection (timeout, cancel, lost hedge)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.handle_error = lambda request, address: None
+        self.host = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def _message(content, done):
+        return {"model": f"{MODEL}:latest", "created_at": "2026-01-01T00:00:00Z",
+                "message": {"role": "assistant", "content": content}, "done": done}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stubs():
+    started = []
+
+    def start(**kwargs):
+        stub = StubOllama(**kwargs)
+        started.append(stub)
+        return stub
+
+    yield start
+    for stub in started:
+        stub.close()
+
+
+def closed_port_host() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def make_pool(hosts, **kwargs):
+    return OllamaPool(hosts, health_interval=0, **kwargs)
+
+
+def ask(pool, **kwargs):
+    return pool.chat(model=MODEL, messages=[{"role": "user", "content": "hola"}], **kwargs)
+
+
+def test_fails_over_when_a_host_refuses_connections(stubs):
+    live = stubs(reply="from live")
+    pool = make_pool([closed_port_host(), live.host])
+
+    response = ask(pool)
+
+    assert response["message"]["content"] == "from live"
+    dead, alive = pool.status()
+    assert not dead["healthy"] and dead["failures"] == 1
+    assert alive["healthy"] and alive["outstanding"] == 0
+
+
+def test_every_request_carries_the_models_options(stubs):
+    live = stubs()
+    pool = make_pool([live.host], model_options={MODEL: {"num_ctx": 8192}}, keep_alive="30m")
+
+    ask(pool, options={"temperature": 0.1})
+
+    assert live.requests[0]["options"] == {"num_ctx": 8192, "temperature": 0.1}
+    assert live.requests[0]["keep_alive"] == "30m"
+
+
+def test_breaker_opens_after_repeated_timeouts(stubs):
+    hung = stubs(delay=1.0)
+    pool = make_pool([hung.host], breaker_failures=2, breaker_reset=60)
+
+    for _ in range(2):
+        with pytest.raises(OllamaTimeout):
+            ask(pool, timeout=0.2)
+
+    assert pool.status()[0]["breaker"]["state"] == CircuitBreaker.OPEN
+    start = time.monotonic()
+    with pytest.raises(NoBackendAvailable):
+        ask(pool, timeout=0.2)
+    assert time.monotonic() - start < 0.1
+    assert len(hung.requests) == 2
+
+
+def test_slow_request_is_hedged_to_the_next_host(stubs):
+    slow = stubs(reply="slow", delay=1.0)
+    fast = stubs(reply="fast")
+    pool = make_pool([slow.host, fast.host], hedge_percentile=95, hedge_min_samples=5)
+    pool._stats(MODEL).samples.extend([0.05] * 5)
+
+    start = time.monotonic()
+    response = ask(pool, timeout=5)
+
+    assert response["message"]["content"] == "fast"
+    assert time.monotonic() - start < 0.8
+    stats = pool.latency_stats()[f"{MODEL}:latest"]
+    assert stats["hedged"] == 1 and stats["hedge_wins"] == 1
+
+
+def test_cancelled_attempt_leaves_a_half_open_breaker_undecided(stubs):
+    stub = stubs(delay=1.0)
+    pool = make_pool([stub.host], breaker_failures=1, breaker_reset=0.1)
+    with pytest.raises(OllamaTimeout):
+        ask(pool, timeout=0.2)
+    time.sleep(0.15)
+
+    # The half-open trial request is cancelled mid-stream
+    stub.delay, stub.chunks, stub.chunk_delay = 0.0, 20, 0.05
+    token = CancelToken()
+    threading.Timer(0.1, token.cancel, args=("superseded",)).start()
+    with cancel_scope(token), pytest.raises(JobCancelled):
+        ask(pool, timeout=5)
+
+    breaker = pool.backends[0].breaker
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert pool.status()[0]["outstanding"] == 0
+    # The trial slot was given back: the next request decides
+    assert breaker.acquire()
+
+
+def test_lost_hedge_says_nothing_about_its_host(stubs):
+    slow = stubs(reply="slow", delay=0.6)
+    fast = stubs(reply="fast")
+    pool = make_pool([slow.host, fast.host], breaker_failures=3,
+                     hedge_percentile=95, hedge_min_samples=5)
+    pool._stats(MODEL).samples.extend([0.05] * 5)
+    pool.backends[0].breaker.record_failure()
+
+    assert ask(pool, timeout=5)["message"]["content"] == "fast"
+
+    # The losing attempt is cancelled once its host answers; it must not reset the failure count
+    deadline = time.monotonic() + 3
+    while pool.status()[0]["outstanding"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert pool.status()[0]["outstanding"] == 0
+    assert pool.backends[0].breaker.consecutive_failures == 1